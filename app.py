@@ -3,7 +3,9 @@ Video Download API - Enhanced Version
 Features: Audio detection, MP3 support, automatic file cleanup, file size info
 """
 
-from flask import Flask, request, send_file, jsonify, after_this_request
+from flask import Flask, Response, request, jsonify, after_this_request
+from werkzeug.http import http_date
+from werkzeug.wsgi import wrap_file
 from flask_cors import CORS
 import os
 import re
@@ -12,7 +14,24 @@ import threading
 import uuid
 import subprocess
 import json
+import math
 import time
+import signal
+import zipfile
+import fcntl
+import sqlite3
+import hashlib
+import hmac
+import bisect
+import heapq
+import itertools
+import urllib.error
+import urllib.request
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, urlunparse, parse_qs, urlencode, quote
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+
+import yt_dlp
 
 app = Flask(__name__)
 CORS(app)
@@ -21,29 +40,881 @@ CORS(app)
 app.config['DOWNLOAD_FOLDER'] = './downloads'
 app.config['COOKIES_FILE'] = './cookies/youtube_cookies.txt'
 
+# Cookie identities rotated across extractions and downloads, one file per
+# identity under COOKIES_DIR/<platform>/<name>.txt (COOKIES_FILE is YouTube's
+# 'default'). A throttled identity sits out for IDENTITY_BACKOFF seconds,
+# doubling per consecutive throttle up to IDENTITY_BACKOFF_MAX.
+app.config['COOKIES_DIR'] = os.environ.get('COOKIES_DIR', './cookies/pool')
+app.config['IDENTITY_BACKOFF'] = int(os.environ.get('IDENTITY_BACKOFF', 60))
+app.config['IDENTITY_BACKOFF_MAX'] = int(os.environ.get('IDENTITY_BACKOFF_MAX', 3600))
+
+# Per-platform request budget (token bucket, per worker process) in front of
+# extraction and download starts: sustained requests per minute and burst.
+# Requests wait up to RATE_LIMIT_MAX_WAIT seconds for a token before a 429.
+app.config['PLATFORM_RATE_LIMITS'] = {
+    'youtube': (float(os.environ.get('YOUTUBE_RATE_PER_MINUTE', 60)), int(os.environ.get('YOUTUBE_RATE_BURST', 10))),
+    'instagram': (float(os.environ.get('INSTAGRAM_RATE_PER_MINUTE', 20)), int(os.environ.get('INSTAGRAM_RATE_BURST', 5))),
+}
+app.config['RATE_LIMIT_MAX_WAIT'] = int(os.environ.get('RATE_LIMIT_MAX_WAIT', 10))
+
+# Extraction engine: 'inprocess' keeps warm YoutubeDL instances inside the
+# worker, 'subprocess' spawns a yt-dlp CLI per request for isolation
+app.config['EXTRACTOR_MODE'] = os.environ.get('EXTRACTOR_MODE', 'inprocess')
+app.config['EXTRACTOR_POOL_SIZE'] = int(os.environ.get('EXTRACTOR_POOL_SIZE', 4))
+app.config['EXTRACT_TIMEOUT'] = int(os.environ.get('EXTRACT_TIMEOUT', 30))
+# While every pool thread is busy, up to this many extractions run as a CLI
+# instead; past that they queue for a thread and get 503 if none frees up in time
+app.config['EXTRACT_FALLBACK_SLOTS'] = int(os.environ.get('EXTRACT_FALLBACK_SLOTS', 2))
+# A pool whose thread hung past EXTRACT_TIMEOUT is replaced; at most this many
+# replaced pools may still be holding hung threads (then the pool runs short)
+app.config['EXTRACTOR_MAX_RETIRED_POOLS'] = int(os.environ.get('EXTRACTOR_MAX_RETIRED_POOLS', 2))
+
+# Metadata cache (keyed on canonical video identity)
+app.config['INFO_CACHE_TTL'] = int(os.environ.get('INFO_CACHE_TTL', 600))
+app.config['INFO_CACHE_MAX_ENTRIES'] = int(os.environ.get('INFO_CACHE_MAX_ENTRIES', 256))
+
+# /api/video/info/batch: max URLs (after playlist expansion) and parallelism
+app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 200))
+app.config['BATCH_CONCURRENCY'] = int(os.environ.get('BATCH_CONCURRENCY', 4))
+
+# /api/video/archive: at most ARCHIVE_MAX_ITEMS files per ZIP; a playlist's
+# entries are downloaded ARCHIVE_WINDOW at a time while the ZIP streams
+app.config['ARCHIVE_MAX_ITEMS'] = int(os.environ.get('ARCHIVE_MAX_ITEMS', 200))
+app.config['ARCHIVE_WINDOW'] = int(os.environ.get('ARCHIVE_WINDOW', 4))
+# Under WSGI an archive holds a request thread until its last file is in;
+# past this many, clients get 503 (ASGI: no limit)
+app.config['MAX_WSGI_ARCHIVES'] = int(os.environ.get('MAX_WSGI_ARCHIVES', 2))
+# Hand cached info dicts to the downloader (--load-info-json) while their
+# signed media URLs are still valid
+app.config['REUSE_INFO_JSON'] = os.environ.get('REUSE_INFO_JSON', '1') == '1'
+app.config['INFO_URL_EXPIRY_MARGIN'] = int(os.environ.get('INFO_URL_EXPIRY_MARGIN', 300))
+# /api/video/info returns an opaque info_token naming a copy of the info it
+# described; a download started with it loads that copy (on any worker, after
+# the cache dropped it) for INFO_TOKEN_TTL or until its media URLs expire
+app.config['INFO_TOKENS_DIR'] = os.environ.get('INFO_TOKENS_DIR', './data/info')
+app.config['INFO_TOKEN_TTL'] = int(os.environ.get('INFO_TOKEN_TTL', 3600))
+
+# Download folder janitor: total byte budget (LRU eviction), per-kind
+# expiry after last access, and how often the background sweep runs
+app.config['DOWNLOAD_FOLDER_MAX_BYTES'] = int(os.environ.get('DOWNLOAD_FOLDER_MAX_BYTES', 5 * 1024 ** 3))
+app.config['ARTIFACT_TTL'] = int(os.environ.get('ARTIFACT_TTL', 1800))
+app.config['THUMBNAIL_TTL'] = int(os.environ.get('THUMBNAIL_TTL', 24 * 3600))
+app.config['DEFAULT_FILE_TTL'] = 300
+app.config['JANITOR_INTERVAL'] = int(os.environ.get('JANITOR_INTERVAL', 30))
+
+# Download scheduler: total slots, per-platform slots and queue admission
+app.config['MAX_CONCURRENT_DOWNLOADS'] = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 4))
+app.config['PLATFORM_CONCURRENCY'] = {
+    'youtube': int(os.environ.get('YOUTUBE_CONCURRENCY', 3)),
+    'instagram': int(os.environ.get('INSTAGRAM_CONCURRENCY', 2)),
+}
+app.config['MAX_QUEUED_DOWNLOADS'] = int(os.environ.get('MAX_QUEUED_DOWNLOADS', 100))
+
+# Downloader network use: DASH/HLS fragments fetched in parallel per
+# download, and a node-wide rate budget in bytes/s (0 = unlimited) shared
+# by the downloads running at the time (never less than budget / slots
+# each). yt-dlp limits each fragment separately, so rate-limited downloads
+# fetch one fragment at a time
+app.config['CONCURRENT_FRAGMENTS'] = int(os.environ.get('CONCURRENT_FRAGMENTS', 4))
+app.config['BANDWIDTH_BUDGET'] = int(os.environ.get('BANDWIDTH_BUDGET', 0))
+
+# Speculative prefetch (opt-in): after /api/video/info, download the
+# platform's most requested format at low priority so the real request finds
+# it in flight or done. Only starts on an idle scheduler and is preempted by
+# real downloads.
+app.config['SPECULATIVE_PREFETCH'] = os.environ.get('SPECULATIVE_PREFETCH', '0') == '1'
+app.config['SPECULATIVE_MIN_SAMPLES'] = int(os.environ.get('SPECULATIVE_MIN_SAMPLES', 20))
+app.config['SPECULATIVE_MAX_ACTIVE'] = int(os.environ.get('SPECULATIVE_MAX_ACTIVE', 1))
+
+# Progressive streaming (/api/video/stream) runs in the request thread
+app.config['MAX_CONCURRENT_STREAMS'] = int(os.environ.get('MAX_CONCURRENT_STREAMS', 8))
+app.config['STREAM_CHUNK_SIZE'] = 64 * 1024
+
+# Audio re-encodes run on their own pool, off the download slots; each
+# ffmpeg gets FFMPEG_THREADS threads so the pool stays within the cores
+app.config['TRANSCODE_WORKERS'] = int(os.environ.get('TRANSCODE_WORKERS', os.cpu_count() or 2))
+app.config['FFMPEG_THREADS'] = int(os.environ.get('FFMPEG_THREADS', 1))
+
+# Served tasks are kept this long so clients can resume with Range requests
+app.config['TASK_RETENTION'] = int(os.environ.get('TASK_RETENTION', 3600))
+
+# Downloads whose tasks nobody has polled (status/progress) for this long
+# are cancelled (0 = never). Every downloader process group is recorded
+# under PROCESS_DIR so the next worker to start can reap the ones a crashed
+# worker left running.
+app.config['TASK_POLL_TIMEOUT'] = int(os.environ.get('TASK_POLL_TIMEOUT', 300))
+app.config['PROCESS_DIR'] = os.environ.get('PROCESS_DIR', './data/processes')
+
+# Every download and the tasks waiting on it are journaled under JOURNAL_DIR;
+# a worker that starts after a crash or deploy resumes the unfinished ones
+# from their partial files and gives up after MAX_RESUME_ATTEMPTS restarts
+app.config['JOURNAL_DIR'] = os.environ.get('JOURNAL_DIR', './data/journal')
+app.config['MAX_RESUME_ATTEMPTS'] = int(os.environ.get('MAX_RESUME_ATTEMPTS', 3))
+
+# Progress updates are published at most this often per download
+app.config['PROGRESS_MIN_INTERVAL'] = float(os.environ.get('PROGRESS_MIN_INTERVAL', 0.5))
+app.config['PROGRESS_STREAM_TIMEOUT'] = int(os.environ.get('PROGRESS_STREAM_TIMEOUT', 600))
+# Under WSGI every open event stream holds a request thread; past this many,
+# clients get one event and reconnect after PROGRESS_RETRY_MS (ASGI: no limit)
+app.config['MAX_PROGRESS_STREAMS'] = int(os.environ.get('MAX_PROGRESS_STREAMS', 4))
+app.config['PROGRESS_RETRY_MS'] = int(os.environ.get('PROGRESS_RETRY_MS', 5000))
+app.config['THUMBNAIL_MAX_AGE'] = 365 * 24 * 3600
+
+# Thumbnail variants (?size=&format=) are rendered once with ffmpeg and kept
+# next to the original; requested widths snap up to THUMBNAIL_SIZES. Hot
+# images are served from a bounded in-memory cache.
+app.config['THUMBNAIL_SIZES'] = (160, 320, 480, 640, 1280)
+app.config['THUMBNAIL_CACHE_BYTES'] = int(os.environ.get('THUMBNAIL_CACHE_BYTES', 32 * 1024 ** 2))
+# Each linked thumbnail's remote URL is recorded here so whichever worker
+# gets /api/thumbnail/<name> can fetch it; kept THUMBNAIL_TTL after last use
+app.config['THUMBNAIL_SOURCES_DIR'] = os.environ.get('THUMBNAIL_SOURCES_DIR', './data/thumbnails')
+
+# Task store: 'memory' or 'sqlite' (survives restarts, readable by other
+# processes on the box). Either way run one worker per download folder:
+# artifacts, the scheduler and the folder index are per process
+app.config['TASK_STORE'] = os.environ.get('TASK_STORE', 'memory')
+app.config['TASK_STORE_PATH'] = os.environ.get('TASK_STORE_PATH', './data/tasks.sqlite3')
+
+# How finished files reach clients (/api/video/file):
+#   direct    streamed by this process
+#   accel     nginx serves them: X-Accel-Redirect to ACCEL_REDIRECT_PREFIX +
+#             the file name, an internal location aliased to DOWNLOAD_FOLDER
+#               location /protected-downloads/ { internal; alias /app/downloads/; }
+#   sendfile  X-Sendfile with the absolute path (Apache mod_xsendfile, lighttpd)
+#   s3        each finished file is also uploaded to S3_BUCKET on S3_ENDPOINT
+#             (any S3-compatible store; a local MinIO for tests) and clients
+#             are redirected to a URL presigned for S3_URL_TTL seconds. The
+#             copy is deleted together with the local file.
+app.config['DELIVERY_BACKEND'] = os.environ.get('DELIVERY_BACKEND', 'direct')
+app.config['ACCEL_REDIRECT_PREFIX'] = os.environ.get('ACCEL_REDIRECT_PREFIX', '/protected-downloads/')
+app.config['S3_ENDPOINT'] = os.environ.get('S3_ENDPOINT', 'https://s3.amazonaws.com')
+app.config['S3_REGION'] = os.environ.get('S3_REGION', 'us-east-1')
+app.config['S3_BUCKET'] = os.environ.get('S3_BUCKET', '')
+app.config['S3_PREFIX'] = os.environ.get('S3_PREFIX', 'downloads/')
+app.config['S3_ACCESS_KEY'] = os.environ.get('S3_ACCESS_KEY', os.environ.get('AWS_ACCESS_KEY_ID', ''))
+app.config['S3_SECRET_KEY'] = os.environ.get('S3_SECRET_KEY', os.environ.get('AWS_SECRET_ACCESS_KEY', ''))
+app.config['S3_URL_TTL'] = int(os.environ.get('S3_URL_TTL', 300))
+app.config['S3_UPLOAD_WORKERS'] = int(os.environ.get('S3_UPLOAD_WORKERS', 2))
+
 os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
 os.makedirs('./cookies', exist_ok=True)
 FFMPEG_PATH = "ffmpeg"
 
-# Storage
-download_tasks = {}
+# -----------------------------
+# Metrics (Prometheus text format)
+# -----------------------------
+# Kept per worker process; every sample carries a worker="<pid>" label so
+# series from different workers stay apart (sum by the other labels for totals)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [(self.name, key, (), value) for key, value in sorted(values.items())]
+
+
+class Gauge:
+    """Value read at scrape time: `collect()` returns {label tuple: value}"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def samples(self):
+        values = self.collect()
+        return [(self.name, key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}       # label tuple -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(n, '')) for n in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+
+        samples = []
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                samples.append((self.name + "_bucket", key, (('le', repr(float(bound))),), cumulative))
+            samples.append((self.name + "_bucket", key, (('le', '+Inf'),), values[-1]))
+            samples.append((self.name + "_sum", key, (), values[-2]))
+            samples.append((self.name + "_count", key, (), values[-1]))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        worker = (('worker', os.getpid()),)
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                print(f"Metric {metric.name} failed: {str(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, extra, value in samples:
+                lines.append(f"{name}{_format_labels(metric.labelnames, key, extra + worker)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.register(Histogram(
+    'video_api_stage_duration_seconds',
+    'Time spent in each pipeline stage',
+    ('stage',)
+))
+BYTES_SERVED = metrics.register(Counter(
+    'video_api_served_bytes_total',
+    'Media bytes sent to clients',
+    ('endpoint',)
+))
+SUBPROCESS_SPAWNS = metrics.register(Counter(
+    'video_api_subprocess_spawns_total',
+    'External processes started',
+    ('command',)
+))
+FAILURES = metrics.register(Counter(
+    'video_api_failures_total',
+    'Failed operations by cause',
+    ('cause',)
+))
+THROTTLES = metrics.register(Counter(
+    'video_api_throttles_total',
+    'Requests a platform throttled, by cookie identity',
+    ('platform', 'identity')
+))
+DELIVERIES = metrics.register(Counter(
+    'video_api_file_deliveries_total',
+    'Completed files handed to clients, by who sends the bytes (direct, accel, sendfile, s3)',
+    ('backend',)
+))
+RECOVERED_DOWNLOADS = metrics.register(Counter(
+    'video_api_recovered_downloads_total',
+    'Journaled downloads picked up after a restart, by outcome (resumed, restored, failed)',
+    ('outcome',)
+))
+
+
+SPECULATIONS = metrics.register(Counter(
+    'video_api_speculative_downloads_total',
+    'Speculative prefetches by outcome (started, hit, wasted; preempted ones also count as wasted)',
+    ('outcome',)
+))
+SPECULATIVE_WASTED_BYTES = metrics.register(Counter(
+    'video_api_speculative_wasted_bytes_total',
+    'Bytes of speculative downloads that were never requested'
+))
+
+
+def count_spawn(cmd):
+    SUBPROCESS_SPAWNS.inc(command=os.path.basename(cmd[0]))
+
+
+# -----------------------------
+# Task storage
+# -----------------------------
+class InMemoryTaskStore:
+    """Task state in a dict; only visible to the current worker process"""
+
+    def __init__(self):
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def create(self, task_id, task):
+        with self._lock:
+            self._tasks[task_id] = dict(task)
+
+    def get(self, task_id):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            return dict(task) if task is not None else None
+
+    def update(self, task_id, **fields):
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return False
+            task.update(fields)
+            return True
+
+    def delete(self, task_id):
+        with self._lock:
+            self._tasks.pop(task_id, None)
+
+    def count(self):
+        with self._lock:
+            return len(self._tasks)
+
+    def count_by_status(self):
+        with self._lock:
+            counts = {}
+            for task in self._tasks.values():
+                counts[task.get('status')] = counts.get(task.get('status'), 0) + 1
+            return counts
+
+    def purge_served(self, cutoff):
+        """Delete tasks served before cutoff; returns the removed tasks by id"""
+        with self._lock:
+            expired = {
+                task_id: task for task_id, task in self._tasks.items()
+                if task.get('served_at') and task['served_at'] < cutoff
+            }
+            for task_id in expired:
+                del self._tasks[task_id]
+            return expired
 
 
-def cleanup_old_files():
-    """Delete files older than 5 minutes"""
+class SqliteTaskStore:
+    """Task state in SQLite (WAL mode), shared by every worker process on the host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " task_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " served_at REAL,"
+            " updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS tasks_served_at ON tasks (served_at)")
+
+    def _conn(self):
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def create(self, task_id, task):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO tasks (task_id, data, served_at, updated_at) VALUES (?, ?, ?, ?)",
+            (task_id, json.dumps(task), task.get('served_at'), time.time())
+        )
+
+    def get(self, task_id):
+        row = self._conn().execute("SELECT data FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, task_id, **fields):
+        # json_set writes every field in a single statement, so concurrent
+        # writers from other processes never lose each other's fields. Unlike
+        # json_patch it stores None as null instead of deleting the key,
+        # which keeps documents identical to InMemoryTaskStore's
+        paths = "".join(", ?, json(?)" for _ in fields)
+        values = [v for name, value in fields.items() for v in (f'$."{name}"', json.dumps(value))]
+        cur = self._conn().execute(
+            f"UPDATE tasks SET data = json_set(data{paths}),"
+            " served_at = COALESCE(?, served_at), updated_at = ?"
+            " WHERE task_id = ?",
+            (*values, fields.get('served_at'), time.time(), task_id)
+        )
+        return cur.rowcount > 0
+
+    def delete(self, task_id):
+        self._conn().execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    def count_by_status(self):
+        rows = self._conn().execute(
+            "SELECT json_extract(data, '$.status'), COUNT(*) FROM tasks GROUP BY 1"
+        ).fetchall()
+        return dict(rows)
+
+    def purge_served(self, cutoff):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT task_id, data FROM tasks WHERE served_at IS NOT NULL AND served_at < ?",
+                (cutoff,)
+            ).fetchall()
+            conn.execute("DELETE FROM tasks WHERE served_at IS NOT NULL AND served_at < ?", (cutoff,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return {task_id: json.loads(data) for task_id, data in rows}
+
+
+def create_task_store():
+    backend = app.config['TASK_STORE']
+    if backend == 'sqlite':
+        return SqliteTaskStore(app.config['TASK_STORE_PATH'])
+    if backend == 'memory':
+        return InMemoryTaskStore()
+    raise ValueError(f"Unknown TASK_STORE backend: {backend}")
+
+
+task_store = create_task_store()
+
+
+# -----------------------------
+# Download folder index + janitor
+# -----------------------------
+class FileIndex:
+    """In-memory index of files in the download folder
+
+    Entries are kept in last-access order (for LRU eviction under the byte
+    budget) and in a heap keyed on expiry. Files with active readers, or
+    whose name starts with a prefix that is still being written, are never
+    deleted.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # path -> entry, least recently used first
+        self._expiry = []               # heap of (expires_at, path); stale items skipped
+        self._writing = {}              # path prefix -> active writer count
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def add(self, path, ttl, on_evict=None):
+        """Index a finished file; it expires ttl seconds after its last access"""
+        size = os.path.getsize(path)
+        now = time.time()
+
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old:
+                self.total_bytes -= old['size']
+            self._entries[path] = {
+                'size': size,
+                'ttl': ttl,
+                'expires_at': now + ttl,
+                'readers': 0,
+                'on_evict': on_evict
+            }
+            self.total_bytes += size
+            heapq.heappush(self._expiry, (now + ttl, path))
+            over_budget = self.total_bytes > self.max_bytes
+
+        if over_budget:
+            janitor_wakeup.set()
+
+    def touch(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry:
+                entry['expires_at'] = time.time() + entry['ttl']
+                self._entries.move_to_end(path)
+
+    def acquire(self, path):
+        """Pin a file while it is being read"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry:
+                entry['readers'] += 1
+                entry['expires_at'] = time.time() + entry['ttl']
+                self._entries.move_to_end(path)
+
+    def release(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry['readers'] > 0:
+                entry['readers'] -= 1
+                entry['expires_at'] = time.time() + entry['ttl']
+
+    def begin_write(self, prefix):
+        with self._lock:
+            self._writing[prefix] = self._writing.get(prefix, 0) + 1
+
+    def end_write(self, prefix):
+        with self._lock:
+            if self._writing.get(prefix, 0) <= 1:
+                self._writing.pop(prefix, None)
+            else:
+                self._writing[prefix] -= 1
+
+    def discard(self, path):
+        """Unindex a file nobody is using so the caller can delete it now; None if busy"""
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None or self._busy(path, entry):
+                return None
+            return self._take(path)
+
+    def _busy(self, path, entry):
+        # Caller must hold self._lock
+        return entry['readers'] > 0 or any(path.startswith(p) for p in self._writing)
+
+    def _take(self, path):
+        # Caller must hold self._lock
+        entry = self._entries.pop(path)
+        self.total_bytes -= entry['size']
+        return entry
+
+    def collect(self):
+        """Unindex expired files, then LRU files over budget; returns [(path, entry)] to delete"""
+        now = time.time()
+        victims = []
+        later = []
+
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                _, path = heapq.heappop(self._expiry)
+                entry = self._entries.get(path)
+                if entry is None:
+                    continue
+                if entry['expires_at'] > now or self._busy(path, entry):
+                    # Touched since it was queued, or in use: check again later
+                    # (requeued after the sweep, or a zero TTL would spin here)
+                    later.append((max(entry['expires_at'], now + entry['ttl']), path))
+                    continue
+                victims.append((path, self._take(path)))
+                self.expirations += 1
+            for item in later:
+                heapq.heappush(self._expiry, item)
+
+            if self.total_bytes > self.max_bytes:
+                for path, entry in list(self._entries.items()):
+                    if self.total_bytes <= self.max_bytes:
+                        break
+                    if self._busy(path, entry):
+                        continue
+                    victims.append((path, self._take(path)))
+                    self.evictions += 1
+
+        return victims
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'active_readers': sum(e['readers'] for e in self._entries.values()),
+                'active_writers': len(self._writing),
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+
+file_index = FileIndex(app.config['DOWNLOAD_FOLDER_MAX_BYTES'])
+janitor_wakeup = threading.Event()
+
+
+def run_janitor_pass():
+    """Delete whatever the index says has expired or no longer fits the budget"""
+    for path, entry in file_index.collect():
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            print(f"✓ Cleaned up: {os.path.basename(path)}")
+        except OSError as e:
+            print(f"Cleanup error: {str(e)}")
+        # Along with any copy the delivery backend holds
+        delivery.remove(path)
+        if entry['on_evict']:
+            entry['on_evict']()
+
+
+def janitor_loop():
+    while True:
+        janitor_wakeup.wait(app.config['JANITOR_INTERVAL'])
+        janitor_wakeup.clear()
+        try:
+            run_janitor_pass()
+            cancel_abandoned_tasks()
+            recover_downloads()
+            prune_thumbnail_sources()
+            prune_info_tokens()
+        except Exception as e:
+            print(f"Janitor error: {str(e)}")
+
+
+def index_existing_files():
+    """Index files left over from a previous run so they expire normally"""
+    folder = app.config['DOWNLOAD_FOLDER']
+    # Tracks of an unfinished download wait for it to resume, and files of
+    # another live worker are its to expire: its readers' pins are not ours
+    skip = download_journal.unfinished_prefixes() + download_journal.live_prefixes()
+    skip += [os.path.basename(entry['prefix']) for _, entry, owner_alive in process_registry.entries()
+             if owner_alive and entry.get('prefix')]
+    skip = tuple(skip)
+    for filename in os.listdir(folder):
+        path = os.path.join(folder, filename)
+        # Partial files still here belong to another worker's live download
+        if os.path.isfile(path) and not PARTIAL_FILE_RE.search(filename) and not filename.startswith(skip):
+            file_index.add(path, app.config['DEFAULT_FILE_TTL'])
+
+
+def start_janitor():
+    reap_orphans()
+    index_existing_files()
+    recover_downloads()
+    threading.Thread(target=janitor_loop, daemon=True, name='janitor').start()
+
+
+# -----------------------------
+# Subprocess lifecycle
+# -----------------------------
+# What yt-dlp and ffmpeg write while they run: .part, .part-FragN, .ytdl,
+# .temp.<ext> merge output and unmerged .f<format_id>.<ext> tracks
+PARTIAL_FILE_RE = re.compile(r'\.part$|\.part-Frag\d+|\.ytdl$|\.temp\.\w+$|\.f[\w-]+\.\w+$')
+
+
+def _process_start_time(pid):
+    """Kernel start time of a pid (tells a live process from a reused pid); None if gone"""
     try:
-        download_folder = app.config['DOWNLOAD_FOLDER']
-        current_time = time.time()
-        
-        for filename in os.listdir(download_folder):
-            filepath = os.path.join(download_folder, filename)
-            if os.path.isfile(filepath):
-                file_age = current_time - os.path.getmtime(filepath)
-                if file_age > 300:  # 5 minutes
-                    os.remove(filepath)
-                    print(f"Cleaned up old file: {filename}")
-    except Exception as e:
-        print(f"Cleanup error: {str(e)}")
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+
+
+def _process_alive(pid, start_time):
+    if start_time is not None:
+        return _process_start_time(pid) == start_time
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ProcessRegistry:
+    """Process groups spawned by this service, one JSON file each
+
+    Every downloader runs as the leader of its own process group, so killing
+    the group also takes down the ffmpeg children yt-dlp starts. The files
+    outlive a crashed worker, which lets the next one to start find its
+    orphans and their partial files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._owner = {'pid': os.getpid(), 'start_time': _process_start_time(os.getpid())}
+
+    def _file(self, pgid):
+        return os.path.join(self.path, f"{pgid}.json")
+
+    def register(self, pgid, cmd, prefix=None):
+        if self._owner['pid'] != os.getpid():
+            # Forked since import (gunicorn --preload)
+            self._owner = {'pid': os.getpid(), 'start_time': _process_start_time(os.getpid())}
+        with open(self._file(pgid), 'w') as f:
+            json.dump({
+                'owner': self._owner,
+                'command': os.path.basename(cmd[0]),
+                'prefix': prefix,
+                'started_at': time.time()
+            }, f)
+
+    def unregister(self, pgid):
+        try:
+            os.remove(self._file(pgid))
+        except OSError:
+            pass
+
+    def entries(self):
+        """[(pgid, entry, owner_alive)] for every recorded process group"""
+        result = []
+        for filename in os.listdir(self.path):
+            pgid, ext = os.path.splitext(filename)
+            if ext != '.json' or not pgid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.path, filename)) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            owner = entry.get('owner') or {}
+            result.append((int(pgid), entry, _process_alive(owner.get('pid', 0), owner.get('start_time'))))
+        return result
+
+
+process_registry = ProcessRegistry(app.config['PROCESS_DIR'])
+
+
+def spawn_process(cmd, prefix=None, **popen_args):
+    """Popen cmd as the leader of a new process group and record it
+
+    prefix is the output path prefix its partial files live under. Wait
+    for it with reap_process().
+    """
+    count_spawn(cmd)
+    process = subprocess.Popen(cmd, start_new_session=True, **popen_args)
+    process_registry.register(process.pid, cmd, prefix)
+    return process
+
+
+def kill_process_group(pgid):
+    """SIGKILL a process group: the downloader and whatever it spawned"""
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def reap_process(process, kill=False):
+    """Wait for a spawn_process() leader, SIGKILL what is left of its group, then reap it
+
+    Children can outlive the leader (an ffmpeg yt-dlp was waiting on). The
+    leader is waited for without being reaped, and a zombie keeps its pid
+    reserved, so the group kill cannot hit a new session that reused the
+    number. kill=True stops a leader that is still running first.
+    """
+    if kill:
+        kill_process_group(process.pid)
+    try:
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        kill_process_group(process.pid)
+    except ChildProcessError:
+        pass    # already reaped; too late to kill the group safely
+    process.wait()
+    process_registry.unregister(process.pid)
+
+
+def process_exited(pgid):
+    """Clean up after a leader something else already reaped (asyncio's child watcher)"""
+    # Its pid is free now: a live process with that pid is someone else's
+    # session. Otherwise leftover members keep the pgid from being reused.
+    if not os.path.exists(f"/proc/{pgid}"):
+        kill_process_group(pgid)
+    process_registry.unregister(pgid)
+
+
+def _is_recorded_process(pgid, entry):
+    try:
+        with open(f"/proc/{pgid}/cmdline", 'rb') as f:
+            cmdline = f.read().replace(b'\0', b' ').decode('utf-8', errors='replace')
+    except FileNotFoundError:
+        # Leader gone; the pgid cannot have been reused while members remain
+        return True
+    except OSError:
+        return False
+    if not cmdline:
+        # Zombie leader: same as gone
+        return True
+    prefix = entry.get('prefix')
+    return entry.get('command', '') in cmdline and (not prefix or os.path.basename(prefix) in cmdline)
+
+
+def kill_orphaned_groups():
+    """Kill process groups whose worker died; returns the output prefixes of live ones"""
+    live_prefixes = []
+    for pgid, entry, owner_alive in process_registry.entries():
+        if owner_alive:
+            if entry.get('prefix'):
+                live_prefixes.append(os.path.basename(entry['prefix']))
+            continue
+        if _is_recorded_process(pgid, entry):
+            kill_process_group(pgid)
+            print(f"✓ Reaped orphaned {entry.get('command')} (pgid {pgid})")
+        process_registry.unregister(pgid)
+    return live_prefixes
+
+
+def reap_orphans():
+    """Kill process groups whose worker died, then delete partial files nobody is writing"""
+    # Listed first: a download registers its process before it creates files
+    folder = app.config['DOWNLOAD_FOLDER']
+    partials = [f for f in os.listdir(folder) if PARTIAL_FILE_RE.search(f)]
+
+    # Journaled downloads resume from theirs
+    keep = kill_orphaned_groups() + download_journal.unfinished_prefixes()
+
+    for filename in partials:
+        if any(filename.startswith(prefix) for prefix in keep):
+            continue
+        try:
+            os.remove(os.path.join(folder, filename))
+            print(f"✓ Removed stray partial file: {filename}")
+        except OSError:
+            pass
 
 
 def get_platform(url):
@@ -54,6 +925,52 @@ def get_platform(url):
     return None
 
 
+YOUTUBE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+YOUTUBE_PATH_PREFIXES = ('shorts', 'embed', 'live', 'v', 'e')
+INSTAGRAM_PATH_PREFIXES = ('p', 'reel', 'reels', 'tv')
+TRACKING_PARAMS = ('t', 'si', 'feature', 'igsh', 'igshid', 'utm_source', 'utm_medium', 'utm_campaign')
+
+
+def get_video_key(url, platform=None):
+    """Return a canonical identity like 'youtube:<id>' for the video behind a URL"""
+    platform = platform or get_platform(url)
+    url = url.strip()
+    if '://' not in url:
+        url = 'https://' + url
+
+    parsed = urlparse(url)
+    host = (parsed.hostname or '').lower()
+    parts = [p for p in parsed.path.split('/') if p]
+    query = parse_qs(parsed.query)
+
+    if platform == "youtube":
+        video_id = None
+        if host.endswith('youtu.be'):
+            video_id = parts[0] if parts else None
+        elif query.get('v'):
+            video_id = query['v'][0]
+        elif len(parts) >= 2 and parts[0] in YOUTUBE_PATH_PREFIXES:
+            video_id = parts[1]
+
+        if video_id and YOUTUBE_ID_RE.match(video_id):
+            return f"youtube:{video_id}"
+
+    elif platform == "instagram":
+        # instagram.com/p/<code>/ and instagram.com/<user>/reel/<code>/
+        for i, part in enumerate(parts[:-1]):
+            if part in INSTAGRAM_PATH_PREFIXES:
+                return f"instagram:{parts[i + 1]}"
+
+    # Unknown shape: fall back to the URL minus fragment and tracking params
+    if host.startswith('www.') or host.startswith('m.'):
+        host = host.split('.', 1)[1]
+    kept = sorted((k, v) for k, vs in query.items() if k not in TRACKING_PARAMS for v in vs)
+    canonical = host + '/' + '/'.join(parts)
+    if kept:
+        canonical += '?' + urlencode(kept)
+    return f"{platform}:{canonical}"
+
+
 def format_filesize(bytes_size):
     """Convert bytes to human readable format"""
     if not bytes_size:
@@ -75,314 +992,3971 @@ def format_filesize(bytes_size):
         return f"{gb_size:.2f} GB"
 
 
-def get_video_info_universal(url, platform):
-    try:
-        cmd = [
-            'yt-dlp',
-            '--dump-json',
-            '--no-warnings',
-            '--no-check-certificates',
-            url
-        ]
+# -----------------------------
+# Metadata cache
+# -----------------------------
+class _Flight:
+    """A single in-progress load that concurrent callers wait on"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class InfoCache:
+    """TTL + LRU cache with single-flight loading of missing keys"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> (expires_at, value)
+        self._inflight = {}             # key -> _Flight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        # Caller must hold self._lock
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, key):
+        with self._lock:
+            return self._lookup(key)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, running loader() at most once across threads"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+            self.put(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'entries': size,
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions
+        }
+
+
+info_cache = InfoCache(app.config['INFO_CACHE_TTL'], app.config['INFO_CACHE_MAX_ENTRIES'])
+
+# Large fields we never use; dropping them keeps cached info dicts small
+INFO_DROP_KEYS = ('automatic_captions', 'subtitles', 'heatmap')
+
+
+# -----------------------------
+# Platform rate limits and cookie identities
+# -----------------------------
+# What yt-dlp prints when a platform pushes back (HTTP 429, bot checks,
+# Instagram's "rate-limit reached")
+THROTTLE_RE = re.compile(r"HTTP Error 429|Too Many Requests|confirm you.re not a bot|rate[- ]limit", re.I)
+IDENTITY_NAME_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+SUPPORTED_PLATFORMS = ('youtube', 'instagram')
+
+
+class Throttled(Exception):
+    pass
+
+
+class TokenBucket:
+    """`rate` tokens per second up to `burst`; pause() withholds tokens entirely for a while"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self.granted = 0
+        self.rejected = 0
+
+    def _refill(self, now):
+        # Caller must hold self._cond; nothing accrues while paused
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _delay(self, now):
+        # Caller must hold self._cond
+        if self._paused_until > now:
+            return self._paused_until - now
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """Take a token, waiting up to timeout seconds (None = as long as it takes); False if none came"""
+        if self.rate <= 0:
+            return True
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                delay = self._delay(now)
+                if not delay:
+                    self._tokens -= 1
+                    self.granted += 1
+                    return True
+                if deadline is not None and now + delay > deadline:
+                    # Not going to make it; say so now instead of at the deadline
+                    self.rejected += 1
+                    return False
+                self._cond.wait(delay)
+
+    def try_acquire(self):
+        """Take a token if one is free right now; returns 0, or the seconds until one would be"""
+        if self.rate <= 0:
+            return 0.0
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            delay = self._delay(now)
+            if not delay:
+                self._tokens -= 1
+                self.granted += 1
+            return delay
+
+    def delay(self):
+        """Seconds until the next token would be granted"""
+        if self.rate <= 0:
+            return 0.0
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return self._delay(now)
+
+    def pause(self, seconds):
+        """Grant nothing for `seconds`, then restart from an empty bucket"""
+        with self._cond:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = self._paused_until
+            self._cond.notify_all()
+
+    def stats(self):
+        return {
+            'rate_per_minute': self.rate * 60,
+            'burst': self.burst,
+            'delay': round(self.delay(), 2),
+            'granted': self.granted,
+            'rejected': self.rejected
+        }
+
+
+platform_buckets = {
+    platform: TokenBucket(per_minute / 60, burst)
+    for platform, (per_minute, burst) in app.config['PLATFORM_RATE_LIMITS'].items()
+}
+
+
+def take_platform_token(platform, timeout):
+    """Wait for the platform's request budget; raises RateLimited after timeout seconds"""
+    bucket = platform_buckets.get(platform)
+    if bucket is None:
+        return
+    started = time.perf_counter()
+    if not bucket.acquire(timeout):
+        raise RateLimited(f"{platform} request budget exhausted, retry later", bucket.delay())
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage='rate_limit_wait')
+
+
+def try_platform_token(platform):
+    """Take a platform token without waiting; returns 0, or the seconds until one is due"""
+    bucket = platform_buckets.get(platform)
+    if bucket is None:
+        return 0.0
+    return bucket.try_acquire()
+
+
+class IdentityPool:
+    """Cookie identities handed out round-robin, with per-identity backoff on throttling
+
+    Identity files live on disk so uploads reach every worker; health is
+    kept per worker process. When every identity of a platform is backing
+    off, requests go out without cookies ('anonymous'), and a throttled
+    anonymous request pauses the platform's token bucket instead.
+    """
+
+    RESCAN_INTERVAL = 5
+
+    def __init__(self, directory, legacy_file, backoff, backoff_max):
+        self.directory = directory
+        self.legacy_file = legacy_file
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._identities = {}       # (platform, name) -> identity dict
+        self._anonymous = {p: self._new_identity(p, 'anonymous', None) for p in SUPPORTED_PLATFORMS}
+        self._lock = threading.Lock()
+        self._scanned_at = 0.0
+        for platform in SUPPORTED_PLATFORMS:
+            os.makedirs(os.path.join(directory, platform), exist_ok=True)
+
+    @staticmethod
+    def _new_identity(platform, name, path):
+        return {
+            'platform': platform,
+            'name': name,
+            'path': path,
+            'leases': 0,
+            'uses': 0,
+            'throttles': 0,
+            'consecutive_throttles': 0,
+            'backoff_until': 0.0,
+            'last_used': 0.0
+        }
+
+    def path_for(self, platform, name):
+        if platform == 'youtube' and name == 'default':
+            return self.legacy_file
+        return os.path.join(self.directory, platform, f"{name}.txt")
+
+    def _scan(self, force=False):
+        # Caller must hold self._lock
+        now = time.time()
+        if not force and now - self._scanned_at < self.RESCAN_INTERVAL:
+            return
+        self._scanned_at = now
+
+        found = {}
+        if os.path.exists(self.legacy_file):
+            found[('youtube', 'default')] = self.legacy_file
+        for platform in SUPPORTED_PLATFORMS:
+            for filename in os.listdir(os.path.join(self.directory, platform)):
+                name, ext = os.path.splitext(filename)
+                if ext == '.txt' and IDENTITY_NAME_RE.match(name):
+                    found[(platform, name)] = os.path.join(self.directory, platform, filename)
+
+        for key in list(self._identities):
+            if key not in found:
+                del self._identities[key]
+        for key, path in found.items():
+            if key not in self._identities:
+                self._identities[key] = self._new_identity(key[0], key[1], path)
+
+    def save(self, platform, name, file):
+        """Store an uploaded cookies file as an identity (replacing it, with fresh health)"""
+        path = self.path_for(platform, name)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        file.save(tmp_path)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._identities.pop((platform, name), None)
+            self._scan(force=True)
+
+    def acquire(self, platform):
+        """Lease the least busy healthy identity; the anonymous one if none is healthy"""
+        now = time.time()
+        with self._lock:
+            self._scan()
+            healthy = [
+                identity for (p, _), identity in self._identities.items()
+                if p == platform and identity['backoff_until'] <= now
+            ]
+            if healthy:
+                identity = min(healthy, key=lambda i: (i['leases'], i['last_used']))
+            else:
+                identity = self._anonymous.get(platform) or self._new_identity(platform, 'anonymous', None)
+            identity['leases'] += 1
+            identity['uses'] += 1
+            identity['last_used'] = now
+            return identity
+
+    def release(self, identity, throttled=False, succeeded=False):
+        """Return a lease; a throttled identity backs off exponentially. Returns the backoff (seconds)"""
+        backoff = 0
+        with self._lock:
+            identity['leases'] = max(identity['leases'] - 1, 0)
+            if throttled:
+                identity['throttles'] += 1
+                identity['consecutive_throttles'] += 1
+                backoff = min(self.backoff * 2 ** (identity['consecutive_throttles'] - 1), self.backoff_max)
+                identity['backoff_until'] = max(identity['backoff_until'], time.time() + backoff)
+            elif succeeded:
+                identity['consecutive_throttles'] = 0
+
+        if throttled:
+            THROTTLES.inc(platform=identity['platform'], identity=identity['name'])
+            print(f"⚠ {identity['platform']} identity '{identity['name']}' throttled, backing off {backoff}s")
+            if identity['path'] is None:
+                # Nobody left to rotate to: slow the whole platform down
+                bucket = platform_buckets.get(identity['platform'])
+                if bucket:
+                    bucket.pause(backoff)
+        return backoff
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            self._scan()
+            identities = list(self._identities.values()) + list(self._anonymous.values())
+            return [
+                {
+                    'platform': i['platform'],
+                    'name': i['name'],
+                    'healthy': i['backoff_until'] <= now,
+                    'backoff_remaining': max(round(i['backoff_until'] - now), 0),
+                    'leases': i['leases'],
+                    'uses': i['uses'],
+                    'throttles': i['throttles']
+                }
+                for i in identities
+            ]
+
+
+identity_pool = IdentityPool(
+    app.config['COOKIES_DIR'],
+    app.config['COOKIES_FILE'],
+    app.config['IDENTITY_BACKOFF'],
+    app.config['IDENTITY_BACKOFF_MAX']
+)
+
+
+def cookie_args(identity):
+    return ["--cookies", identity['path']] if identity and identity['path'] else []
+
+
+def with_identity(cmd, identity):
+    """cmd with its --cookies option replaced by identity's"""
+    if "--cookies" in cmd:
+        i = cmd.index("--cookies")
+        cmd = cmd[:i] + cmd[i + 2:]
+    return cmd[:1] + cookie_args(identity) + cmd[1:]
+
+
+# -----------------------------
+# Extraction engine
+# -----------------------------
+YDL_INFO_OPTIONS = {
+    'quiet': True,
+    'noplaylist': True,
+    'no_warnings': True,
+    'nocheckcertificate': True,
+    'skip_download': True,
+    'noprogress': True,
+    'socket_timeout': app.config['EXTRACT_TIMEOUT'],
+}
+
+_ydl_local = threading.local()
+
+
+def _new_extract_executor():
+    executor = ThreadPoolExecutor(
+        max_workers=app.config['EXTRACTOR_POOL_SIZE'],
+        thread_name_prefix='extractor'
+    )
+    executor.inflight = 0           # submitted and not finished, guarded by _extract_executor_lock
+    return executor
+
+
+_extract_executor = _new_extract_executor()
+_extract_executor_lock = threading.Lock()
+_retired_extract_executors = set()     # replaced pools still holding hung threads
+_extract_fallback_slots = threading.BoundedSemaphore(app.config['EXTRACT_FALLBACK_SLOTS'])
+
+
+def _claim_extractor():
+    """(current pool, whether all its threads were already taken); counts the new job"""
+    with _extract_executor_lock:
+        executor = _extract_executor
+        busy = executor.inflight >= app.config['EXTRACTOR_POOL_SIZE']
+        executor.inflight += 1
+        return executor, busy
+
+
+def _release_extractor(executor):
+    with _extract_executor_lock:
+        executor.inflight -= 1
+        if not executor.inflight:
+            _retired_extract_executors.discard(executor)
+
+
+def retire_extract_executor(executor, future):
+    """Swap in a fresh pool after one of executor's threads got stuck in yt-dlp
+
+    A running extract_info call cannot be interrupted, so the stuck thread
+    stays busy until yt-dlp returns. The retired pool still finishes what
+    was queued on it; its threads exit once idle. Once
+    EXTRACTOR_MAX_RETIRED_POOLS retired pools are still stuck, the current
+    pool is kept and simply has fewer threads until one returns.
+    """
+    global _extract_executor
+    if future.done():
+        return
+    with _extract_executor_lock:
+        if _extract_executor is not executor:
+            return
+        if len(_retired_extract_executors) >= app.config['EXTRACTOR_MAX_RETIRED_POOLS']:
+            print("⚠️ Extraction hung; too many hung pools to replace this one")
+            return
+        _retired_extract_executors.add(executor)
+        _extract_executor = _new_extract_executor()
+    executor.shutdown(wait=False)
+    print("⚠️ Extraction timed out; replaced the extractor pool")
+
+
+# Playlist/channel listing: entries only, no per-video extraction
+YDL_FLAT_OPTIONS = dict(YDL_INFO_OPTIONS, noplaylist=False, extract_flat='in_playlist')
+
+
+def _get_worker_ydl(flat=False, cookiefile=None):
+    """Return the warm YoutubeDL instance owned by the current pool thread (one per identity)"""
+    instances = getattr(_ydl_local, 'instances', None)
+    if instances is None:
+        instances = _ydl_local.instances = {}
+
+    # The cookie jar is read once per instance, so a refreshed cookie file
+    # (IdentityPool.save) needs a new one
+    try:
+        version = os.path.getmtime(cookiefile) if cookiefile else None
+    except OSError:
+        version = None
+
+    cached = instances.get((flat, cookiefile))
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    options = dict(YDL_FLAT_OPTIONS if flat else YDL_INFO_OPTIONS)
+    if cookiefile:
+        options['cookiefile'] = cookiefile
+    ydl = yt_dlp.YoutubeDL(options)
+    instances[(flat, cookiefile)] = (version, ydl)
+    return ydl
+
+
+def _extract_inprocess(url, flat=False, cookiefile=None):
+    ydl = _get_worker_ydl(flat, cookiefile)
+    try:
+        info = ydl.extract_info(url, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        print("YT-DLP ERROR:", str(e))
+        if THROTTLE_RE.search(str(e)):
+            raise Throttled(str(e))
+        raise Exception("Video not accessible")
+    # Round-trip through sanitize_info so the dict matches --dump-json output
+    return ydl.sanitize_info(info)
+
+
+def _extract_subprocess(url, timeout, flat=False, cookiefile=None):
+    if flat:
+        cmd = [
+            'yt-dlp',
+            '--dump-single-json',
+            '--flat-playlist',
+            '--no-warnings',
+            '--no-check-certificates',
+            url
+        ]
+    else:
+        cmd = [
+            'yt-dlp',
+            '--dump-json',
+            '--no-warnings',
+            '--no-check-certificates',
+            '--no-playlist',
+            url
+        ]
+    if cookiefile:
+        cmd[1:1] = ['--cookies', cookiefile]
+
+    count_spawn(cmd)
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+
+    if result.returncode != 0:
+        print("YT-DLP STDOUT:", result.stdout)
+        print("YT-DLP STDERR:", result.stderr)
+        if THROTTLE_RE.search(result.stderr):
+            raise Throttled(result.stderr[-500:])
+        raise Exception("Video not accessible")
+
+    return json.loads(result.stdout)
+
+
+def extract_info(url, flat=False):
+    """Extract the raw yt-dlp info dict for a URL using the configured engine
+
+    flat=True lists a playlist's entries without extracting each video.
+    Waits for the platform's request budget and runs under a cookie
+    identity; a throttled attempt is retried once under another identity.
+    Raises RateLimited when that is not possible.
+    """
+    platform = get_platform(url)
+
+    for attempt in range(2):
+        take_platform_token(platform, app.config['RATE_LIMIT_MAX_WAIT'])
+        identity = identity_pool.acquire(platform)
+        try:
+            info = _extract_with(url, flat, identity['path'])
+        except Throttled:
+            backoff = identity_pool.release(identity, throttled=True)
+            # Retry once as the next identity (or anonymously); anonymous throttling is final
+            if attempt or identity['path'] is None:
+                raise RateLimited(f"{platform} is throttling requests, retry later", backoff)
+            continue
+        except Exception:
+            identity_pool.release(identity)
+            raise
+        identity_pool.release(identity, succeeded=True)
+        return info
+
+
+def _extract_with(url, flat, cookiefile):
+    timeout = app.config['EXTRACT_TIMEOUT']
+
+    if app.config['EXTRACTOR_MODE'] == 'subprocess':
+        return _extract_subprocess(url, timeout, flat, cookiefile)
+
+    executor, busy = _claim_extractor()
+    if busy and _extract_fallback_slots.acquire(blocking=False):
+        # Every pool thread is taken; a bounded number of CLI runs take the overflow
+        _release_extractor(executor)
+        try:
+            return _extract_subprocess(url, timeout, flat, cookiefile)
+        finally:
+            _extract_fallback_slots.release()
+
+    started_at = []
+
+    def run():
+        started_at.append(time.monotonic())
+        return _extract_inprocess(url, flat, cookiefile)
+
+    future = executor.submit(run)
+    future.add_done_callback(lambda _: _release_extractor(executor))
+    # One timeout covers both waiting for a pool thread and extracting
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        if future.cancel():
+            raise ApiError('Every extractor is busy, try again shortly', 503)
+        # Unlike subprocess.run(timeout=...), nothing stops the call: the thread
+        # is lost until yt-dlp returns. Once it has run for a full timeout
+        # (it may have started late), later work gets a new pool
+        started = started_at[0] if started_at else time.monotonic()
+        watchdog = threading.Timer(max(started + timeout - time.monotonic(), 0),
+                                   retire_extract_executor, (executor, future))
+        watchdog.daemon = True
+        watchdog.start()
+        raise Exception(f"Extraction timed out after {timeout} seconds")
+
+
+def get_cached_info(url, platform):
+    """Return the raw info dict for a URL, extracting at most once per cache window"""
+    def load():
+        with STAGE_SECONDS.time(stage='extract'):
+            info = extract_info(url)
+        for key in INFO_DROP_KEYS:
+            info.pop(key, None)
+        return info
+
+    return info_cache.get_or_load(get_video_key(url, platform), load)
+
+
+def info_urls_expire_at(info):
+    """Earliest expiry (unix time) of the signed media URLs in an info dict, if known"""
+    expiries = []
+
+    for f in info.get('formats') or []:
+        media_url = f.get('url') or ''
+        parsed = urlparse(media_url)
+        query = parse_qs(parsed.query)
+
+        if query.get('expire'):                         # googlevideo
+            expiries.append(int(query['expire'][0]))
+        elif query.get('oe'):                           # Instagram CDN (hex)
+            expiries.append(int(query['oe'][0], 16))
+        else:
+            match = re.search(r'/expire/(\d+)', parsed.path)   # YouTube manifests
+            if match:
+                expiries.append(int(match.group(1)))
+
+    return min(expiries) if expiries else None
+
+
+def info_urls_fresh(info):
+    """Whether an info dict's signed media URLs stay valid for INFO_URL_EXPIRY_MARGIN more seconds"""
+    expires_at = info_urls_expire_at(info)
+    return not expires_at or expires_at >= time.time() + app.config['INFO_URL_EXPIRY_MARGIN']
+
+
+def get_reusable_info(video_key):
+    """Return a cached info dict that is still safe to download from, or None"""
+    if not app.config['REUSE_INFO_JSON'] or not video_key:
+        return None
+
+    info = info_cache.get(video_key)
+    if not info or not info_urls_fresh(info):
+        return None
+
+    return info
+
+
+INFO_TOKEN_RE = re.compile(r'^[0-9a-f]{32}$')
+
+# video key -> (token, info) last issued here, so a cached info dict is saved once
+info_tokens = OrderedDict()
+info_tokens_lock = threading.Lock()
+
+
+def info_token_path(token):
+    return os.path.join(app.config['INFO_TOKENS_DIR'], f"{token}.json")
+
+
+def issue_info_token(video_key, info):
+    """Save an info dict where any worker's download can load it; returns its token"""
+    with info_tokens_lock:
+        issued = info_tokens.get(video_key)
+    if issued and issued[1] is info and os.path.exists(info_token_path(issued[0])):
+        return issued[0]
+
+    token = uuid.uuid4().hex
+    path = info_token_path(token)
+    os.makedirs(app.config['INFO_TOKENS_DIR'], exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(info, _video_key=video_key), f)
+    os.replace(tmp_path, path)
+
+    with info_tokens_lock:
+        info_tokens[video_key] = (token, info)
+        info_tokens.move_to_end(video_key)
+        while len(info_tokens) > app.config['INFO_CACHE_MAX_ENTRIES']:
+            info_tokens.popitem(last=False)
+    return token
+
+
+def load_info_token(token):
+    """The info dict a token names while it is still safe to download from, or None
+
+    Its '_video_key' says which video it describes.
+    """
+    if not isinstance(token, str) or not INFO_TOKEN_RE.match(token):
+        return None
+    path = info_token_path(token)
+    try:
+        if os.path.getmtime(path) < time.time() - app.config['INFO_TOKEN_TTL']:
+            return None
+        with open(path) as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return info if info_urls_fresh(info) else None
+
+
+def prune_info_tokens():
+    """Delete saved info documents older than INFO_TOKEN_TTL"""
+    cutoff = time.time() - app.config['INFO_TOKEN_TTL']
+    try:
+        with os.scandir(app.config['INFO_TOKENS_DIR']) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+
+
+def summarize_info(info, url, platform, clip=None):
+    """Build the /api/video/info response from a raw yt-dlp info dict
+
+    With a clip, size estimates are scaled to the share of the video it covers.
+    """
+    # -----------------------------
+    # Duration
+    # -----------------------------
+    duration_seconds = int(info.get('duration') or 0)
+    clip = bound_clip(clip, info.get('duration'))
+    minutes = duration_seconds // 60
+    seconds = duration_seconds % 60
+    duration_formatted = f"{minutes}:{seconds:02d}"
+
+    # -----------------------------
+    # Views
+    # -----------------------------
+    view_count = int(info.get('view_count') or 0)
+
+    if view_count >= 1_000_000:
+        views_formatted = f"{view_count / 1_000_000:.1f}M views"
+    elif view_count >= 1_000:
+        views_formatted = f"{view_count / 1_000:.1f}K views"
+    else:
+        views_formatted = f"{view_count} views" if view_count else ""
+
+    # -----------------------------
+    # Thumbnail (fetched lazily from the info dict)
+    # -----------------------------
+    thumb_source = pick_thumbnail_url(info)
+
+    if thumb_source:
+        thumb_filename = register_thumbnail(get_video_key(url, platform), thumb_source)
+        thumbnail_url = f"/api/thumbnail/{thumb_filename}"
+        thumbnail_small_url = f"{thumbnail_url}?{THUMBNAIL_PREVIEW_QUERY}"
+    else:
+        thumbnail_url = ""
+        thumbnail_small_url = ""
+
+    # -----------------------------
+    # Get File Sizes from formats
+    # -----------------------------
+    all_formats = info.get('formats', [])
+    
+    # Find sizes for specific quality levels
+    size_1080p = None
+    size_720p = None
+    size_best = None
+    size_audio = None
+    
+    for f in all_formats:
+        height = f.get('height')
+        filesize = f.get('filesize') or f.get('filesize_approx')
+        vcodec = f.get('vcodec', 'none')
+        acodec = f.get('acodec', 'none')
+        
+        # Best quality (highest resolution video with audio)
+        if vcodec != 'none' and acodec != 'none' and filesize:
+            if not size_best or (height and height > (size_best.get('height') or 0)):
+                size_best = {'size': filesize, 'height': height}
+        
+        # 1080p
+        if height == 1080 and vcodec != 'none' and filesize:
+            if not size_1080p or (acodec != 'none'):  # Prefer with audio
+                size_1080p = filesize
+        
+        # 720p
+        if height == 720 and vcodec != 'none' and filesize:
+            if not size_720p or (acodec != 'none'):  # Prefer with audio
+                size_720p = filesize
+        
+        # Audio only
+        if vcodec == 'none' and acodec != 'none' and filesize:
+            if not size_audio or filesize > size_audio:  # Get best audio
+                size_audio = filesize
+
+    # -----------------------------
+    # Format Options with Sizes
+    # -----------------------------
+    if platform == "youtube":
+        formats = [
+            {
+                "quality": "Best Quality",
+                "format_id": "best",
+                "ext": "mp4",
+                "type": "video",
+                "has_audio": True,
+                "filesize": size_best['size'] if size_best else None,
+                "filesize_formatted": format_filesize(size_best['size']) if size_best else "Unknown"
+            },
+            {
+                "quality": "1080p",
+                "format_id": "best[height<=1080]",
+                "ext": "mp4",
+                "type": "video",
+                "has_audio": True,
+                "filesize": size_1080p,
+                "filesize_formatted": format_filesize(size_1080p) if size_1080p else "Unknown"
+            },
+            {
+                "quality": "720p",
+                "format_id": "best[height<=720]",
+                "ext": "mp4",
+                "type": "video",
+                "has_audio": True,
+                "filesize": size_720p,
+                "filesize_formatted": format_filesize(size_720p) if size_720p else "Unknown"
+            },
+            {
+                "quality": "Audio Only",
+                "format_id": "bestaudio",
+                "ext": "mp3",
+                "type": "audio",
+                "has_audio": True,
+                "filesize": size_audio,
+                "filesize_formatted": format_filesize(size_audio) if size_audio else "Unknown"
+            }
+        ]
+    else:
+        formats = [
+            {
+                "quality": "Best Quality",
+                "format_id": "best",
+                "ext": "mp4",
+                "type": "video",
+                "has_audio": True,
+                "filesize": size_best['size'] if size_best else None,
+                "filesize_formatted": format_filesize(size_best['size']) if size_best else "Unknown"
+            },
+            {
+                "quality": "Audio Only",
+                "format_id": "bestaudio",
+                "ext": "mp3",
+                "type": "audio",
+                "has_audio": True,
+                "filesize": size_audio,
+                "filesize_formatted": format_filesize(size_audio) if size_audio else "Unknown"
+            }
+        ]
+
+    if clip:
+        scale = clip_fraction(clip, info.get('duration'))
+        for f in formats:
+            if f['filesize']:
+                f['filesize'] = round(f['filesize'] * scale)
+                f['filesize_formatted'] = format_filesize(f['filesize'])
+
+    summary = {
+        "info_token": issue_info_token(get_video_key(url, platform), info),
+        "title": info.get("title", "Video"),
+        "thumbnail": thumbnail_url,
+        "thumbnail_small": thumbnail_small_url,
+        "duration": duration_formatted,
+        "views": views_formatted,
+        "uploader": info.get("uploader", ""),
+        "platform": platform,
+        "formats": formats,
+        "has_audio": True
+    }
+    if clip:
+        summary["clip"] = {
+            "start": clip['start'],
+            "end": clip['end'],
+            "duration": round(clip['end'] - clip['start'], 3)
+        }
+    return summary
+
+
+
+def get_video_info_universal(url, platform, clip=None):
+    try:
+        info = get_cached_info(url, platform)
+        return summarize_info(info, url, platform, clip)
+
+    except ApiError:
+        raise
+    except Exception as e:
+        FAILURES.inc(cause='extract')
+        raise Exception(str(e))
+
+
+# -----------------------------
+# Batch / playlist info
+# -----------------------------
+YOUTUBE_LIST_PREFIXES = ('playlist', 'channel', 'c', 'user')
+
+_batch_executor = ThreadPoolExecutor(
+    max_workers=app.config['BATCH_CONCURRENCY'],
+    thread_name_prefix='batch'
+)
+
+
+def is_playlist_url(url, platform):
+    """True for YouTube playlist and channel pages (watch?v=...&list=... is one video)"""
+    if platform != "youtube":
+        return False
+
+    parsed = urlparse(url if '://' in url else 'https://' + url)
+    parts = [p for p in parsed.path.split('/') if p]
+    query = parse_qs(parsed.query)
+
+    if query.get('v'):
+        return False
+    if query.get('list'):
+        return True
+    return bool(parts) and (parts[0] in YOUTUBE_LIST_PREFIXES or parts[0].startswith('@'))
+
+
+def expand_playlist(url, limit):
+    """Return (title, [(video url, video title)]) for a playlist or channel page"""
+    parsed = urlparse(url if '://' in url else 'https://' + url)
+    parts = [p for p in parsed.path.split('/') if p]
+
+    # A bare channel URL (/@handle, /channel/<id>, /c/<name>, /user/<name>)
+    # lists its tabs; ask for the uploads tab instead, keeping the query
+    if (len(parts) == 1 and parts[0].startswith('@')) or (len(parts) == 2 and parts[0] in ('channel', 'c', 'user')):
+        url = urlunparse(parsed._replace(path='/' + '/'.join(parts + ['videos'])))
+
+    listing = extract_info(url, flat=True)
+    urls = []
+
+    for entry in listing.get('entries') or []:
+        if len(urls) >= limit:
+            break
+        entry_url = entry.get('url') or entry.get('webpage_url')
+        if not entry_url and entry.get('id'):
+            entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+        if entry_url:
+            urls.append((entry_url, entry.get('title') or ''))
+
+    return listing.get('title', ''), urls
+
+
+def _batch_item(url):
+    platform = get_platform(url)
+    if not platform:
+        raise Exception('Only YouTube or Instagram URLs supported')
+    return get_video_info_universal(url, platform)
+
+
+# -----------------------------
+# Thumbnails
+# -----------------------------
+THUMBNAIL_SOURCES_MAX = 4096
+THUMBNAIL_CACHE_CONTROL = f"public, max-age={app.config['THUMBNAIL_MAX_AGE']}, immutable"
+THUMBNAIL_MIME_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'webp': 'image/webp',
+    'png': 'image/png',
+}
+
+# What the info response links as the small preview (the UI shows 320px)
+THUMBNAIL_PREVIEW_QUERY = "size=320&format=webp"
+
+# ffmpeg output options per variant extension
+THUMBNAIL_ENCODERS = {
+    'webp': ["-c:v", "libwebp", "-quality", "80", "-f", "webp"],
+    'jpg': ["-c:v", "mjpeg", "-q:v", "4", "-f", "mjpeg"],
+}
+THUMBNAIL_FORMATS = {'webp': 'webp', 'jpeg': 'jpg', 'jpg': 'jpg'}   # ?format= -> extension
+
+thumbnail_sources = OrderedDict()   # thumbnail filename -> remote image URL (recently used)
+thumbnail_lock = threading.Lock()
+_thumbnail_fetches = {}             # thumbnail/variant filename -> lock held while fetching or rendering
+
+
+class ThumbnailCache:
+    """Bounded LRU of thumbnail bytes, so hot images are served without disk reads"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # filename -> image dict, least recently used first
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename):
+        with self._lock:
+            image = self._entries.get(filename)
+            if image is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(filename)
+            self.hits += 1
+            return image
+
+    def put(self, filename, image):
+        size = len(image['body'])
+        # A few oversized originals must not flush every small variant
+        if size > self.max_bytes // 16:
+            return
+
+        with self._lock:
+            old = self._entries.pop(filename, None)
+            if old:
+                self.total_bytes -= len(old['body'])
+            self._entries[filename] = image
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= len(evicted['body'])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'images': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+thumbnail_cache = ThumbnailCache(app.config['THUMBNAIL_CACHE_BYTES'])
+_thumbnail_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='thumbnail')
+
+
+def pick_thumbnail_url(info):
+    """Pick the best thumbnail URL from an info dict, preferring JPEG"""
+    thumbnails = info.get('thumbnails') or []
+
+    # yt-dlp sorts thumbnails worst -> best
+    for thumb in reversed(thumbnails):
+        thumb_url = thumb.get('url') or ''
+        if urlparse(thumb_url).path.lower().endswith(('.jpg', '.jpeg')):
+            return thumb_url
+
+    return info.get('thumbnail') or None
+
+
+def thumbnail_filename(video_key, source_url):
+    """Deterministic local filename for a video's thumbnail"""
+    ext = os.path.splitext(urlparse(source_url).path)[1].lower().lstrip('.')
+    if ext not in THUMBNAIL_MIME_TYPES:
+        ext = 'jpg'
+
+    safe_key = re.sub(r'[^A-Za-z0-9_-]', '_', video_key)
+    if len(safe_key) > 64:
+        safe_key = hashlib.sha1(video_key.encode()).hexdigest()
+    return f"thumb_{safe_key}.{ext}"
+
+
+def _remember_thumbnail_source(filename, source_url):
+    with thumbnail_lock:
+        thumbnail_sources[filename] = source_url
+        thumbnail_sources.move_to_end(filename)
+        while len(thumbnail_sources) > THUMBNAIL_SOURCES_MAX:
+            thumbnail_sources.popitem(last=False)
+
+
+def _thumbnail_source_path(filename):
+    return os.path.join(app.config['THUMBNAIL_SOURCES_DIR'], f"{filename}.url")
+
+
+def save_thumbnail_source(filename, source_url):
+    """Record a thumbnail's remote URL where every worker can read it"""
+    path = _thumbnail_source_path(filename)
+    try:
+        with open(path) as f:
+            if f.read() == source_url:
+                os.utime(path)
+                return
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(app.config['THUMBNAIL_SOURCES_DIR'], exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(source_url)
+    os.replace(tmp_path, path)
+
+
+def get_thumbnail_source(filename):
+    """Remote URL of a registered thumbnail (by this or another worker), or None"""
+    with thumbnail_lock:
+        source_url = thumbnail_sources.get(filename)
+    if source_url:
+        return source_url
+
+    try:
+        with open(_thumbnail_source_path(filename)) as f:
+            source_url = f.read()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    _remember_thumbnail_source(filename, source_url)
+    return source_url
+
+
+def prune_thumbnail_sources():
+    """Forget thumbnail sources nobody has registered for THUMBNAIL_TTL"""
+    cutoff = time.time() - app.config['THUMBNAIL_TTL']
+    try:
+        with os.scandir(app.config['THUMBNAIL_SOURCES_DIR']) as entries:
+            for entry in entries:
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+    except FileNotFoundError:
+        pass
+
+
+def register_thumbnail(video_key, source_url):
+    """Remember where a thumbnail comes from and warm it in the background"""
+    filename = thumbnail_filename(video_key, source_url)
+
+    _remember_thumbnail_source(filename, source_url)
+    save_thumbnail_source(filename, source_url)
+
+    if not os.path.exists(os.path.join(app.config['DOWNLOAD_FOLDER'], filename)):
+        _thumbnail_executor.submit(download_thumbnail, filename)
+
+    return filename
+
+
+def resolve_thumbnail(filename):
+    """Local path of a thumbnail, fetching it on first access; None if unknown"""
+    if os.path.basename(filename) != filename:
+        return None
+
+    filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
+
+    if os.path.exists(filepath):
+        file_index.touch(filepath)
+        return filepath
+
+    return download_thumbnail(filename)
+
+
+def download_thumbnail(filename):
+    """Fetch a registered thumbnail into the downloads folder; returns its path or None"""
+    filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
+
+    source_url = get_thumbnail_source(filename)
+    if not source_url:
+        return None
+
+    with thumbnail_lock:
+        fetch_lock = _thumbnail_fetches.setdefault(filename, threading.Lock())
+
+    tmp_path = None
+    try:
+        # Only one thread fetches a given thumbnail; the rest reuse its file
+        with fetch_lock:
+            if os.path.exists(filepath):
+                return filepath
+
+            tmp_path = f"{filepath}.{uuid.uuid4().hex[:8]}.tmp"
+            req = urllib.request.Request(source_url, headers={'User-Agent': 'Mozilla/5.0'})
+
+            with STAGE_SECONDS.time(stage='thumbnail_fetch'), \
+                    urllib.request.urlopen(req, timeout=15) as resp, open(tmp_path, 'wb') as out:
+                while True:
+                    chunk = resp.read(64 * 1024)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+
+            os.replace(tmp_path, filepath)
+            file_index.add(filepath, app.config['THUMBNAIL_TTL'])
+            return filepath
+
+    except Exception as e:
+        print("Thumbnail download error:", str(e))
+        FAILURES.inc(cause='thumbnail')
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+    finally:
+        with thumbnail_lock:
+            _thumbnail_fetches.pop(filename, None)
+
+
+def thumbnail_variant_name(filename, size=None, fmt=None):
+    """Filename of the variant a ?size=&format= request maps to (filename itself if none)
+
+    Widths snap up to THUMBNAIL_SIZES so arbitrary values cannot fill the
+    disk with near-duplicates. Raises ApiError on invalid parameters.
+    """
+    if not size and not fmt:
+        return filename
+
+    base, ext = os.path.splitext(filename)
+    ext = ext.lower().lstrip('.')
+    if fmt:
+        ext = THUMBNAIL_FORMATS.get(fmt.lower())
+        if ext is None:
+            raise ApiError(f"format must be one of: {', '.join(THUMBNAIL_FORMATS)}", 400)
+    elif ext not in THUMBNAIL_ENCODERS:
+        ext = 'jpg'
+
+    sizes = app.config['THUMBNAIL_SIZES']
+    width = sizes[-1]
+    if size:
+        try:
+            requested = int(size)
+        except ValueError:
+            raise ApiError("size must be a width in pixels", 400)
+        if requested <= 0:
+            raise ApiError("size must be a width in pixels", 400)
+        width = next((s for s in sizes if s >= requested), sizes[-1])
+
+    return f"{base}.w{width}.{ext}"
+
+
+def render_thumbnail_variant(source, variant):
+    """Scale and re-encode a thumbnail into the downloads folder; returns its path or None"""
+    filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], variant)
+    width = int(variant.rsplit('.', 2)[1][1:])
+    ext = variant.rsplit('.', 1)[1]
+
+    with thumbnail_lock:
+        render_lock = _thumbnail_fetches.setdefault(variant, threading.Lock())
+
+    tmp_path = None
+    try:
+        # Only one thread renders a given variant; the rest reuse its file
+        with render_lock:
+            if os.path.exists(filepath):
+                return filepath
+
+            tmp_path = f"{filepath}.{uuid.uuid4().hex[:8]}.tmp"
+            cmd = [
+                FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-y", "-i", source,
+                # Never upscale; keep the height even for the encoders
+                "-vf", f"scale='min({width},iw)':-2",
+                "-frames:v", "1", "-threads", "1",
+                *THUMBNAIL_ENCODERS[ext], tmp_path
+            ]
+
+            with STAGE_SECONDS.time(stage='thumbnail_resize'):
+                process = spawn_process(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+                # Safe to fire until reap_process: the leader is not reaped before
+                timer = threading.Timer(30, kill_process_group, (process.pid,))
+                timer.start()
+                finished = False
+                try:
+                    stderr = process.stderr.read()
+                    finished = True
+                finally:
+                    timer.cancel()
+                    reap_process(process, kill=not finished)
+                    process.stderr.close()
+
+            if process.returncode != 0 or not os.path.exists(tmp_path):
+                raise Exception(f"ffmpeg failed: {stderr[-300:]}")
+
+            os.replace(tmp_path, filepath)
+            file_index.add(filepath, app.config['THUMBNAIL_TTL'])
+            return filepath
+
+    except Exception as e:
+        print("Thumbnail resize error:", str(e))
+        FAILURES.inc(cause='thumbnail_resize')
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+
+    finally:
+        with thumbnail_lock:
+            _thumbnail_fetches.pop(variant, None)
+
+
+def cached_thumbnail(variant):
+    """A thumbnail image dict from the in-memory cache, or None"""
+    image = thumbnail_cache.get(variant)
+    if image:
+        # Keep the file's janitor entry as warm as the cached copy
+        file_index.touch(os.path.join(app.config['DOWNLOAD_FOLDER'], variant))
+    return image
+
+
+def load_thumbnail(filename, variant=None):
+    """A thumbnail or one of its variants as an image dict; None if unknown
+
+    The dict holds the body plus the ETag/Last-Modified validators
+    send_media_file would use for the same file. The original is fetched
+    and the variant rendered on first use; hot images stay in memory.
+    """
+    variant = variant or filename
+    image = cached_thumbnail(variant)
+    if image:
+        return image
+
+    if os.path.basename(filename) != filename:
+        return None
+
+    filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], variant)
+    if os.path.exists(filepath):
+        file_index.touch(filepath)
+    elif variant == filename:
+        filepath = download_thumbnail(filename)
+    else:
+        source = resolve_thumbnail(filename)
+        filepath = source and render_thumbnail_variant(source, variant)
+    if not filepath:
+        return None
+
+    try:
+        with open(filepath, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            body = f.read()
+    except FileNotFoundError:
+        # Evicted by the janitor in the meantime
+        return None
+
+    mtime = int(stat.st_mtime)
+    image = {
+        'body': body,
+        'etag': f"{mtime:x}-{len(body):x}",
+        'mtime': mtime,
+        'mimetype': THUMBNAIL_MIME_TYPES.get(os.path.splitext(variant)[1].lower().lstrip('.'), 'image/jpeg')
+    }
+    thumbnail_cache.put(variant, image)
+    return image
+
+
+def thumbnail_headers(image):
+    return {
+        'ETag': f'"{image["etag"]}"',
+        'Last-Modified': http_date(image['mtime']),
+        'Cache-Control': THUMBNAIL_CACHE_CONTROL
+    }
+
+
+# -----------------------------
+# Time-range clips
+# -----------------------------
+TIMESTAMP_RE = re.compile(r'^(?:(\d+):)?(?:(\d+):)?(\d+(?:\.\d+)?)$')
+
+
+def parse_timestamp(value):
+    """Seconds from a number or an [[HH:]MM:]SS(.fff) string; None if malformed
+
+    Only the leading component may run past 59 ("90:00" is an hour and a half).
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        # JSON bodies can carry NaN and Infinity
+        return float(value) if math.isfinite(value) else None
+
+    match = TIMESTAMP_RE.match(str(value).strip())
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    if minutes is None and hours is not None:
+        # "MM:SS" lands in the first group
+        hours, minutes = None, hours
+    if hours is not None and int(minutes) >= 60:
+        return None
+    if minutes is not None and float(seconds) >= 60:
+        return None
+    return int(hours or 0) * 3600 + int(minutes or 0) * 60 + float(seconds)
+
+
+FLAG_VALUES = {'true': True, '1': True, 'yes': True, 'false': False, '0': False, 'no': False, '': False}
+
+
+def parse_flag(value, name):
+    """A boolean request field sent as a JSON boolean, 0/1 or a string; raises ApiError"""
+    if value is None or isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in FLAG_VALUES:
+        return FLAG_VALUES[value.strip().lower()]
+    raise ApiError(f"{name} must be true or false", 400)
+
+
+def parse_clip(data):
+    """The {'start', 'end', 'accurate'} range a request asks for, or None for the whole video
+
+    Raises ApiError for malformed or empty ranges.
+    """
+    start_value, end_value = data.get('start'), data.get('end')
+    if start_value in (None, '') and end_value in (None, ''):
+        return None
+    if end_value in (None, ''):
+        raise ApiError("end is required for a clip", 400)
+
+    start = parse_timestamp(start_value) if start_value not in (None, '') else 0.0
+    end = parse_timestamp(end_value)
+    if start is None or end is None or start < 0:
+        raise ApiError("start and end must be seconds or HH:MM:SS timestamps", 400)
+    if end <= start:
+        raise ApiError("end must be after start", 400)
+
+    return {
+        'start': start,
+        'end': end,
+        # Keyframe cuts are stream copies; accurate cuts re-encode around the edges
+        'accurate': parse_flag(data.get('accurate_cut'), 'accurate_cut')
+    }
+
+
+def bound_clip(clip, duration):
+    """Clamp a clip to a known video duration; raises ApiError if it starts past the end"""
+    if not clip or not duration:
+        return clip
+    if clip['start'] >= duration:
+        raise ApiError(f"start is past the end of the video ({duration:g}s)", 400)
+    return dict(clip, end=min(clip['end'], float(duration)))
+
+
+def format_clip_time(seconds):
+    return f"{seconds:.3f}".rstrip('0').rstrip('.')
+
+
+def clip_fraction(clip, duration):
+    """Share of the video a clip covers (for size estimates); 1.0 if unknown"""
+    if not clip or not duration:
+        return 1.0
+    return min((clip['end'] - clip['start']) / duration, 1.0)
+
+
+# -----------------------------
+# Download artifact cache
+# -----------------------------
+# What each download type asks yt-dlp for; part of the artifact identity
+VIDEO_FORMAT = "bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]"
+VIDEO_POSTPROCESS = "merge:mp4"
+
+# Audio outputs a client can ask for. A source track whose container is in
+# 'copy_from' is stream-copied (remux, near-zero CPU); anything else is
+# re-encoded with 'codec' on the transcode pool.
+AUDIO_PROFILES = {
+    'mp3': {
+        'format': 'bestaudio',
+        'postprocess': 'mp3:192K',
+        'muxer': 'mp3',
+        'codec': ['-c:a', 'libmp3lame', '-b:a', '192k'],
+        'copy_from': (),
+    },
+    'm4a': {
+        'format': 'bestaudio[ext=m4a]/bestaudio',
+        'postprocess': 'm4a:copy',
+        'muxer': 'ipod',
+        'codec': ['-c:a', 'aac', '-b:a', '192k'],
+        'copy_from': ('mp4',),
+    },
+    'opus': {
+        'format': 'bestaudio[acodec=opus]/bestaudio',
+        'postprocess': 'opus:copy',
+        'muxer': 'opus',
+        'codec': ['-c:a', 'libopus', '-b:a', '160k'],
+        'copy_from': ('webm', 'ogg'),
+    },
+}
+
+artifacts = OrderedDict()   # artifact key -> artifact dict, least recently used first
+artifact_lock = threading.RLock()
+
+
+def get_artifact_key(video_key, is_audio, audio_format='mp3', clip=None):
+    """Identity of a finished download: (video, format selector, type, transcode, range)"""
+    if is_audio:
+        profile = AUDIO_PROFILES[audio_format]
+        key = f"{video_key}|{profile['format']}|audio|{profile['postprocess']}"
+    else:
+        key = f"{video_key}|{VIDEO_FORMAT}|video|{VIDEO_POSTPROCESS}"
+
+    if clip:
+        key += f"|clip:{format_clip_time(clip['start'])}-{format_clip_time(clip['end'])}"
+        if clip['accurate']:
+            key += ":accurate"
+    return key
+
+
+# What a task attaching to an existing artifact copies from it
+ARTIFACT_TASK_FIELDS = ('status', 'progress', 'file_path', 'file_ext', 'remote_key')
+
+
+def artifact_base_name(key):
+    return f"media_{hashlib.sha1(key.encode()).hexdigest()[:20]}"
+
+
+def claim_artifact(key, task_id, speculative=False):
+    """Attach a task to an artifact; returns (artifact, True) if the caller must download it
+
+    A speculative claim (task_id None) attaches nothing and only creates the
+    artifact if it does not exist yet.
+    """
+    with artifact_lock:
+        artifact = artifacts.get(key)
+
+        if artifact and artifact['status'] == 'completed' and not os.path.exists(artifact['file_path']):
+            # Removed behind our back; download it again
+            del artifacts[key]
+            artifact = None
+
+        if artifact and speculative:
+            return artifact, False
+
+        if artifact:
+            if artifact.get('speculative'):
+                adopt_speculative(artifact)
+            artifact['task_ids'].append(task_id)
+            artifact['last_access'] = time.time()
+            artifacts.move_to_end(key)
+            if artifact['status'] == 'completed':
+                file_index.touch(artifact['file_path'])
+            return artifact, False
+
+        artifact = {
+            'key': key,
+            'output_path': os.path.join(app.config['DOWNLOAD_FOLDER'], artifact_base_name(key)),
+            'status': 'pending',
+            'progress': 0,
+            'task_ids': [task_id] if task_id else [],
+            'speculative': speculative,
+            'last_access': time.time()
+        }
+        artifacts[key] = artifact
+        return artifact, True
+
+
+def update_artifact(artifact, **fields):
+    """Update an artifact and every task attached to it, waking progress subscribers"""
+    fields['updated_at'] = time.time()
+    with artifact_lock:
+        artifact.update(fields)
+        for task_id in artifact['task_ids']:
+            task_store.update(task_id, **fields)
+
+    with progress_cond:
+        progress_cond.notify_all()
+    for listener in progress_listeners:
+        listener()
+
+
+def complete_artifact(artifact, file_path):
+    update_artifact(
+        artifact,
+        status='completed',
+        progress=100,
+        phase='done',
+        speed=None,
+        eta=None,
+        file_path=file_path,
+        file_ext=os.path.splitext(file_path)[1].lstrip("."),
+        file_size=os.path.getsize(file_path)
+    )
+    # The janitor owns deletion from here on; forget the artifact when it goes
+    file_index.add(file_path, app.config['ARTIFACT_TTL'], on_evict=lambda: drop_artifact(artifact))
+    download_journal.record(artifact)
+    delivery.publish(artifact)
+
+
+def drop_artifact(artifact):
+    with artifact_lock:
+        if artifacts.get(artifact['key']) is artifact:
+            del artifacts[artifact['key']]
+        wasted = artifact.pop('speculative', False)
+    download_journal.forget(artifact['key'])
+
+    if wasted:
+        SPECULATIONS.inc(outcome='wasted')
+        SPECULATIVE_WASTED_BYTES.inc(artifact.get('file_size') or artifact.get('downloaded_bytes') or 0)
+
+
+def fail_artifact(artifact, error, cause='download'):
+    FAILURES.inc(cause=cause)
+    update_artifact(artifact, status='failed', error=error)
+    # Forget it so the next request retries from scratch
+    drop_artifact(artifact)
+
+
+def detach_artifact_task(key, task_id):
+    with artifact_lock:
+        artifact = artifacts.get(key)
+        if not artifact or task_id not in artifact['task_ids']:
+            return
+        artifact['task_ids'].remove(task_id)
+    download_journal.record(artifact)
+
+
+# -----------------------------
+# Download scheduler
+# -----------------------------
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+# Used for start-time estimates until real downloads have been timed
+DEFAULT_DOWNLOAD_SECONDS = 30
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class DownloadScheduler:
+    """Bounded pool of download slots with per-platform limits and a priority queue
+
+    admit(job, waiting), if given, is asked before a job takes a slot, with
+    the number of other jobs still queued: it returns 0 to let the job
+    start, the seconds until it may, or None to wait for a running job to
+    finish. A job that may not start yet stays queued and jobs for other
+    platforms go ahead of it.
+    """
+
+    def __init__(self, slots, platform_limits, max_queued, admit=None):
+        self.slots = slots
+        self.platform_limits = platform_limits
+        self.max_queued = max_queued
+        self.admit = admit
+        self._queue = []                # sorted [(priority, seq, job)]
+        self._running = {}              # platform -> running job count
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._durations = deque(maxlen=50)
+        self._workers = []
+        self.completed = 0
+        self.rejected = 0
+
+    def _start_workers(self):
+        # Caller must hold self._cond
+        while len(self._workers) < self.slots:
+            worker = threading.Thread(target=self._work, daemon=True,
+                                      name=f"download-worker-{len(self._workers)}")
+            self._workers.append(worker)
+            worker.start()
+
+    def submit(self, job_id, platform, fn, args=(), priority=PRIORITY_NORMAL):
+        """Queue fn(*args); raises SchedulerFull when the queue is at capacity"""
+        with self._cond:
+            if len(self._queue) >= self.max_queued:
+                self.rejected += 1
+                raise SchedulerFull("Download queue is full, try again later")
+
+            job = {
+                'id': job_id,
+                'platform': platform,
+                'fn': fn,
+                'args': args,
+                'queued_at': time.time()
+            }
+            bisect.insort(self._queue, (priority, next(self._seq), job))
+            self._start_workers()
+            self._cond.notify_all()
+
+    def cancel(self, job_id):
+        """Remove a job that has not started yet; True if it was queued"""
+        with self._cond:
+            for i, (_, _, job) in enumerate(self._queue):
+                if job['id'] == job_id:
+                    del self._queue[i]
+                    return True
+        return False
+
+    def promote(self, job_id, priority):
+        """Move a queued job up to `priority` (never down)"""
+        with self._cond:
+            for i, (current, seq, job) in enumerate(self._queue):
+                if job['id'] == job_id and priority < current:
+                    del self._queue[i]
+                    bisect.insort(self._queue, (priority, seq, job))
+                    self._cond.notify_all()
+                    return
+
+    def has_room(self, platform):
+        """True if a job submitted now for `platform` would start without waiting"""
+        with self._cond:
+            queued_for_platform = sum(1 for _, _, job in self._queue if job['platform'] == platform)
+            limit = self.platform_limits.get(platform, self.slots)
+            return (sum(self._running.values()) + len(self._queue) < self.slots
+                    and self._running.get(platform, 0) + queued_for_platform < limit)
+
+    def _has_capacity(self, platform):
+        limit = self.platform_limits.get(platform, self.slots)
+        return self._running.get(platform, 0) < limit
+
+    def _next_job(self):
+        # Caller must hold self._cond; first job in order whose platform has room
+        # and admits it. Returns (job, None) or (None, seconds to wait; None = until notified)
+        wait = None
+        held = set()
+        for i, (_, _, job) in enumerate(self._queue):
+            platform = job['platform']
+            if platform in held or not self._has_capacity(platform):
+                continue
+            delay = self.admit(job, len(self._queue) - 1) if self.admit else 0
+            if delay == 0:
+                return self._queue.pop(i)[2], None
+            held.add(platform)
+            if delay is not None:
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job, wait = self._next_job()
+                while job is None:
+                    self._cond.wait(wait)
+                    job, wait = self._next_job()
+                platform = job['platform']
+                self._running[platform] = self._running.get(platform, 0) + 1
+
+            started = time.time()
+            STAGE_SECONDS.observe(started - job['queued_at'], stage='queue_wait')
+            try:
+                job['fn'](*job['args'])
+            except Exception as e:
+                print(f"Scheduler job error: {str(e)}")
+            finally:
+                with self._cond:
+                    self._running[platform] -= 1
+                    self._durations.append(time.time() - started)
+                    self.completed += 1
+                    self._cond.notify_all()
+
+    def average_duration(self):
+        with self._cond:
+            if not self._durations:
+                return DEFAULT_DOWNLOAD_SECONDS
+            return sum(self._durations) / len(self._durations)
+
+    def position(self, job_id):
+        """Return (1-based queue position, estimated seconds until start) or None"""
+        avg = self.average_duration()
+
+        with self._cond:
+            queued = [job for _, _, job in self._queue]
+            index = next((i for i, job in enumerate(queued) if job['id'] == job_id), None)
+            if index is None:
+                return None
+
+            platform = queued[index]['platform']
+            ahead = sum(1 for job in queued[:index] if job['platform'] == platform)
+            limit = min(self.platform_limits.get(platform, self.slots), self.slots)
+
+        # Jobs ahead of us on the same platform start `limit` at a time, each
+        # batch after the currently running one finishes
+        rounds = ahead // max(limit, 1) + 1
+        return index + 1, round(avg * rounds)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'slots': self.slots,
+                'running': sum(self._running.values()),
+                'running_by_platform': dict(self._running),
+                'queued': len(self._queue),
+                'max_queued': self.max_queued,
+                'completed': self.completed,
+                'rejected': self.rejected
+            }
+
+
+def admit_download(job, waiting):
+    """Scheduler admission: bandwidth first, then the platform's request budget"""
+    if not bandwidth_budget.can_start():
+        return None
+    delay = try_platform_token(job['platform'])
+    if delay:
+        return delay
+    # Leased here so two jobs admitted back to back cannot both count the same free budget
+    bandwidth_budget.lease(job['id'], waiting)
+    return 0
+
+
+download_scheduler = DownloadScheduler(
+    app.config['MAX_CONCURRENT_DOWNLOADS'],
+    app.config['PLATFORM_CONCURRENCY'],
+    app.config['MAX_QUEUED_DOWNLOADS'],
+    # Rate-limited jobs wait in the queue, not in a slot
+    admit=admit_download
+)
+
+
+class BandwidthBudget:
+    """Splits a node-wide download rate across the downloads running on it
+
+    yt-dlp reads --limit-rate once at startup and cannot be given more or
+    less later, so a download's share is fixed when it starts. It leases
+    the budget that is free at that moment, less budget / slots kept back
+    for each queued download that could start right after it (at least one
+    while slots are free), and never less than budget / slots. A download
+    only starts once that minimum is free, so the leases never add up to
+    more than the budget, and one running alone is not held to 1 / slots.
+    """
+
+    def __init__(self, budget, slots):
+        self.budget = budget
+        self.slots = slots
+        self.minimum = max(budget // max(slots, 1), 1)
+        self._leases = {}               # job id -> bytes/s
+        self._lock = threading.Lock()
+        self._throughputs = deque(maxlen=50)
+
+    def _free(self):
+        # Caller must hold self._lock
+        return self.budget - sum(self._leases.values())
+
+    def can_start(self):
+        if not self.budget:
+            return True
+        with self._lock:
+            return self._free() >= self.minimum
+
+    def lease(self, job_id, waiting=0):
+        """Reserve a rate (bytes/s) for a starting download; None when unlimited"""
+        if not self.budget:
+            return None
+        with self._lock:
+            idle = self.slots - len(self._leases) - 1
+            upcoming = min(waiting, idle)
+            if idle > 0:
+                upcoming = max(upcoming, 1)
+            free = self._free()
+            rate = max(free - upcoming * self.minimum, min(self.minimum, free), 1)
+            self._leases[job_id] = rate
+            return rate
+
+    def leased(self, job_id):
+        with self._lock:
+            return self._leases.get(job_id)
+
+    def release(self, job_id):
+        with self._lock:
+            self._leases.pop(job_id, None)
+
+    def record(self, throughput):
+        with self._lock:
+            self._throughputs.append(throughput)
+
+    def stats(self):
+        with self._lock:
+            recent = list(self._throughputs)
+            return {
+                'budget': self.budget or None,
+                'allocated': sum(self._leases.values()),
+                'active_leases': len(self._leases),
+                'concurrent_fragments': app.config['CONCURRENT_FRAGMENTS'],
+                'avg_throughput': round(sum(recent) / len(recent)) if recent else None
+            }
+
+
+bandwidth_budget = BandwidthBudget(app.config['BANDWIDTH_BUDGET'], app.config['MAX_CONCURRENT_DOWNLOADS'])
+
+
+# -----------------------------
+# Download progress
+# -----------------------------
+# yt-dlp prints one JSON object per progress callback with these templates;
+# the codecs tell us whether a separate audio track will follow
+PROGRESS_TEMPLATE_ARGS = [
+    "--newline",
+    "--progress-template",
+    'download:[progress] {"progress": %(progress)j, "vcodec": %(info.vcodec)j, "acodec": %(info.acodec)j}',
+    "--progress-template", "postprocess:[postprocess] %(progress)j",
+]
+
+POSTPROCESSOR_PHASES = {
+    'Merger': 'merging',
+    'FFmpegMerger': 'merging',
+    'ExtractAudio': 'transcoding',
+    'FFmpegExtractAudio': 'transcoding',
+    'VideoConvertor': 'transcoding',
+    'FFmpegVideoConvertor': 'transcoding',
+}
+
+PROGRESS_FIELDS = ('progress', 'phase', 'downloaded_bytes', 'total_bytes', 'speed', 'eta')
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Notified on every published progress change; subscribers re-read the store
+progress_cond = threading.Condition()
+# Extra no-argument callbacks run on every change (the ASGI front end's wakeup)
+progress_listeners = []
+
+
+def set_artifact_stop(artifact, stop):
+    """Register how to kill an artifact's running process; runs it at once if already cancelled"""
+    with artifact_lock:
+        artifact['stop'] = stop
+        cancelled = artifact.get('cancelled')
+    if stop and cancelled:
+        stop()
+
+
+class ProgressTracker:
+    """Turns yt-dlp's JSON progress lines into throttled task updates"""
+
+    def __init__(self, artifact):
+        self.artifact = artifact
+        self.files = {}             # filename -> (downloaded, total)
+        self.parts = 1
+        self.state = {'phase': 'downloading'}
+        self.last_publish = 0.0
+        self.postprocess_started = None
+        self.throttled = False
+
+    def set_stop(self, stop):
+        """Register how to kill the running process (None once it exited)"""
+        set_artifact_stop(self.artifact, stop)
+
+    def feed_line(self, line):
+        line = line.strip()
+        if not line.startswith("[") and THROTTLE_RE.search(line):
+            self.throttled = True
+        try:
+            self.feed(line)
+        except ValueError:
+            print(f"Unparseable progress line: {line[:200]}")
+
+    def feed(self, line):
+        if line.startswith("[progress] "):
+            self._on_download(json.loads(line[len("[progress] "):]))
+        elif line.startswith("[postprocess] "):
+            self._on_postprocess(json.loads(line[len("[postprocess] "):]))
+
+    def _on_download(self, event):
+        p = event.get('progress') or {}
+        total = p.get('total_bytes') or p.get('total_bytes_estimate')
+        downloaded = p.get('downloaded_bytes') or 0
+        if p.get('status') == 'finished' and not total:
+            total = downloaded
+
+        # A video-only track means an audio track is downloaded after it
+        if event.get('acodec') == 'none' and event.get('vcodec') not in (None, 'none'):
+            self.parts = 2
+
+        # Video and audio are separate files; report them as one transfer
+        self.files[p.get('filename') or p.get('tmpfilename')] = (downloaded, total or 0)
+        done = sum(d for d, _ in self.files.values())
+        known_total = sum(t for _, t in self.files.values())
+        fractions = [min(d / t, 1.0) if t else 0.0 for d, t in self.files.values()]
+
+        update = {
+            'phase': 'downloading',
+            'downloaded_bytes': done,
+            'total_bytes': known_total or None,
+            'speed': p.get('speed'),
+            'eta': p.get('eta'),
+            # Each track counts equally; leave headroom for post-processing
+            'progress': round(sum(fractions) / max(self.parts, len(self.files)) * 95, 1),
+        }
+
+        self._publish(update, force=p.get('status') == 'finished')
+
+    def _on_postprocess(self, p):
+        phase = POSTPROCESSOR_PHASES.get(p.get('postprocessor'), 'postprocessing')
+        if self.postprocess_started is None:
+            self.postprocess_started = time.perf_counter()
+        if p.get('status') == 'finished':
+            return
+        self._publish({'phase': phase, 'progress': 95, 'speed': None, 'eta': None})
+
+    def _publish(self, update, force=False):
+        now = time.time()
+        phase_changed = update.get('phase') != self.state.get('phase')
+        self.state.update(update)
+
+        if not (force or phase_changed or now - self.last_publish >= app.config['PROGRESS_MIN_INTERVAL']):
+            return
+
+        self.last_publish = now
+        update_artifact(self.artifact, **{k: self.state.get(k) for k in PROGRESS_FIELDS if k in self.state})
+
+
+# Set by the ASGI entry point to fn(cmd, tracker) -> exit code, which runs
+# the process on its event loop; None means a blocking pipe read here
+download_supervisor = None
+
+
+def _supervise_blocking(cmd, tracker):
+    process = spawn_process(
+        cmd,
+        prefix=tracker.artifact['output_path'],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        bufsize=1
+    )
+    tracker.set_stop(lambda: kill_process_group(process.pid))
+
+    finished = False
+    try:
+        for line in process.stdout:
+            tracker.feed_line(line)
+        finished = True
+    finally:
+        tracker.set_stop(None)
+        # Cut short by an exception: stop it rather than wait for it
+        reap_process(process, kill=not finished)
+        process.stdout.close()
+    return process.returncode
+
+
+def _run_ytdlp(cmd, artifact):
+    """Run a yt-dlp download command, tracking progress
+
+    Returns (exit code, whether the output showed the platform throttling us).
+    """
+    cmd = cmd[:1] + PROGRESS_TEMPLATE_ARGS + cmd[1:]
+
+    print("\nStarting download:")
+    print(" ".join(cmd[:10]), "...")
+
+    if artifact.get('cancelled'):
+        return -1, False
+
+    started = time.perf_counter()
+    tracker = ProgressTracker(artifact)
+
+    if download_supervisor:
+        returncode = download_supervisor(cmd, tracker)
+    else:
+        returncode = _supervise_blocking(cmd, tracker)
+
+    # yt-dlp merges (or fixes up) after the transfer; time the two separately
+    finished = time.perf_counter()
+    postprocess_started = tracker.postprocess_started or finished
+    STAGE_SECONDS.observe(postprocess_started - started, stage='download')
+    if tracker.postprocess_started:
+        STAGE_SECONDS.observe(finished - postprocess_started, stage='merge')
+
+    return returncode, tracker.throttled and returncode != 0
+
+
+# -----------------------------
+# Audio post-processing
+# -----------------------------
+transcode_pool = ThreadPoolExecutor(
+    max_workers=app.config['TRANSCODE_WORKERS'],
+    thread_name_prefix="transcode"
+)
+
+
+def _convert_audio(artifact, source, target, profile, copy):
+    """Write source's audio track to target with ffmpeg; True on success"""
+    cmd = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-y", "-i", source, "-vn"]
+    if copy:
+        cmd += ["-c:a", "copy"]
+    else:
+        cmd += ["-threads", str(app.config['FFMPEG_THREADS']), *profile['codec']]
+
+    # Written under .part so the file finder never picks up a half-written file
+    partial = target + ".part"
+    cmd += ["-f", profile['muxer'], partial]
+
+    with STAGE_SECONDS.time(stage='remux' if copy else 'transcode'):
+        process = spawn_process(
+            cmd,
+            prefix=artifact['output_path'],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+        set_artifact_stop(artifact, lambda: kill_process_group(process.pid))
+        finished = False
+        try:
+            stderr = process.stderr.read()
+            finished = True
+        finally:
+            set_artifact_stop(artifact, None)
+            reap_process(process, kill=not finished)
+            process.stderr.close()
+    if process.returncode != 0:
+        print("ffmpeg failed:", stderr[-500:])
+        if os.path.exists(partial):
+            os.remove(partial)
+        return False
+
+    os.replace(partial, target)
+    os.remove(source)
+    return True
+
+
+def transcode_audio(artifact, source, target, profile):
+    """Transcode pool job: re-encode a downloaded track and complete the artifact"""
+    try:
+        if artifact.get('cancelled'):
+            raise Exception("Cancelled")
+        update_artifact(artifact, phase='transcoding', progress=95, speed=None, eta=None)
+
+        if not _convert_audio(artifact, source, target, profile, copy=False):
+            raise Exception("ffmpeg transcode failed")
+
+        complete_artifact(artifact, target)
+
+    except Exception as e:
+        if artifact.get('cancelled'):
+            print("Transcode cancelled:", artifact['key'])
+            if not requeue_preempted(artifact):
+                fail_artifact(artifact, 'Cancelled', cause='cancelled')
+        else:
+            print("Transcode error:", str(e))
+            fail_artifact(artifact, str(e), cause='transcode')
+
+    finally:
+        if os.path.exists(source):
+            os.remove(source)
+        file_index.end_write(artifact['output_path'])
+
+
+def prepare_audio(artifact, source, audio_format):
+    """Bring a natively downloaded audio track into the requested format
+
+    Returns the final path when no re-encode is needed (the track already
+    matches, or a stream copy into the target container is enough).
+    Otherwise queues the transcode on the transcode pool, which completes
+    the artifact, and returns None.
+    """
+    profile = AUDIO_PROFILES[audio_format]
+    source_ext = os.path.splitext(source)[1].lstrip(".")
+
+    if source_ext == audio_format:
+        return source
+
+    target = f"{artifact['output_path']}.{audio_format}"
+
+    if source_ext in profile['copy_from']:
+        update_artifact(artifact, phase='remuxing', progress=95, speed=None, eta=None)
+        if _convert_audio(artifact, source, target, profile, copy=True):
+            return target
+        if artifact.get('cancelled'):
+            raise Exception("Cancelled")
+        print("Remux failed, re-encoding:", source)
+
+    # Keep the prefix protected from the janitor until the pool job ends
+    file_index.begin_write(artifact['output_path'])
+    update_artifact(artifact, phase='transcode_queued', progress=95, speed=None, eta=None)
+    try:
+        transcode_pool.submit(transcode_audio, artifact, source, target, profile)
+    except RuntimeError:
+        file_index.end_write(artifact['output_path'])
+        raise
+    return None
+
+
+def download_youtube_video(url, format_id, task_id, artifact, is_audio=False, video_key=None, audio_format='mp3',
+                           clip=None, info_token=None):
+
+    info_json_path = None
+    output_path = artifact['output_path']
+
+    # Partial files under this prefix must survive the janitor until we finish
+    file_index.begin_write(output_path)
+
+    identity = None
+
+    try:
+        update_artifact(artifact, status='downloading', progress=0)
+
+        # The scheduler already took this platform's token before starting us
+        platform = get_platform(url)
+        identity = identity_pool.acquire(platform)
+
+        output_template = output_path + ".%(ext)s"
+
+        # --------------------------
+        # REUSE EXTRACTED INFO
+        # --------------------------
+        source_args = [url]
+        token_info = app.config['REUSE_INFO_JSON'] and info_token and load_info_token(info_token)
+        info = None if token_info else get_reusable_info(video_key)
+
+        if token_info:
+            # The info the client was shown, saved when /api/video/info returned it
+            source_args = ["--load-info-json", info_token_path(info_token)]
+        elif info:
+            info_json_path = os.path.join(app.config['DOWNLOAD_FOLDER'], f"info_{task_id}.json")
+            with open(info_json_path, 'w') as f:
+                json.dump(info, f)
+            source_args = ["--load-info-json", info_json_path]
+
+        # --------------------------
+        # BUILD COMMAND
+        # --------------------------
+
+        if is_audio:
+            # Native track only; conversion happens after the download slot is freed
+            cmd = [
+                "yt-dlp",
+                "--no-check-certificates",
+                "--format", AUDIO_PROFILES[audio_format]['format'],
+                "--output", output_template,
+                *source_args
+            ]
+        else:
+            cmd = [
+                "yt-dlp",
+                "--no-check-certificates",
+                "--format", VIDEO_FORMAT,
+                "--merge-output-format", "mp4",
+                "--prefer-ffmpeg",
+                "--output", output_template,
+                *source_args
+            ]
+
+        cmd = with_identity(cmd, identity)
+
+        # Parallel fragments for DASH/HLS, or this download's share of the
+        # budget: yt-dlp applies --limit-rate to every fragment on its own
+        rate_limit = bandwidth_budget.leased(artifact['key'])
+        if rate_limit:
+            cmd[1:1] = ["--limit-rate", str(rate_limit)]
+        else:
+            cmd[1:1] = ["--concurrent-fragments", str(app.config['CONCURRENT_FRAGMENTS'])]
+
+        # Only the fragments covering the range are fetched
+        if clip:
+            section = f"*{format_clip_time(clip['start'])}-{format_clip_time(clip['end'])}"
+            cmd[1:1] = ["--download-sections", section]
+            if clip['accurate']:
+                cmd[1:1] = ["--force-keyframes-at-cuts"]
+
+        download_started = time.time()
+        try:
+            returncode, throttled = _run_ytdlp(cmd, artifact)
+
+            if throttled and not artifact.get('cancelled'):
+                # Rotate to the next identity (or anonymous) once; anonymous throttling is final
+                anonymous = identity['path'] is None
+                backoff = identity_pool.release(identity, throttled=True)
+                identity = None
+                if anonymous:
+                    update_artifact(artifact, retry_after=backoff)
+                    raise Throttled(f"{platform} is throttling downloads, retry in {backoff}s")
+                delay = try_platform_token(platform)
+                if delay:
+                    # Waiting for the budget here would hold the slot; wait in the queue
+                    print("Throttled, queueing the retry behind the rate limit:", url)
+                    update_artifact(artifact, status='pending', phase='rate_limited',
+                                    retry_after=math.ceil(delay), speed=None, eta=None)
+                    submit_download(artifact, artifact['params'], f"retry_{uuid.uuid4().hex[:8]}")
+                    return
+                identity = identity_pool.acquire(platform)
+                print(f"Throttled, retrying as identity '{identity['name']}':", url)
+                cmd = with_identity(cmd, identity)
+                returncode, throttled = _run_ytdlp(cmd, artifact)
+
+            elif returncode != 0 and source_args[0] == "--load-info-json" and not artifact.get('cancelled'):
+                # Cached media URLs were rejected; fall back to a fresh extraction
+                print("Cached info rejected, re-extracting:", url)
+                cmd[-2:] = [url]
+                returncode, throttled = _run_ytdlp(cmd, artifact)
+        finally:
+            bandwidth_budget.release(artifact['key'])
+        download_seconds = time.time() - download_started
+
+        if throttled:
+            backoff = identity_pool.release(identity, throttled=True)
+            identity = None
+            update_artifact(artifact, retry_after=backoff)
+            raise Throttled(f"{platform} is throttling downloads, retry in {backoff}s")
+        if returncode != 0:
+            raise Exception("yt-dlp download failed")
+
+        identity_pool.release(identity, succeeded=True)
+        identity = None
+
+        # --------------------------
+        # FIND FINAL FILE
+        # --------------------------
+        download_dir = os.path.dirname(output_path)
+        base_name = os.path.basename(output_path)
+
+        found_files = [
+            os.path.join(download_dir, f)
+            for f in os.listdir(download_dir)
+            if f.startswith(base_name) and not f.endswith(('.part', '.ytdl'))
+        ]
+
+        if not found_files:
+            raise Exception("Downloaded file not found")
+
+        final_output = max(found_files, key=os.path.getmtime)
+
+        # Recorded per task so fragment/budget settings can be tuned
+        throughput = round(os.path.getsize(final_output) / max(download_seconds, 0.001))
+        bandwidth_budget.record(throughput)
+        update_artifact(artifact, throughput=throughput, rate_limit=rate_limit)
+        print(f"Downloaded {final_output} at {format_filesize(throughput)}/s (limit: {rate_limit or 'none'})")
+
+        if is_audio:
+            final_output = prepare_audio(artifact, final_output, audio_format)
+            if final_output is None:
+                return  # the transcode pool completes the artifact
+
+        if artifact.get('cancelled'):
+            raise Exception("Cancelled")
+        complete_artifact(artifact, final_output)
+
+    except Exception as e:
+        if artifact.get('cancelled'):
+            print("Download cancelled:", artifact['key'])
+            if not requeue_preempted(artifact):
+                remove_partial_files(output_path)
+                fail_artifact(artifact, 'Cancelled', cause='cancelled')
+        elif isinstance(e, Throttled):
+            print("Download throttled:", str(e))
+            remove_partial_files(output_path)
+            fail_artifact(artifact, str(e), cause='throttled')
+        else:
+            print("Download error:", str(e))
+            fail_artifact(artifact, str(e))
+
+    finally:
+        # Admission leased it even if we failed before downloading
+        bandwidth_budget.release(artifact['key'])
+        if identity:
+            identity_pool.release(identity)
+        file_index.end_write(output_path)
+        if info_json_path and os.path.exists(info_json_path):
+            os.remove(info_json_path)
+
+
+def remove_partial_files(output_path):
+    """Delete whatever a stopped download left under its output prefix"""
+    download_dir = os.path.dirname(output_path)
+    base_name = os.path.basename(output_path)
+
+    for f in os.listdir(download_dir):
+        if f.startswith(base_name):
+            try:
+                os.remove(os.path.join(download_dir, f))
+            except OSError:
+                pass
+
+
+def cancel_artifact(artifact, preempt=False):
+    """Stop an artifact's download, queued or running; False if it already finished
+
+    preempt=True stops a speculative download only while it is still
+    unadopted (checked in the same lock hold that flags it); a request that
+    adopts it afterwards gets it queued again by requeue_preempted.
+    """
+    with artifact_lock:
+        if artifact['status'] in TERMINAL_STATUSES or artifact.get('cancelled'):
+            return False
+        if preempt and not artifact.get('speculative'):
+            return False
+        artifact['cancelled'] = True
+        artifact['preempted'] = preempt
+        stop = artifact.get('stop')
+
+    if download_scheduler.cancel(artifact['key']):
+        # Never started; nothing to kill
+        fail_artifact(artifact, 'Cancelled', cause='cancelled')
+    elif stop:
+        # The download job notices the flag once the process is gone
+        stop()
+    return True
+
+
+def release_task_artifact(key, task_id):
+    """Detach a task; stop (or delete) its artifact if nothing else still wants it"""
+    with artifact_lock:
+        artifact = artifacts.get(key)
+        if artifact is None or task_id not in artifact['task_ids']:
+            return
+        artifact['task_ids'].remove(task_id)
+        keep = artifact['task_ids'] or artifact.get('speculative')
+
+    if keep:
+        download_journal.record(artifact)
+        return
+
+    if artifact['status'] != 'completed':
+        cancel_artifact(artifact)
+        return
+
+    # Finished but unwanted: delete it now unless a client is still reading it
+    entry = file_index.discard(artifact['file_path'])
+    if entry:
+        try:
+            os.remove(artifact['file_path'])
+        except OSError:
+            pass
+        delivery.remove(artifact['file_path'])
+        drop_artifact(artifact)
+
+
+def cancel_task(task_id):
+    """Cancel a task; its download stops once no other task shares it
+
+    Returns the task as it was, or None if there is no such task.
+    """
+    task = task_store.get(task_id)
+    if task is None:
+        return None
+
+    # The artifact may live in another worker process; its janitor pass
+    # picks up cancel_requested
+    release_task_artifact(task.get('artifact_key'), task_id)
+    task_store.update(
+        task_id,
+        status='cancelled',
+        error='Cancelled',
+        cancel_requested=True,
+        updated_at=time.time()
+    )
+
+    with progress_cond:
+        progress_cond.notify_all()
+    for listener in progress_listeners:
+        listener()
+    return task
+
+
+# Store writes for "a client is still polling" are throttled to one per task per this many seconds
+POLL_RECORD_INTERVAL = 5
+
+
+def record_poll(task_id, task):
+    """Note that a client is still watching a task"""
+    now = time.time()
+    if now - (task.get('last_polled') or 0) >= POLL_RECORD_INTERVAL:
+        task_store.update(task_id, last_polled=now)
+
+
+def cancel_abandoned_tasks():
+    """Release in-flight tasks cancelled on another worker or no longer polled by anyone"""
+    timeout = app.config['TASK_POLL_TIMEOUT']
+    cutoff = time.time() - timeout
+
+    with artifact_lock:
+        in_flight = [
+            (a['key'], list(a['task_ids'])) for a in artifacts.values()
+            if a['status'] not in TERMINAL_STATUSES
+        ]
+
+    for key, task_ids in in_flight:
+        for task_id in task_ids:
+            task = task_store.get(task_id)
+            if task is None or task.get('cancel_requested'):
+                release_task_artifact(key, task_id)
+            elif timeout and (task.get('last_polled') or 0) < cutoff:
+                print(f"Task {task_id} not polled for {timeout}s, cancelling")
+                cancel_task(task_id)
+
+
+# -----------------------------
+# Download journal
+# -----------------------------
+class DownloadJournal:
+    """Downloads and the tasks waiting on them, one JSON file per artifact
+
+    Written whenever an artifact changes hands or state (never for progress),
+    so the files say what every worker was doing when it died: the yt-dlp
+    parameters to resume with and a copy of each task for a store that did
+    not survive the restart. Entries go away with their artifact.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _file(self, key):
+        return os.path.join(self.path, artifact_base_name(key) + ".json")
+
+    def _write(self, path, entry):
+        # Atomic, so a crash mid-write leaves the previous entry intact
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(partial, 'w') as f:
+            json.dump(entry, f)
+        os.replace(partial, path)
+
+    def _remove(self, key):
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+
+    def record(self, artifact):
+        """Write an artifact's current state (nothing once it is dropped or no task wants it)"""
+        with self._lock:
+            with artifact_lock:
+                if artifacts.get(artifact['key']) is not artifact:
+                    return
+                if not artifact['task_ids']:
+                    self._remove(artifact['key'])
+                    return
+                entry = {
+                    'key': artifact['key'],
+                    'output_path': artifact['output_path'],
+                    'status': artifact['status'],
+                    'file_path': artifact.get('file_path'),
+                    'params': artifact.get('params'),
+                    'resume_attempts': artifact.get('resume_attempts', 0),
+                    'task_ids': list(artifact['task_ids'])
+                }
+            entry['tasks'] = {task_id: task_store.get(task_id) for task_id in entry.pop('task_ids')}
+            entry['owner'] = {'pid': os.getpid(), 'start_time': _process_start_time(os.getpid())}
+            entry['updated_at'] = time.time()
+            self._write(self._file(artifact['key']), entry)
+
+    def forget(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def entries(self):
+        result = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.path, filename)) as f:
+                    result.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return result
+
+    def unfinished_prefixes(self):
+        """Output prefixes of journaled downloads that have not completed"""
+        return [os.path.basename(e['output_path']) for e in self.entries() if e.get('status') != 'completed']
+
+    def live_prefixes(self):
+        """Output prefixes of entries another live worker owns"""
+        prefixes = []
+        for entry in self.entries():
+            owner = entry.get('owner') or {}
+            if owner.get('pid') != os.getpid() and _process_alive(owner.get('pid', 0), owner.get('start_time')):
+                prefixes.append(os.path.basename(entry['output_path']))
+        return prefixes
+
+    def claim_orphans(self):
+        """Take over the entries of dead workers; each goes to exactly one claimant"""
+        owner = {'pid': os.getpid(), 'start_time': _process_start_time(os.getpid())}
+        claimed = []
+        # Workers starting together serialize here
+        with open(os.path.join(self.path, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for entry in self.entries():
+                previous = entry.get('owner') or {}
+                if _process_alive(previous.get('pid', 0), previous.get('start_time')):
+                    continue
+                entry['owner'] = owner
+                self._write(self._file(entry['key']), entry)
+                claimed.append(entry)
+        return claimed
+
+
+download_journal = DownloadJournal(app.config['JOURNAL_DIR'])
+
+
+def submit_download(artifact, params, job_name, priority=PRIORITY_NORMAL):
+    """Queue the download job for an artifact this worker owns; raises SchedulerFull"""
+    artifact['params'] = params
+    download_scheduler.submit(
+        artifact['key'],
+        params['platform'],
+        download_youtube_video,
+        args=(params['url'], params['format_id'], job_name, artifact, params['is_audio'],
+              params['video_key'], params['audio_format'], params['clip'], params.get('info_token')),
+        priority=priority
+    )
+
+
+def restore_tasks(entry):
+    """Put a journal entry's tasks back in the store; returns the ids still wanted"""
+    now = time.time()
+    task_ids = []
+    for task_id, snapshot in (entry.get('tasks') or {}).items():
+        task = task_store.get(task_id)
+        if task is None and snapshot:
+            task_store.create(task_id, snapshot)
+        elif task is None or task.get('cancel_requested'):
+            continue
+        # Clients get a full poll timeout to come back before auto-cancel
+        task_store.update(task_id, last_polled=now)
+        task_ids.append(task_id)
+    return task_ids
+
+
+def recover_download(entry):
+    """Resume (or re-adopt, or fail) one download a dead worker journaled"""
+    key = entry['key']
+    task_ids = restore_tasks(entry)
+    if not task_ids:
+        if entry.get('status') != 'completed':
+            remove_partial_files(entry['output_path'])
+        download_journal.forget(key)
+        return
+
+    artifact, is_owner = None, False
+    for task_id in task_ids:
+        artifact, claimed = claim_artifact(key, task_id)
+        is_owner = is_owner or claimed
+
+    if not is_owner:
+        # A new request got here first; its download writes the same files
+        with artifact_lock:
+            for task_id in task_ids:
+                task_store.update(task_id, **{
+                    field: artifact[field]
+                    for field in ARTIFACT_TASK_FIELDS
+                    if field in artifact
+                })
+        download_journal.record(artifact)
+        RECOVERED_DOWNLOADS.inc(outcome='restored')
+        return
+
+    if entry.get('status') == 'completed':
+        if entry.get('file_path') and os.path.exists(entry['file_path']):
+            complete_artifact(artifact, entry['file_path'])
+            RECOVERED_DOWNLOADS.inc(outcome='restored')
+            print(f"✓ Restored finished download: {key}")
+        else:
+            fail_artifact(artifact, "Downloaded file was lost in a restart", cause='interrupted')
+            RECOVERED_DOWNLOADS.inc(outcome='failed')
+        return
+
+    attempts = entry.get('resume_attempts', 0) + 1
+    error = None
+    if not entry.get('params'):
+        error = "Interrupted by a restart before the download started"
+    elif attempts > app.config['MAX_RESUME_ATTEMPTS']:
+        error = f"Interrupted by {attempts} restarts, giving up"
+    else:
+        artifact['resume_attempts'] = attempts
+        update_artifact(artifact, status='pending', phase='resuming', error=None)
+        try:
+            submit_download(artifact, entry['params'], f"resume_{uuid.uuid4().hex[:8]}")
+        except SchedulerFull as e:
+            error = f"Interrupted by a restart and could not be requeued: {e}"
+
+    if error:
+        print(f"✗ Cannot resume {key}: {error}")
+        remove_partial_files(entry['output_path'])
+        fail_artifact(artifact, error, cause='interrupted')
+        RECOVERED_DOWNLOADS.inc(outcome='failed')
+        return
+
+    download_journal.record(artifact)
+    RECOVERED_DOWNLOADS.inc(outcome='resumed')
+    print(f"✓ Resuming interrupted download {key} (attempt {attempts})")
+
+
+def recover_downloads():
+    """Pick up every download whose worker died; runs at startup and on each janitor pass"""
+    entries = download_journal.claim_orphans()
+    if not entries:
+        return
+
+    # Whatever the dead worker left running would write the same partial files
+    kill_orphaned_groups()
+    for entry in entries:
+        try:
+            recover_download(entry)
+        except Exception as e:
+            print(f"Journal recovery error for {entry.get('key')}: {str(e)}")
+
+
+# -----------------------------
+# Speculative prefetch
+# -----------------------------
+class FormatPopularity:
+    """Counts which download type each platform's users ask for"""
+
+    def __init__(self):
+        self._counts = {}           # platform -> {choice: count}
+        self._lock = threading.Lock()
+
+    def record(self, platform, choice):
+        with self._lock:
+            counts = self._counts.setdefault(platform, {})
+            counts[choice] = counts.get(choice, 0) + 1
+
+    def most_likely(self, platform, min_samples):
+        with self._lock:
+            counts = dict(self._counts.get(platform, {}))
+        if sum(counts.values()) < min_samples:
+            return None
+        return max(counts, key=counts.get)
+
+    def stats(self):
+        with self._lock:
+            return {platform: dict(counts) for platform, counts in self._counts.items()}
+
+
+format_popularity = FormatPopularity()
+
+
+def download_choice(is_audio, audio_format):
+    return f"audio:{audio_format}" if is_audio else "video"
+
+
+def adopt_speculative(artifact):
+    # Caller holds artifact_lock; a real request now owns this download
+    artifact['speculative'] = False
+    SPECULATIONS.inc(outcome='hit')
+    download_scheduler.promote(artifact['key'], PRIORITY_NORMAL)
+
+
+def speculate(url, platform):
+    """Start a low-priority download of the format this platform's users usually pick"""
+    choice = format_popularity.most_likely(platform, app.config['SPECULATIVE_MIN_SAMPLES'])
+    if not choice:
+        return
+
+    # Never compete with real work for a slot
+    if not download_scheduler.has_room(platform):
+        return
+
+    with artifact_lock:
+        active = sum(
+            1 for a in artifacts.values()
+            if a.get('speculative') and a['status'] in ('pending', 'downloading')
+        )
+    if active >= app.config['SPECULATIVE_MAX_ACTIVE']:
+        return
+
+    is_audio = choice.startswith('audio:')
+    audio_format = choice.split(':', 1)[1] if is_audio else 'mp3'
+    video_key = get_video_key(url, platform)
+    key = get_artifact_key(video_key, is_audio, audio_format)
+
+    artifact, is_owner = claim_artifact(key, None, speculative=True)
+    if not is_owner:
+        return
+    artifact['platform'] = platform
+
+    params = {
+        'url': url,
+        'platform': platform,
+        'format_id': None,
+        'is_audio': is_audio,
+        'video_key': video_key,
+        'audio_format': audio_format,
+        'clip': None
+    }
+    try:
+        submit_download(artifact, params, f"spec_{uuid.uuid4().hex[:8]}", priority=PRIORITY_LOW)
+    except SchedulerFull:
+        drop_artifact(artifact)
+        return
+
+    SPECULATIONS.inc(outcome='started')
+    print(f"Speculative prefetch started: {key}")
+
+
+def preempt_speculative(platform):
+    """Cancel one running, unadopted speculative download to free a slot
+
+    Prefers one on `platform`, whose per-platform limit may be what is full.
+    """
+    with artifact_lock:
+        running = [
+            a for a in artifacts.values()
+            if a.get('speculative') and a['status'] == 'downloading' and not a.get('cancelled')
+        ]
+        running.sort(key=lambda a: a.get('platform') != platform)
+        victim = running[0] if running else None
+    if not victim or not cancel_artifact(victim, preempt=True):
+        return
+    SPECULATIONS.inc(outcome='preempted')
+    print(f"Speculative prefetch preempted: {victim['key']}")
+
+
+def requeue_preempted(artifact):
+    """Queue a preempted prefetch again if a request adopted it while it stopped; True if it did"""
+    with artifact_lock:
+        if not artifact.pop('preempted', False) or not artifact['task_ids'] \
+                or artifacts.get(artifact['key']) is not artifact:
+            return False
+        artifact['cancelled'] = False
+        artifact.pop('stop', None)
+
+    print(f"Preempted prefetch was adopted, queueing it again: {artifact['key']}")
+    update_artifact(artifact, status='pending', phase=None, speed=None, eta=None)
+    try:
+        # Its partial files stay; yt-dlp continues from them
+        submit_download(artifact, artifact['params'], f"requeue_{uuid.uuid4().hex[:8]}")
+    except SchedulerFull as e:
+        fail_artifact(artifact, str(e), cause='queue_full')
+    return True
+
+
+def speculation_stats():
+    started = SPECULATIONS.value(outcome='started')
+    hits = SPECULATIONS.value(outcome='hit')
+    return {
+        'enabled': app.config['SPECULATIVE_PREFETCH'],
+        'started': started,
+        'hits': hits,
+        'wasted': SPECULATIONS.value(outcome='wasted'),
+        'preempted': SPECULATIONS.value(outcome='preempted'),
+        'hit_rate': round(hits / started, 3) if started else None,
+        'wasted_bytes': SPECULATIVE_WASTED_BYTES.value(),
+        'popularity': format_popularity.stats()
+    }
+
+
+class ApiError(Exception):
+    """Request-level failure shared by the WSGI and ASGI front ends"""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class RateLimited(ApiError):
+    """429: the platform's request budget (or every cookie identity) is exhausted"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message, 429)
+        self.retry_after = max(int(retry_after + 0.999), 1)
+
+
+def api_error_response(e):
+    response = jsonify({'error': str(e)})
+    if isinstance(e, RateLimited):
+        response.headers['Retry-After'] = str(e.retry_after)
+    return response, e.status
+
+
+# -----------------------------
+# Progressive streaming
+# -----------------------------
+MEDIA_MIME_TYPES = {
+    'mp3': 'audio/mpeg',
+    'mp4': 'video/mp4',
+    'm4a': 'audio/mp4',
+    'webm': 'video/webm',
+    'mkv': 'video/x-matroska',
+    'opus': 'audio/ogg',
+}
+
+stream_slots = threading.BoundedSemaphore(app.config['MAX_CONCURRENT_STREAMS'])
+
+
+def _has_video(f):
+    return f.get('vcodec') not in (None, 'none')
+
+
+def _has_audio(f):
+    return f.get('acodec') not in (None, 'none')
+
+
+def plan_stream(info, is_audio, audio_format='mp3'):
+    """Decide how to stream a video without writing it to disk
+
+    Returns a dict with 'kind' ('ytdlp' to pipe a single format straight
+    from yt-dlp, 'ffmpeg' to merge/transcode into a streamable container),
+    the formats involved, 'ext' and 'mimetype'; or None if nothing fits.
+    """
+    formats = [f for f in info.get('formats') or [] if f.get('url')]
+    audio_only = [f for f in formats if _has_audio(f) and not _has_video(f)]
+
+    if is_audio:
+        if not audio_only:
+            return None
+        best_audio = max(audio_only, key=lambda f: f.get('abr') or f.get('tbr') or 0)
+
+        if audio_format == 'mp3':
+            return {'kind': 'ffmpeg', 'formats': [best_audio], 'ext': 'mp3', 'mimetype': 'audio/mpeg'}
+
+        ext = best_audio.get('ext') or 'm4a'
+        return {
+            'kind': 'ytdlp',
+            'formats': [best_audio],
+            'ext': ext,
+            'mimetype': MEDIA_MIME_TYPES.get(ext, 'application/octet-stream')
+        }
+
+    def video_rank(f):
+        return (f.get('height') or 0, f.get('tbr') or 0)
+
+    progressive = [f for f in formats if _has_video(f) and _has_audio(f) and f.get('ext') == 'mp4']
+    video_only = [f for f in formats if _has_video(f) and not _has_audio(f) and f.get('ext') == 'mp4']
+    m4a_audio = [f for f in audio_only if f.get('ext') == 'm4a']
+
+    best_progressive = max(progressive, key=video_rank) if progressive else None
+    best_video = max(video_only, key=video_rank) if video_only and m4a_audio else None
+
+    # Same preference as VIDEO_FORMAT: separate tracks win when they are
+    # better quality, and are merged on the fly into fragmented MP4
+    if best_video and (not best_progressive or video_rank(best_video) > video_rank(best_progressive)):
+        best_audio = max(m4a_audio, key=lambda f: f.get('abr') or f.get('tbr') or 0)
+        return {'kind': 'ffmpeg', 'formats': [best_video, best_audio], 'ext': 'mp4', 'mimetype': 'video/mp4'}
+
+    if best_progressive:
+        return {'kind': 'ytdlp', 'formats': [best_progressive], 'ext': 'mp4', 'mimetype': 'video/mp4'}
+
+    return None
+
+
+def build_stream_command(plan, url, info_json_path=None, identity=None):
+    """Command line that writes the planned stream to stdout"""
+    if plan['kind'] == 'ytdlp':
+        cmd = [
+            "yt-dlp",
+            "--no-check-certificates",
+            "--quiet",
+            "--format", plan['formats'][0]['format_id'],
+            "--output", "-",
+            *cookie_args(identity)
+        ]
+        if info_json_path:
+            cmd += ["--load-info-json", info_json_path]
+        else:
+            cmd.append(url)
+        return cmd
+
+    cmd = [FFMPEG_PATH, "-hide_banner", "-loglevel", "error"]
+    for f in plan['formats']:
+        headers = f.get('http_headers') or {}
+        if headers:
+            cmd += ["-headers", "".join(f"{k}: {v}\r\n" for k, v in headers.items())]
+        cmd += ["-i", f['url']]
+
+    if plan['ext'] == 'mp3':
+        cmd += ["-vn", "-threads", str(app.config['FFMPEG_THREADS']), *AUDIO_PROFILES['mp3']['codec'], "-f", "mp3"]
+    else:
+        cmd += [
+            "-map", "0:v:0", "-map", "1:a:0",
+            "-c", "copy",
+            # Fragmented MP4 can be written to a pipe and played while arriving
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof",
+            "-f", "mp4"
+        ]
+    cmd.append("pipe:1")
+    return cmd
+
+
+def prepare_stream(url, is_audio, audio_format):
+    """Plan a progressive stream and take a stream slot
+
+    Returns (cmd, plan, download filename, release callback); the caller
+    must run the callback once the stream ends. Raises ApiError.
+    """
+    if not url:
+        raise ApiError('URL is required', 400)
+
+    platform = get_platform(url)
+
+    if not platform:
+        raise ApiError('Only YouTube or Instagram supported', 400)
+
+    video_key = get_video_key(url, platform)
+    try:
+        info = get_cached_info(url, platform)
+        plan = plan_stream(info, is_audio, audio_format)
+        # ffmpeg reads the signed media URLs itself; re-extract rather than
+        # hand it ones that are about to expire
+        if plan and plan['kind'] == 'ffmpeg' and not info_urls_fresh(info):
+            info_cache.invalidate(video_key)
+            info = get_cached_info(url, platform)
+            plan = plan_stream(info, is_audio, audio_format)
+    except ApiError:
+        raise
+    except Exception as e:
+        raise ApiError(str(e), 500)
+
+    if not plan:
+        raise ApiError('No streamable format available, use /api/video/download', 422)
+
+    # Streaming from the platform counts against its request budget too
+    take_platform_token(platform, app.config['RATE_LIMIT_MAX_WAIT'])
+
+    if not stream_slots.acquire(blocking=False):
+        raise ApiError('Too many active streams, try again later', 503)
+
+    identity = identity_pool.acquire(platform)
+    try:
+        cleanup_paths = []
+        info_json_path = None
+
+        if plan['kind'] == 'ytdlp' and get_reusable_info(video_key):
+            info_json_path = os.path.join(app.config['DOWNLOAD_FOLDER'], f"info_stream_{uuid.uuid4().hex}.json")
+            with open(info_json_path, 'w') as f:
+                json.dump(info, f)
+            cleanup_paths.append(info_json_path)
+
+        cmd = build_stream_command(plan, url, info_json_path, identity)
+        print(f"\nStreaming ({plan['kind']}): {' '.join(cmd[:6])} ...")
+    except Exception as e:
+        stream_slots.release()
+        identity_pool.release(identity)
+        raise ApiError(str(e), 500)
+
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = f"{'audio' if is_audio else 'video'}_{timestamp}.{plan['ext']}"
+
+    def release_stream():
+        stream_slots.release()
+        identity_pool.release(identity)
+        for path in cleanup_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    return cmd, plan, filename, release_stream
+
+
+def stream_process_output(cmd):
+    """Yield a subprocess's stdout in chunks; the pipe provides backpressure"""
+    process = spawn_process(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    chunk_size = app.config['STREAM_CHUNK_SIZE']
+
+    finished = False
+    try:
+        while True:
+            chunk = process.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            BYTES_SERVED.inc(len(chunk), endpoint='stream')
+            yield chunk
+        finished = True
+    finally:
+        # Client went away (GeneratorExit) or we finished: never leave it running
+        reap_process(process, kill=not finished)
+        process.stdout.close()
+
+    if process.returncode != 0:
+        print(f"Stream process exited with {process.returncode}: {cmd[0]}")
+        FAILURES.inc(cause='stream')
+
+
+# -----------------------------
+# File delivery (Range / conditional requests)
+# -----------------------------
+_last_task_purge = 0.0
+
+
+def purge_served_tasks():
+    """Drop tasks whose file was served more than TASK_RETENTION seconds ago"""
+    global _last_task_purge
+
+    now = time.time()
+    if now - _last_task_purge < 60:
+        return
+    _last_task_purge = now
+
+    cutoff = now - app.config['TASK_RETENTION']
+    for task_id, task in task_store.purge_served(cutoff).items():
+        detach_artifact_task(task.get('artifact_key'), task_id)
+        print(f"✓ Removed task: {task_id}")
+
+
+class _ClosingFile:
+    """File object that runs a callback once the server closes the response body
+
+    Keeps fileno() so gunicorn's wsgi.file_wrapper can still use sendfile.
+    """
+
+    def __init__(self, f, on_close=None):
+        self._f = f
+        self._on_close = on_close
+        self._closed = False
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._f.close()
+        if self._on_close:
+            self._on_close()
+
+
+def _read_range(f, start, stop, chunk_size=64 * 1024):
+    f.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+
+class _FileBody:
+    """Response body iterating chunks of f; close() always closes f
+
+    A generator's finally block never runs if the server closes it before
+    the first chunk (HEAD requests, clients gone before the body starts),
+    which would leak the file and skip its on_close.
+    """
+
+    def __init__(self, f, chunks):
+        self._f = f
+        self._chunks = chunks
+
+    def __iter__(self):
+        return self._chunks
+
+    def close(self):
+        self._f.close()
+
+
+def _iter_multipart_ranges(f, ranges, size, mimetype, boundary):
+    for start, stop in ranges:
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {mimetype}\r\n"
+            f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n"
+        ).encode()
+        yield from _read_range(f, start, stop)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def _satisfiable_ranges(byte_range, size):
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:                   # suffix range: last N bytes
+            start, stop = max(size + start, 0), size
+        else:
+            stop = size if stop is None else min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def send_media_file(file_path, mimetype, download_name=None, cache_control=None, on_close=None):
+    """send_file with Range/206, ETag/Last-Modified/304 and zero-copy full bodies
+
+    Full bodies and open-ended ranges ("bytes=N-", what resuming clients
+    send) go out through wsgi.file_wrapper so gunicorn can use sendfile();
+    bounded and multi-part ranges are streamed from Python. on_close runs
+    once the server is done with the response, however it ended.
+    """
+    stat = os.stat(file_path)
+    size = stat.st_size
+    mtime = int(stat.st_mtime)
+    etag = f"{mtime:x}-{size:x}"
+
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(mtime),
+        'Accept-Ranges': 'bytes'
+    }
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+
+    def finish(response):
+        if download_name:
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        return response
+
+    # -------------------------
+    # Conditional GET
+    # -------------------------
+    not_modified = False
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since:
+        not_modified = mtime <= request.if_modified_since.timestamp()
+
+    if not_modified:
+        response = Response(status=304, headers=headers)
+        if on_close:
+            response.call_on_close(on_close)
+        return finish(response)
+
+    # -------------------------
+    # Range
+    # -------------------------
+    byte_range = request.range
+    if_range = request.if_range
+    if byte_range and (if_range.etag or if_range.date):
+        # If-Range: only honour the range if the client's copy is current
+        if if_range.etag:
+            still_valid = if_range.etag == etag
+        else:
+            still_valid = if_range.date is not None and mtime <= if_range.date.timestamp()
+        if not still_valid:
+            byte_range = None
+
+    ranges = None
+    if byte_range and byte_range.units == 'bytes':
+        ranges = _satisfiable_ranges(byte_range, size)
+        if not ranges:
+            headers['Content-Range'] = f"bytes */{size}"
+            response = Response(status=416, headers=headers)
+            if on_close:
+                response.call_on_close(on_close)
+            return response
+
+    # Counted as handed to the server; an aborted transfer still counts in full
+    body_bytes = sum(stop - start for start, stop in ranges) if ranges else size
+    endpoint = request.endpoint
+
+    def closed():
+        BYTES_SERVED.inc(body_bytes, endpoint=endpoint)
+        if on_close:
+            on_close()
+
+    f = _ClosingFile(open(file_path, 'rb'), closed)
+
+    if not ranges or (len(ranges) == 1 and ranges[0] == (0, size)):
+        status, start, stop = 200, 0, size
+    elif len(ranges) == 1:
+        status, (start, stop) = 206, ranges[0]
+        headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    else:
+        boundary = uuid.uuid4().hex
+        response = Response(
+            _FileBody(f, _iter_multipart_ranges(f, ranges, size, mimetype, boundary)),
+            status=206,
+            headers=headers,
+            mimetype=f"multipart/byteranges; boundary={boundary}"
+        )
+        return finish(response)
+
+    headers['Content-Length'] = str(stop - start)
+
+    if stop == size:
+        f.seek(start)
+        body = wrap_file(request.environ, f)
+    else:
+        body = _FileBody(f, _read_range(f, start, stop))
+
+    response = Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    return finish(response)
+
+
+def locate_task_file(task_id):
+    """(file_path, mimetype, download_name) of a completed task; raises ApiError"""
+    task = task_store.get(task_id)
+
+    if task is None:
+        raise ApiError('Task not found', 404)
+
+    if task.get('status') != 'completed':
+        raise ApiError('Download not completed', 400)
+
+    file_path = task.get('file_path')
+
+    if not file_path or not os.path.exists(file_path):
+        raise ApiError('File not found', 404)
+
+    ext = os.path.splitext(file_path)[1]
+    mimetype = MEDIA_MIME_TYPES.get(ext.lower().lstrip('.'), 'application/octet-stream')
+
+    print("\nSending file to client:")
+    print(f"  Path: {file_path}")
+    print(f"  MIME: {mimetype}")
+
+    return file_path, mimetype, task.get('download_name', 'video') + ext
+
+
+def finish_file_transfer(file_path, task_id, pinned=True):
+    """Unpin a served file and start the task's retention clock
+
+    The task is kept for TASK_RETENTION so interrupted transfers can resume.
+    Transfers handed to a delivery backend were never pinned; they only
+    refresh the file's expiry.
+    """
+    try:
+        if pinned:
+            file_index.release(file_path)
+        else:
+            file_index.touch(file_path)
+
+        task_store.update(task_id, served_at=time.time())
+
+        purge_served_tasks()
+
+    except Exception as e:
+        print(f"Cleanup error: {str(e)}")
+
+
+# -----------------------------
+# File delivery backends
+# -----------------------------
+# Files above this go up as a multipart upload, in parts of this size
+S3_PART_SIZE = 64 * 1024 ** 2
+S3_UPLOAD_ID_RE = re.compile(r'<UploadId>([^<]+)</UploadId>')
+
+
+class DirectDelivery:
+    """Finished files are streamed by this process"""
+
+    name = 'direct'
+
+    def publish(self, artifact):
+        """Called once an artifact's file is complete"""
+
+    def handoff(self, task_id, file_path, mimetype, download_name):
+        """(status, headers) that hand the transfer to something else; None to stream it here"""
+        return None
+
+    def remove(self, file_path):
+        """Called once the local file has been deleted"""
+
+    def stats(self):
+        return {'backend': self.name}
+
+
+class ProxyDelivery(DirectDelivery):
+    """The front proxy reads the file from DOWNLOAD_FOLDER itself (X-Accel-Redirect / X-Sendfile)"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def handoff(self, task_id, file_path, mimetype, download_name):
+        headers = {
+            'Content-Type': mimetype,
+            'Content-Disposition': f'attachment; filename="{download_name}"'
+        }
+        if self.name == 'accel':
+            relative = os.path.relpath(file_path, app.config['DOWNLOAD_FOLDER'])
+            headers['X-Accel-Redirect'] = app.config['ACCEL_REDIRECT_PREFIX'] + quote(relative)
+        else:
+            headers['X-Sendfile'] = os.path.abspath(file_path)
+        return 200, headers
+
+
+class S3Error(Exception):
+    pass
+
+
+class _FileSection:
+    """Reads at most `length` bytes from the current position of f (one multipart part)"""
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+def _hmac(key, message):
+    return hmac.new(key, message.encode(), hashlib.sha256).digest()
+
+
+class S3Client:
+    """The handful of S3 calls delivery needs, signed with AWS Signature V4
+
+    Path-style URLs (endpoint/bucket/key), which MinIO and AWS both accept.
+    Payloads are sent as UNSIGNED-PAYLOAD so uploads stream from disk
+    without being hashed first.
+    """
+
+    def __init__(self, endpoint, region, bucket, access_key, secret_key):
+        parsed = urlparse(endpoint)
+        self.base_url = f"{parsed.scheme}://{parsed.netloc}"
+        self.host = parsed.netloc
+        self.region = region
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+
+    def _path(self, key):
+        return f"/{self.bucket}/{quote(key, safe='/-_.~')}" if key else f"/{self.bucket}"
+
+    def _sign(self, method, path, query, headers, amz_date):
+        """Returns (credential scope, canonical query string, signed header names, signature)"""
+        datestamp = amz_date[:8]
+        scope = f"{datestamp}/{self.region}/s3/aws4_request"
+        canonical_query = "&".join(
+            f"{quote(str(k), safe='-_.~')}={quote(str(v), safe='-_.~')}" for k, v in sorted(query.items())
+        )
+        names = sorted(headers)
+        canonical_request = "\n".join([
+            method,
+            path,
+            canonical_query,
+            "".join(f"{name}:{headers[name]}\n" for name in names),
+            ";".join(names),
+            "UNSIGNED-PAYLOAD"
+        ])
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest()
+        ])
+        key = _hmac(_hmac(_hmac(_hmac(f"AWS4{self.secret_key}".encode(), datestamp), self.region), "s3"), "aws4_request")
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return scope, canonical_query, ";".join(names), signature
+
+    def presign(self, key, expires, params=None):
+        """A GET URL for key that works for `expires` seconds without credentials"""
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        path = self._path(key)
+        query = dict(params or {})
+        query.update({
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f"{self.access_key}/{amz_date[:8]}/{self.region}/s3/aws4_request",
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': str(expires),
+            'X-Amz-SignedHeaders': 'host'
+        })
+        _, canonical_query, _, signature = self._sign('GET', path, query, {'host': self.host}, amz_date)
+        return f"{self.base_url}{path}?{canonical_query}&X-Amz-Signature={signature}"
+
+    def request(self, method, key='', query=None, headers=None, body=None, timeout=60):
+        """Signed request; returns (status, headers, body) for any HTTP status"""
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        path = self._path(key)
+        signed = {'host': self.host, 'x-amz-content-sha256': 'UNSIGNED-PAYLOAD', 'x-amz-date': amz_date}
+        scope, canonical_query, signed_names, signature = self._sign(method, path, query or {}, signed, amz_date)
+
+        headers = dict(headers or {})
+        if body is not None:
+            # urllib would otherwise label every body as a form post
+            headers.setdefault('Content-Type', 'application/octet-stream')
+        headers.update({
+            'x-amz-content-sha256': 'UNSIGNED-PAYLOAD',
+            'x-amz-date': amz_date,
+            'Authorization': (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+                              f"SignedHeaders={signed_names}, Signature={signature}")
+        })
+        url = self.base_url + path + (f"?{canonical_query}" if canonical_query else "")
+        req = urllib.request.Request(url, data=body, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
+                return resp.status, resp.headers, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+
+    def _check(self, response, action):
+        status, headers, body = response
+        # CompleteMultipartUpload can fail with a 200 and an <Error> body
+        if status >= 300 or b"<Error>" in body:
+            raise S3Error(f"S3 {action} failed ({status}): {body[:200].decode(errors='replace')}")
+        return response
+
+    def ensure_bucket(self):
+        if self.request('HEAD')[0] != 404:
+            return
+        body = None
+        if self.region != 'us-east-1':
+            body = (f"<CreateBucketConfiguration><LocationConstraint>{self.region}"
+                    f"</LocationConstraint></CreateBucketConfiguration>").encode()
+        self._check(self.request('PUT', body=body, headers={'Content-Type': 'application/xml'}), 'create bucket')
+        print(f"✓ Created bucket {self.bucket}")
+
+    def upload(self, key, file_path, content_type):
+        size = os.path.getsize(file_path)
+        if size <= S3_PART_SIZE:
+            with open(file_path, 'rb') as f:
+                self._check(self.request('PUT', key, headers={
+                    'Content-Type': content_type,
+                    'Content-Length': str(size)
+                }, body=f, timeout=600), 'upload')
+            return
+
+        _, _, body = self._check(self.request('POST', key, query={'uploads': ''},
+                                              headers={'Content-Type': content_type}), 'start upload')
+        upload_id = S3_UPLOAD_ID_RE.search(body.decode()).group(1)
+        try:
+            parts = []
+            with open(file_path, 'rb') as f:
+                for number, offset in enumerate(range(0, size, S3_PART_SIZE), 1):
+                    length = min(S3_PART_SIZE, size - offset)
+                    f.seek(offset)
+                    _, headers, _ = self._check(self.request(
+                        'PUT', key,
+                        query={'partNumber': number, 'uploadId': upload_id},
+                        headers={'Content-Length': str(length)},
+                        body=_FileSection(f, length),
+                        timeout=600
+                    ), f'upload part {number}')
+                    parts.append(f"<Part><PartNumber>{number}</PartNumber><ETag>{headers['ETag']}</ETag></Part>")
+            manifest = f"<CompleteMultipartUpload>{''.join(parts)}</CompleteMultipartUpload>".encode()
+            self._check(self.request('POST', key, query={'uploadId': upload_id}, body=manifest,
+                                     headers={'Content-Type': 'application/xml'}, timeout=600), 'complete upload')
+        except Exception:
+            self.request('DELETE', key, query={'uploadId': upload_id})
+            raise
+
+
+class S3Delivery(DirectDelivery):
+    """Finished files are copied to an S3-compatible bucket; clients are redirected to a presigned URL
+
+    The local file stays the source of truth: uploads run in the background
+    (clients are served locally until theirs is done) and the object is
+    deleted whenever the local file is. Only keys this worker published are
+    deleted, and operations on one key run in the order they were asked
+    for. A bucket lifecycle rule is the backstop for objects whose local
+    file vanished without the janitor.
+    """
 
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+    name = 's3'
 
-        if result.returncode != 0:
-            print("YT-DLP STDOUT:", result.stdout)
-            print("YT-DLP STDERR:", result.stderr)
-            raise Exception("Video not accessible")
+    def __init__(self):
+        if not app.config['S3_BUCKET']:
+            raise ValueError("DELIVERY_BACKEND=s3 needs S3_BUCKET")
+        self.client = S3Client(
+            app.config['S3_ENDPOINT'],
+            app.config['S3_REGION'],
+            app.config['S3_BUCKET'],
+            app.config['S3_ACCESS_KEY'],
+            app.config['S3_SECRET_KEY']
+        )
+        self._pool = ThreadPoolExecutor(max_workers=app.config['S3_UPLOAD_WORKERS'], thread_name_prefix='s3')
+        self._pool.submit(self._ensure_bucket)
+        self._lock = threading.Lock()
+        self._published = set()         # keys uploaded (or found) by this worker
+        self._pending = {}              # key -> deque of operations not yet run
+        self.uploaded = 0
+        self.upload_failures = 0
+        self.deleted = 0
 
-        info = json.loads(result.stdout)
+    def object_key(self, file_path):
+        return app.config['S3_PREFIX'] + os.path.basename(file_path)
 
-        # -----------------------------
-        # Duration
-        # -----------------------------
-        duration_seconds = int(info.get('duration') or 0)
-        minutes = duration_seconds // 60
-        seconds = duration_seconds % 60
-        duration_formatted = f"{minutes}:{seconds:02d}"
+    def _ensure_bucket(self):
+        try:
+            self.client.ensure_bucket()
+        except Exception as e:
+            print(f"S3 bucket check failed: {str(e)}")
 
-        # -----------------------------
-        # Views
-        # -----------------------------
-        view_count = int(info.get('view_count') or 0)
+    def _submit(self, key, fn, *args):
+        # One runner per key drains its operations in order, so a delete can
+        # never overtake the upload it follows (or the other way round)
+        with self._lock:
+            queue = self._pending.get(key)
+            if queue is not None:
+                queue.append((fn, args))
+                return
+            self._pending[key] = deque([(fn, args)])
+        self._pool.submit(self._run, key)
 
-        if view_count >= 1_000_000:
-            views_formatted = f"{view_count / 1_000_000:.1f}M views"
-        elif view_count >= 1_000:
-            views_formatted = f"{view_count / 1_000:.1f}K views"
-        else:
-            views_formatted = f"{view_count} views" if view_count else ""
+    def _run(self, key):
+        while True:
+            with self._lock:
+                queue = self._pending[key]
+                if not queue:
+                    del self._pending[key]
+                    return
+                fn, args = queue.popleft()
+            try:
+                fn(key, *args)
+            except Exception as e:
+                print(f"S3 operation on {key} failed: {str(e)}")
 
-        # -----------------------------
-        # Thumbnail (LOCAL DOWNLOAD)
-        # -----------------------------
-        video_id = str(uuid.uuid4())[:8]
-        local_thumb_filename = download_thumbnail(url, video_id)
+    def publish(self, artifact):
+        file_path = artifact['file_path']
+        self._submit(self.object_key(file_path), self._upload, artifact, file_path)
 
-        if local_thumb_filename:
-            thumbnail_url = f"/api/thumbnail/{local_thumb_filename}"
-        else:
-            # fallback (temporary)
-            thumbnail_url = info.get("thumbnail", "")
+    def _upload(self, key, artifact, file_path):
+        # Pinned so the janitor cannot delete it mid-upload
+        file_index.acquire(file_path)
+        try:
+            status, headers, _ = self.client.request('HEAD', key)
+            # Already there when a restarted worker re-adopts a finished download
+            if status != 200 or int(headers.get('Content-Length', -1)) != os.path.getsize(file_path):
+                ext = os.path.splitext(file_path)[1].lower().lstrip('.')
+                mimetype = MEDIA_MIME_TYPES.get(ext, 'application/octet-stream')
+                with STAGE_SECONDS.time(stage='upload'):
+                    self.client.upload(key, file_path, mimetype)
+                self.uploaded += 1
+            with self._lock:
+                self._published.add(key)
+            update_artifact(artifact, remote_key=key)
+        except Exception as e:
+            self.upload_failures += 1
+            FAILURES.inc(cause='upload')
+            print(f"S3 upload failed for {os.path.basename(file_path)}: {str(e)}")
+        finally:
+            file_index.release(file_path)
 
-        # -----------------------------
-        # Get File Sizes from formats
-        # -----------------------------
-        all_formats = info.get('formats', [])
-        
-        # Find sizes for specific quality levels
-        size_1080p = None
-        size_720p = None
-        size_best = None
-        size_audio = None
-        
-        for f in all_formats:
-            height = f.get('height')
-            filesize = f.get('filesize') or f.get('filesize_approx')
-            vcodec = f.get('vcodec', 'none')
-            acodec = f.get('acodec', 'none')
-            
-            # Best quality (highest resolution video with audio)
-            if vcodec != 'none' and acodec != 'none' and filesize:
-                if not size_best or (height and height > (size_best.get('height') or 0)):
-                    size_best = {'size': filesize, 'height': height}
-            
-            # 1080p
-            if height == 1080 and vcodec != 'none' and filesize:
-                if not size_1080p or (acodec != 'none'):  # Prefer with audio
-                    size_1080p = filesize
-            
-            # 720p
-            if height == 720 and vcodec != 'none' and filesize:
-                if not size_720p or (acodec != 'none'):  # Prefer with audio
-                    size_720p = filesize
-            
-            # Audio only
-            if vcodec == 'none' and acodec != 'none' and filesize:
-                if not size_audio or filesize > size_audio:  # Get best audio
-                    size_audio = filesize
-
-        # -----------------------------
-        # Format Options with Sizes
-        # -----------------------------
-        if platform == "youtube":
-            formats = [
-                {
-                    "quality": "Best Quality",
-                    "format_id": "best",
-                    "ext": "mp4",
-                    "type": "video",
-                    "has_audio": True,
-                    "filesize": size_best['size'] if size_best else None,
-                    "filesize_formatted": format_filesize(size_best['size']) if size_best else "Unknown"
-                },
-                {
-                    "quality": "1080p",
-                    "format_id": "best[height<=1080]",
-                    "ext": "mp4",
-                    "type": "video",
-                    "has_audio": True,
-                    "filesize": size_1080p,
-                    "filesize_formatted": format_filesize(size_1080p) if size_1080p else "Unknown"
-                },
-                {
-                    "quality": "720p",
-                    "format_id": "best[height<=720]",
-                    "ext": "mp4",
-                    "type": "video",
-                    "has_audio": True,
-                    "filesize": size_720p,
-                    "filesize_formatted": format_filesize(size_720p) if size_720p else "Unknown"
-                },
-                {
-                    "quality": "Audio Only",
-                    "format_id": "bestaudio",
-                    "ext": "mp3",
-                    "type": "audio",
-                    "has_audio": True,
-                    "filesize": size_audio,
-                    "filesize_formatted": format_filesize(size_audio) if size_audio else "Unknown"
-                }
-            ]
+    def handoff(self, task_id, file_path, mimetype, download_name):
+        task = task_store.get(task_id)
+        if not task or not task.get('remote_key'):
+            return None  # not uploaded (yet): serve it from here
+        url = self.client.presign(task['remote_key'], app.config['S3_URL_TTL'], {
+            'response-content-disposition': f'attachment; filename="{download_name}"',
+            'response-content-type': mimetype
+        })
+        return 302, {'Location': url, 'Cache-Control': 'no-store'}
+
+    def remove(self, file_path):
+        key = self.object_key(file_path)
+        with self._lock:
+            # Thumbnails and files never handed to publish() have no object
+            if key not in self._published and key not in self._pending:
+                return
+        self._submit(key, self._delete)
+
+    def _delete(self, key):
+        with self._lock:
+            if key not in self._published:
+                return  # its upload failed or never ran
+            self._published.discard(key)
+        status = self.client.request('DELETE', key)[0]
+        if status in (200, 204):
+            self.deleted += 1
         else:
-            formats = [
-                {
-                    "quality": "Best Quality",
-                    "format_id": "best",
-                    "ext": "mp4",
-                    "type": "video",
-                    "has_audio": True,
-                    "filesize": size_best['size'] if size_best else None,
-                    "filesize_formatted": format_filesize(size_best['size']) if size_best else "Unknown"
-                },
-                {
-                    "quality": "Audio Only",
-                    "format_id": "bestaudio",
-                    "ext": "mp3",
-                    "type": "audio",
-                    "has_audio": True,
-                    "filesize": size_audio,
-                    "filesize_formatted": format_filesize(size_audio) if size_audio else "Unknown"
-                }
-            ]
+            print(f"S3 delete of {key} failed ({status})")
 
+    def stats(self):
         return {
-            "title": info.get("title", "Video"),
-            "thumbnail": thumbnail_url,
-            "duration": duration_formatted,
-            "views": views_formatted,
-            "uploader": info.get("uploader", ""),
-            "platform": platform,
-            "formats": formats,
-            "has_audio": True
+            'backend': self.name,
+            'bucket': self.client.bucket,
+            'uploaded': self.uploaded,
+            'upload_failures': self.upload_failures,
+            'deleted': self.deleted
         }
 
-    except Exception as e:
-        raise Exception(str(e))
 
+def create_delivery_backend():
+    backend = app.config['DELIVERY_BACKEND']
+    if backend == 'direct':
+        return DirectDelivery()
+    if backend in ('accel', 'sendfile'):
+        return ProxyDelivery(backend)
+    if backend == 's3':
+        return S3Delivery()
+    raise ValueError(f"Unknown DELIVERY_BACKEND: {backend}")
 
-def download_thumbnail(url, video_id):
-    try:
-        output_base = os.path.join(app.config['DOWNLOAD_FOLDER'], video_id)
 
-        cmd = [
-            "yt-dlp",
-            "--skip-download",
-            "--write-thumbnail",
-            "--convert-thumbnails", "jpg",
-            "--output", output_base,
-            url
-        ]
+delivery = create_delivery_backend()
 
-        subprocess.run(cmd, capture_output=True)
 
-        # Find generated thumbnail
-        for file in os.listdir(app.config['DOWNLOAD_FOLDER']):
-            if file.startswith(video_id) and file.endswith(".jpg"):
-                return file  # return filename only
+# -----------------------------
+# ZIP archives
+# -----------------------------
+ARCHIVE_CHUNK_SIZE = 256 * 1024
+ARCHIVE_NAME_RE = re.compile(r'[^\w\- ]+')
 
-        return None
 
-    except Exception as e:
-        print("Thumbnail download error:", str(e))
-        return None
+class _ZipSink:
+    """zipfile output that holds bytes only until they are drained
 
+    It has no seek(), so zipfile writes each entry's CRC and sizes in a data
+    descriptor after its body instead of going back to patch the header.
+    """
 
-def download_youtube_video(url, format_id, task_id, output_path, is_audio=False):
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
 
-    try:
-        download_tasks[task_id]['status'] = 'downloading'
-        download_tasks[task_id]['progress'] = 0
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
 
-        cookie_path = app.config['COOKIES_FILE']
-        use_cookies = os.path.exists(cookie_path)
-        output_template = output_path + ".%(ext)s"
+    def tell(self):
+        return self._offset
 
-        # --------------------------
-        # BUILD COMMAND
-        # --------------------------
+    def flush(self):
+        pass
 
-        if is_audio:
-            cmd = [
-                "yt-dlp",
-                "--no-check-certificates",
-                "--format", "bestaudio",
-                "--extract-audio",
-                "--audio-format", "mp3",
-                "--audio-quality", "192K",
-                "--prefer-ffmpeg",
-                "--output", output_template,
-                url
-            ]
-        else:
-            cmd = [
-                "yt-dlp",
-                "--no-check-certificates",
-                "--format", "bv*[ext=mp4]+ba[ext=m4a]/b[ext=mp4]",
-                "--merge-output-format", "mp4",
-                "--prefer-ffmpeg",
-                "--output", output_template,
-                url
-            ]
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
 
-        # Add cookies ONLY if file exists
-        if use_cookies:
-            cmd.insert(1, "--cookies")
-            cmd.insert(2, cookie_path)
 
-        print("\nStarting download:")
-        print(" ".join(cmd[:10]), "...")
+class ZipStream:
+    """A ZIP archive of stored (uncompressed) entries, built as a stream
 
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
+    Every method returns the bytes to send next, so memory use is one
+    chunk no matter how large the archive gets. Entries over 4 GB get
+    ZIP64 records.
+    """
 
-        # --------------------------
-        # PROGRESS TRACKING
-        # --------------------------
-        for line in process.stdout:
-            line = line.strip()
+    def __init__(self):
+        self._sink = _ZipSink()
+        self._zip = zipfile.ZipFile(self._sink, 'w', zipfile.ZIP_STORED)
+        self._entry = None
 
-            if "[download]" in line and "%" in line:
-                match = re.search(r"(\d+\.?\d*)%", line)
-                if match:
-                    progress = float(match.group(1))
-                    download_tasks[task_id]['progress'] = progress
+    def begin(self, name, size, mtime):
+        info = zipfile.ZipInfo(name, date_time=time.localtime(mtime)[:6])
+        info.external_attr = 0o644 << 16
+        # Known up front, so zipfile can pick ZIP64 before writing the header
+        info.file_size = size
+        self._entry = self._zip.open(info, 'w')
+        return self._sink.drain()
 
-            elif any(word in line for word in ["Merging", "Extracting", "Converting"]):
-                download_tasks[task_id]['progress'] = 95
+    def write(self, data):
+        self._entry.write(data)
+        return self._sink.drain()
 
-        process.wait()
+    def end(self):
+        self._entry.close()
+        self._entry = None
+        return self._sink.drain()
 
-        if process.returncode != 0:
-            raise Exception("yt-dlp download failed")
+    def add_text(self, name, text):
+        self._zip.writestr(name, text)
+        return self._sink.drain()
 
-        # --------------------------
-        # FIND FINAL FILE
-        # --------------------------
-        download_dir = os.path.dirname(output_path)
-        base_name = os.path.basename(output_path)
+    def finish(self):
+        self._zip.close()
+        return self._sink.drain()
 
-        found_files = [
-            os.path.join(download_dir, f)
-            for f in os.listdir(download_dir)
-            if f.startswith(base_name)
-        ]
 
-        if not found_files:
-            raise Exception("Downloaded file not found")
+def archive_entry_name(title):
+    return ARCHIVE_NAME_RE.sub('', title).strip()[:120]
 
-        final_output = max(found_files, key=os.path.getmtime)
 
-        download_tasks[task_id]['status'] = 'completed'
-        download_tasks[task_id]['progress'] = 100
-        download_tasks[task_id]['file_path'] = final_output
-        download_tasks[task_id]['file_ext'] = os.path.splitext(final_output)[1].lstrip(".")
+class ArchiveBundle:
+    """The tasks that go into one archive, handed out as they complete
+
+    A playlist archive owns its tasks: it starts them `window` at a time as
+    earlier ones finish and cancels the unfinished ones if the client goes
+    away before the archive is complete.
+    """
+
+    def __init__(self, name, task_ids=(), entries=(), download=None, window=1):
+        self.name = name
+        self.waiting = list(task_ids)
+        self.entries = deque(entries)       # (url, title) not started yet
+        self.download = download
+        self.window = window
+        self.owned = []
+        self.errors = []
+        self.complete = False
+        self._names = set()
+        self._started = 0
+
+    @property
+    def done(self):
+        return not self.waiting and not self.entries
+
+    def _start_entries(self):
+        while self.entries and len(self.waiting) < self.window:
+            url, title = self.entries[0]
+            self._started += 1
+            name = f"{self._started:03d} {archive_entry_name(title)}".strip()
+            try:
+                task_id, _ = start_download_task(
+                    url, 'youtube', None, download_name=name, **self.download
+                )
+            except SchedulerFull:
+                # Queue is full; try again on the next poll
+                self._started -= 1
+                return
+            except Exception as e:
+                self.errors.append(f"{url}: {str(e)}")
+            else:
+                self.waiting.append(task_id)
+                self.owned.append(task_id)
+            self.entries.popleft()
+
+    def poll(self):
+        """Start what fits in the window; returns [(task_id, task)] that completed since the last poll"""
+        self._start_entries()
+
+        ready, waiting = [], []
+        for task_id in self.waiting:
+            task = task_store.get(task_id)
+            if task is None:
+                self.errors.append(f"{task_id}: task not found")
+            elif task['status'] == 'completed':
+                ready.append((task_id, task))
+            elif task['status'] in TERMINAL_STATUSES:
+                self.errors.append(f"{task.get('download_name') or task_id}: {task.get('error') or task['status']}")
+            else:
+                # Waiting for it in the archive counts as watching it
+                record_poll(task_id, task)
+                waiting.append(task_id)
+        self.waiting = waiting
+        return ready
+
+    def entry_name(self, task):
+        ext = os.path.splitext(task.get('file_path') or '')[1]
+        base = task.get('download_name') or 'video'
+        name, n = base + ext, 1
+        while name in self._names:
+            n += 1
+            name = f"{base} ({n}){ext}"
+        self._names.add(name)
+        return name
+
+    def open_file(self, task_id, task):
+        """Pin and open a completed task's file; returns (fd, size, mtime) or None if it is gone"""
+        file_path = task.get('file_path')
+        file_index.acquire(file_path)
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except (OSError, TypeError):
+            file_index.release(file_path)
+            self.errors.append(f"{task.get('download_name') or task_id}: file not found")
+            return None
+        stat = os.fstat(fd)
+        return fd, stat.st_size, stat.st_mtime
+
+    def close_file(self, task_id, task, fd):
+        os.close(fd)
+        finish_file_transfer(task.get('file_path'), task_id)
+
+    def error_report(self):
+        if not self.errors:
+            return None
+        return "These items could not be added:\n\n" + "\n".join(self.errors) + "\n"
+
+    def close(self):
+        """Cancel what the archive started but never delivered"""
+        if self.complete:
+            return
+        for task_id in self.owned:
+            if task_id in self.waiting:
+                cancel_task(task_id)
+
+
+def parse_archive_request(data):
+    """Build an ArchiveBundle from {"task_ids": [...]} or {"url": <playlist>, ...}; raises ApiError"""
+    max_items = app.config['ARCHIVE_MAX_ITEMS']
+    task_ids = data.get('task_ids')
+    url = data.get('url')
+
+    if task_ids:
+        if isinstance(task_ids, str):
+            task_ids = [t for t in task_ids.split(',') if t]
+        if not isinstance(task_ids, list):
+            raise ApiError('task_ids must be a list', 400)
+        if len(task_ids) > max_items:
+            raise ApiError(f'At most {max_items} tasks per archive', 400)
+        missing = [t for t in task_ids if task_store.get(str(t)) is None]
+        if missing:
+            raise ApiError(f"Unknown task IDs: {', '.join(map(str, missing))}", 404)
+        name = f"downloads_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        return ArchiveBundle(name, task_ids=[str(t) for t in dict.fromkeys(task_ids)])
+
+    if not url:
+        raise ApiError('url or task_ids is required', 400)
+
+    url = str(url).strip()
+    if not is_playlist_url(url, get_platform(url)):
+        raise ApiError('url must be a YouTube playlist or channel', 400)
+
+    is_audio = parse_flag(data.get('is_audio'), 'is_audio')
+    audio_format = data.get('audio_format', 'mp3')
+    if is_audio and audio_format not in AUDIO_PROFILES:
+        raise ApiError(f"audio_format must be one of: {', '.join(AUDIO_PROFILES)}", 400)
 
+    try:
+        title, entries = expand_playlist(url, max_items)
+    except ApiError:
+        raise
     except Exception as e:
-        print("Download error:", str(e))
-        download_tasks[task_id]['status'] = 'failed'
-        download_tasks[task_id]['error'] = str(e)
+        raise ApiError(f"Could not list playlist: {str(e)}", 502)
+    if not entries:
+        raise ApiError('Playlist is empty', 404)
+
+    download = {'is_audio': is_audio, 'audio_format': audio_format}
+    print(f"Playlist archive: {title!r}, {len(entries)} entries")
+    return ArchiveBundle(
+        archive_entry_name(title) or 'playlist',
+        entries=entries,
+        download=download,
+        window=max(app.config['ARCHIVE_WINDOW'], 1)
+    )
+
+
+def _iter_archive_chunks(bundle, zip_stream):
+    while True:
+        ready = bundle.poll()
+
+        for task_id, task in ready:
+            opened = bundle.open_file(task_id, task)
+            if opened is None:
+                continue
+            fd, size, mtime = opened
+            try:
+                yield zip_stream.begin(bundle.entry_name(task), size, mtime)
+                offset = 0
+                while offset < size:
+                    data = os.pread(fd, min(ARCHIVE_CHUNK_SIZE, size - offset), offset)
+                    if not data:
+                        raise IOError(f"{task.get('file_path')} shrank while archiving")
+                    offset += len(data)
+                    yield zip_stream.write(data)
+                yield zip_stream.end()
+            finally:
+                bundle.close_file(task_id, task, fd)
+
+        if bundle.done:
+            break
+        if not ready:
+            # Local completions wake us; the timeout picks up other workers'
+            with progress_cond:
+                progress_cond.wait(1.0)
+
+    report = bundle.error_report()
+    if report:
+        yield zip_stream.add_text('errors.txt', report)
+    yield zip_stream.finish()
+    bundle.complete = True
+
+
+def iter_archive(bundle):
+    """Response body for an archive: each file is streamed in turn as it completes"""
+    chunks = _iter_archive_chunks(bundle, ZipStream())
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        chunks.close()
+        bundle.close()
+        BYTES_SERVED.inc(sent, endpoint='archive')
 
 
 @app.route('/api/upload-cookies', methods=['POST'])
 def upload_cookies():
-    """Upload cookie file"""
+    """Upload cookie file
+
+    Optional form fields: `platform` (default youtube) and `name`, which adds
+    or replaces that identity in the rotation pool. Without a name the file
+    is the platform's 'default' identity (COOKIES_FILE for YouTube).
+    """
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
     
     file = request.files['file']
     if not file.filename.endswith('.txt'):
         return jsonify({'error': 'Only .txt files allowed'}), 400
+
+    platform = request.form.get('platform', 'youtube')
+    name = request.form.get('name') or 'default'
+    if platform not in SUPPORTED_PLATFORMS:
+        return jsonify({'error': f"platform must be one of: {', '.join(SUPPORTED_PLATFORMS)}"}), 400
+    if not IDENTITY_NAME_RE.match(name) or name == 'anonymous':
+        return jsonify({'error': 'name may only contain letters, digits, _ and - (max 64)'}), 400
     
     try:
-        file.save(app.config['COOKIES_FILE'])
-        return jsonify({'message': 'Cookie file uploaded successfully'}), 200
+        identity_pool.save(platform, name, file)
+        identities = sum(1 for i in identity_pool.stats() if i['platform'] == platform and i['name'] != 'anonymous')
+        return jsonify({
+            'message': 'Cookie file uploaded successfully',
+            'platform': platform,
+            'identity': name,
+            'identities': identities
+        }), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -403,14 +4977,166 @@ def get_video_info():
 
     
     try:
-        # Clean up old files before processing
-        cleanup_old_files()
-        
-        info = get_video_info_universal(url, platform)
-        return jsonify(info), 200
+        # Optional start/end: size estimates for that range only
+        clip = parse_clip(data)
+        info = get_video_info_universal(url, platform, clip)
+    except ApiError as e:
+        return api_error_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+    if app.config['SPECULATIVE_PREFETCH']:
+        try:
+            speculate(url, platform)
+        except Exception as e:
+            print(f"Speculative prefetch error: {str(e)}")
+
+    return jsonify(info), 200
+
+
+@app.route('/api/video/info/batch', methods=['POST'])
+def get_video_info_batch():
+    """Get info for many URLs (playlists expanded), streamed as NDJSON"""
+    data = request.get_json() or {}
+    urls = data.get('urls')
+
+    if not isinstance(urls, list) or not urls:
+        return jsonify({'error': 'urls must be a non-empty list'}), 400
+
+    max_items = app.config['BATCH_MAX_ITEMS']
+
+    if len(urls) > max_items:
+        return jsonify({'error': f'At most {max_items} URLs per batch'}), 400
+
+    def results():
+        items = []
+
+        # -------------------------
+        # Expand playlists
+        # -------------------------
+        for url in urls:
+            url = str(url).strip()
+            if not is_playlist_url(url, get_platform(url)):
+                items.append(url)
+                continue
+
+            try:
+                title, entries = expand_playlist(url, max_items - len(items))
+                items.extend(entry_url for entry_url, _ in entries)
+                yield json.dumps({'url': url, 'status': 'playlist', 'title': title, 'entries': len(entries)}) + "\n"
+            except Exception as e:
+                yield json.dumps({'url': url, 'status': 'error', 'error': str(e)}) + "\n"
+
+            if len(items) >= max_items:
+                break
+
+        # -------------------------
+        # Extract in parallel, emit in completion order
+        # -------------------------
+        futures = {
+            _batch_executor.submit(_batch_item, url): (index, url)
+            for index, url in enumerate(items[:max_items])
+        }
+
+        try:
+            for future in as_completed(futures):
+                index, url = futures[future]
+                try:
+                    line = {'index': index, 'url': url, 'status': 'ok', 'info': future.result()}
+                except Exception as e:
+                    line = {'index': index, 'url': url, 'status': 'error', 'error': str(e)}
+                    if isinstance(e, RateLimited):
+                        line['retry_after'] = e.retry_after
+                yield json.dumps(line) + "\n"
+        finally:
+            # Client went away: don't extract what nobody will read
+            for future in futures:
+                future.cancel()
+
+    return Response(
+        results(),
+        mimetype='application/x-ndjson',
+        headers={'X-Accel-Buffering': 'no'}
+    )
+
+
+def start_download_task(url, platform, format_id, is_audio, audio_format, clip=None, thumbnail_file=None,
+                        download_name=None, info_token=None):
+    """Create a task for a download and attach it to its artifact, starting the download if needed
+
+    Returns (task_id, artifact); raises SchedulerFull (and creates nothing)
+    when the download would have to start but the queue is full.
+    """
+    video_key = get_video_key(url, platform)
+    task_id = str(uuid.uuid4())
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = download_name or f"{'audio' if is_audio else 'video'}_{timestamp}_{task_id[:8]}"
+    key = get_artifact_key(video_key, is_audio, audio_format, clip)
+    format_popularity.record(platform, download_choice(is_audio, audio_format))
+
+    task_store.create(task_id, {
+        'status': 'pending',
+        'progress': 0,
+        'url': url,
+        'format_id': format_id,
+        'is_audio': is_audio,
+        'audio_format': audio_format if is_audio else None,
+        'thumbnail_file': thumbnail_file,
+        'download_name': filename,
+        'artifact_key': key,
+        'clip': clip,
+        'created_at': datetime.now().isoformat(),
+        'last_polled': time.time()
+    })
+
+    # Identical downloads share one artifact: reuse a finished file or
+    # attach to the download already in flight
+    artifact, is_owner = claim_artifact(key, task_id)
+
+    print(f"\n{'='*60}")
+    print(f"New download request:")
+    print(f"  Type: {f'AUDIO ({audio_format.upper()})' if is_audio else 'VIDEO (MP4)'}")
+    print(f"  Format: {format_id}")
+    if clip:
+        print(f"  Clip: {format_clip_time(clip['start'])}s - {format_clip_time(clip['end'])}s"
+              f" ({'accurate' if clip['accurate'] else 'keyframe'} cut)")
+    print(f"  Task ID: {task_id}")
+    print(f"  Output: {artifact['output_path']}")
+    print(f"  Artifact: {'new' if is_owner else artifact['status']}")
+    print(f"{'='*60}\n")
+
+    if is_owner:
+        if not download_scheduler.has_room(platform):
+            # Real downloads never wait behind a guess
+            preempt_speculative(platform)
+        params = {
+            'url': url,
+            'platform': platform,
+            'format_id': format_id,
+            'is_audio': is_audio,
+            'video_key': video_key,
+            'audio_format': audio_format,
+            'clip': clip,
+            'info_token': info_token
+        }
+        try:
+            submit_download(artifact, params, task_id)
+        except SchedulerFull:
+            fail_artifact(artifact, "Download queue is full, try again later", cause='queue_full')
+            task_store.delete(task_id)
+            raise
+    else:
+        with artifact_lock:
+            task_store.update(task_id, **{
+                field: artifact[field]
+                for field in ARTIFACT_TASK_FIELDS
+                if field in artifact
+            })
+
+    # Survives a restart from here on
+    download_journal.record(artifact)
+    return task_id, artifact
+
 
 @app.route('/api/video/download', methods=['POST'])
 def initiate_download():
@@ -419,54 +5145,56 @@ def initiate_download():
     url = data.get('url')
     format_id = data.get('format_id', 'bestvideo+bestaudio/best')
     is_audio = data.get('is_audio', False)
+    # m4a/opus are served as downloaded (remux at most); mp3 is re-encoded
+    audio_format = data.get('audio_format', 'mp3')
     
     if not url:
         return jsonify({'error': 'URL is required'}), 400
+
+    if is_audio and audio_format not in AUDIO_PROFILES:
+        return jsonify({'error': f"audio_format must be one of: {', '.join(AUDIO_PROFILES)}"}), 400
     
     platform = get_platform(url)
 
     if not platform:
       return jsonify({'error': 'Only YouTube or Instagram supported'}), 400
 
+    # info_token (from /api/video/info): start from the info the client was
+    # shown. One that has expired is ignored and the video extracted again
+    video_key = get_video_key(url, platform)
+    info_token = data.get('info_token')
+    token_info = load_info_token(info_token) if info_token else None
+    if token_info and token_info.get('_video_key') != video_key:
+        return jsonify({'error': 'info_token does not match url'}), 400
+
+    # Optional start/end (seconds or HH:MM:SS): download only that range
+    try:
+        cached_info = token_info or info_cache.get(video_key)
+        clip = bound_clip(parse_clip(data), cached_info and cached_info.get('duration'))
+    except ApiError as e:
+        return api_error_response(e)
+
     
     try:
         # Validate format_id for audio downloads
         if is_audio and not format_id:
             format_id = 'bestaudio/best'
-        
-        task_id = str(uuid.uuid4())
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"{'audio' if is_audio else 'video'}_{timestamp}_{task_id[:8]}"
-        output_path = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
-        
-        print(f"\n{'='*60}")
-        print(f"New download request:")
-        print(f"  Type: {'AUDIO (MP3)' if is_audio else 'VIDEO (MP4)'}")
-        print(f"  Format: {format_id}")
-        print(f"  Task ID: {task_id}")
-        print(f"  Output: {output_path}")
-        print(f"{'='*60}\n")
-        
-        download_tasks[task_id] = {
-            'status': 'pending',
-            'progress': 0,
-            'url': url,
-            'format_id': format_id,
-            'is_audio': is_audio,
-            'thumbnail_file': data.get('thumbnail_file'),
-            'created_at': datetime.now().isoformat()
-        }
-        
-        thread = threading.Thread(
-            target=download_youtube_video,
-            args=(url, format_id, task_id, output_path, is_audio)
-        )
-        thread.daemon = True
-        thread.start()
-        
+
+        try:
+            task_id, artifact = start_download_task(
+                url, platform, format_id, is_audio, audio_format, clip,
+                thumbnail_file=data.get('thumbnail_file'),
+                info_token=info_token if token_info else None
+            )
+        except SchedulerFull as e:
+            response = jsonify({'error': str(e)})
+            response.headers['Retry-After'] = str(round(download_scheduler.average_duration()))
+            return response, 503
+        message = 'Download ready' if artifact['status'] == 'completed' else 'Download started'
+
         return jsonify({
             'task_id': task_id,
-            'message': 'Download started',
+            'message': message,
             'is_audio': is_audio,
         }), 202
         
@@ -478,130 +5206,347 @@ def initiate_download():
 @app.route('/api/video/status/<task_id>', methods=['GET'])
 def get_download_status(task_id):
     """Check download status"""
-    if task_id not in download_tasks:
+    task = task_store.get(task_id)
+
+    if task is None:
         return jsonify({'error': 'Task not found'}), 404
-    
-    task = download_tasks[task_id]
-    
-    return jsonify({
+
+    record_poll(task_id, task)
+    return jsonify(status_payload(task)), 200
+
+
+@app.route('/api/video/task/<task_id>', methods=['DELETE'])
+def delete_task(task_id):
+    """Cancel a download task, stopping its download unless another task shares it"""
+    if cancel_task(task_id) is None:
+        return jsonify({'error': 'Task not found'}), 404
+
+    return jsonify({'task_id': task_id, 'status': 'cancelled'}), 200
+
+
+def status_payload(task):
+    """/api/video/status response body for a task"""
+    status = {
         'status': task.get('status'),
         'progress': task.get('progress', 0),
         'error': task.get('error')
-    }), 200
+    }
+    for field in PROGRESS_FIELDS[1:] + ('throughput', 'rate_limit'):
+        if task.get(field) is not None:
+            status[field] = task[field]
+    if task.get('retry_after') and (task.get('phase') == 'rate_limited' or task.get('status') == 'failed'):
+        status['retry_after'] = task['retry_after']
 
+    if task.get('status') == 'pending':
+        queued = download_scheduler.position(task.get('artifact_key'))
+        if queued:
+            position, wait_seconds = queued
+            status['queue_position'] = position
+            status['estimated_wait'] = wait_seconds
+            status['estimated_start'] = datetime.fromtimestamp(time.time() + wait_seconds).isoformat()
 
-@app.route('/api/video/file/<task_id>', methods=['GET'])
-def download_file(task_id):
+    return status
+
+
+def _progress_snapshot(task):
+    snapshot = {
+        'status': task.get('status'),
+        'progress': task.get('progress', 0),
+        'error': task.get('error'),
+    }
+    for field in PROGRESS_FIELDS[1:]:
+        snapshot[field] = task.get(field)
+    return snapshot
+
+
+def progress_event(task):
+    """One Server-Sent Events message carrying a task's progress"""
+    return f"id: {task.get('updated_at') or 0}\nevent: progress\ndata: {json.dumps(_progress_snapshot(task))}\n\n"
+
+
+def parse_long_poll(args):
+    """(since, wait) from ?since=&wait= query args; raises ApiError"""
+    try:
+        since = float(args.get('since') or 0)
+        wait = min(float(args.get('wait') or 25), 60)
+    except ValueError:
+        raise ApiError('since and wait must be numbers', 400)
+    if not math.isfinite(since) or not math.isfinite(wait) or wait < 0:
+        raise ApiError('since and wait must be numbers', 400)
+    return since, wait
+
+
+progress_stream_slots = threading.BoundedSemaphore(app.config['MAX_PROGRESS_STREAMS'])
+
+
+def _wait_for_progress(task_id, since, timeout):
+    """Block until the task changes after `since` (its updated_at) or timeout; returns the task"""
+    deadline = time.time() + timeout
+
+    while True:
+        task = task_store.get(task_id)
+        if task is None or (task.get('updated_at') or 0) > since or task.get('status') in TERMINAL_STATUSES:
+            return task
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return task
+
+        # Local updates wake us immediately; the timeout picks up changes
+        # written by other worker processes
+        with progress_cond:
+            progress_cond.wait(min(remaining, 1.0))
+
+
+@app.route('/api/video/progress/<task_id>', methods=['GET'])
+def stream_progress(task_id):
+    """Push task progress as Server-Sent Events (or long-poll with ?wait=)"""
+    task = task_store.get(task_id)
+
+    if task is None:
+        return jsonify({'error': 'Task not found'}), 404
 
     # -------------------------
-    # Validate Task
+    # Long-poll fallback
     # -------------------------
-    if task_id not in download_tasks:
-        return jsonify({'error': 'Task not found'}), 404
+    if 'wait' in request.args:
+        try:
+            since, wait = parse_long_poll(request.args)
+        except ApiError as e:
+            return api_error_response(e)
+        task = _wait_for_progress(task_id, since, wait)
+        if task is None:
+            return jsonify({'error': 'Task not found'}), 404
+        record_poll(task_id, task)
+        snapshot = _progress_snapshot(task)
+        snapshot['updated_at'] = task.get('updated_at') or 0
+        return jsonify(snapshot), 200
 
-    task = download_tasks[task_id]
+    # -------------------------
+    # Server-Sent Events
+    # -------------------------
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
 
-    if task.get('status') != 'completed':
-        return jsonify({'error': 'Download not completed'}), 400
+    if not progress_stream_slots.acquire(blocking=False):
+        # Every stream slot is taken: send the current state and let
+        # EventSource reconnect later instead of holding a thread
+        record_poll(task_id, task)
+        retry = f"retry: {app.config['PROGRESS_RETRY_MS']}\n"
+        return Response(retry + progress_event(task), mimetype='text/event-stream', headers=headers)
 
-    file_path = task.get('file_path')
+    def events():
+        since = -1
+        started = time.time()
+        last_sent = time.time()
 
-    if not file_path or not os.path.exists(file_path):
+        while time.time() - started < app.config['PROGRESS_STREAM_TIMEOUT']:
+            task = _wait_for_progress(task_id, since, 15)
+            if task is None:
+                yield "event: error\ndata: {\"error\": \"Task not found\"}\n\n"
+                return
+            # An open stream counts as polling
+            record_poll(task_id, task)
+
+            updated_at = task.get('updated_at') or 0
+            if updated_at > since:
+                since = max(updated_at, 0)
+                last_sent = time.time()
+                yield progress_event(task)
+            elif time.time() - last_sent >= 15:
+                last_sent = time.time()
+                yield ": keepalive\n\n"
+
+            if task.get('status') in TERMINAL_STATUSES:
+                return
+
+    response = Response(events(), mimetype='text/event-stream', headers=headers)
+    # Runs even if the client disconnects before the body is iterated
+    response.call_on_close(progress_stream_slots.release)
+    return response
+
+
+@app.route('/api/video/file/<task_id>', methods=['GET'])
+def download_file(task_id):
+    started = time.perf_counter()
+
+    try:
+        file_path, mimetype, download_name = locate_task_file(task_id)
+    except ApiError as e:
+        return api_error_response(e)
+
+    handoff = delivery.handoff(task_id, file_path, mimetype, download_name)
+    if handoff:
+        status, headers = handoff
+        finish_file_transfer(file_path, task_id, pinned=False)
+        DELIVERIES.inc(backend=delivery.name)
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='file_ttfb')
+        return Response(status=status, headers=headers)
+
+    # The file stays pinned in the janitor's index while any client is still
+    # reading it
+    file_index.acquire(file_path)
+    DELIVERIES.inc(backend='direct')
+
+    try:
+        response = send_media_file(
+            file_path,
+            mimetype,
+            download_name=download_name,
+            on_close=lambda: finish_file_transfer(file_path, task_id)
+        )
+        # Time until the body is ready to go out (the rest is the network)
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='file_ttfb')
+        return response
+    except FileNotFoundError:
+        # Evicted between the existence check and open()
+        file_index.release(file_path)
         return jsonify({'error': 'File not found'}), 404
 
-    # -------------------------
-    # Determine MIME Type
-    # -------------------------
-    actual_ext = os.path.splitext(file_path)[1].lower().lstrip('.')
-
-    mime_types = {
-        'mp3': 'audio/mpeg',
-        'mp4': 'video/mp4',
-        'm4a': 'audio/mp4',
-        'webm': 'video/webm',
-        'mkv': 'video/x-matroska',
-    }
 
-    mimetype = mime_types.get(actual_ext, 'application/octet-stream')
+wsgi_archive_slots = threading.BoundedSemaphore(app.config['MAX_WSGI_ARCHIVES'])
 
-    print("\nSending file to client:")
-    print(f"  Path: {file_path}")
-    print(f"  MIME: {mimetype}")
 
-    # -------------------------
-    # DELAYED CLEANUP THREAD
-    # -------------------------
-    def delayed_cleanup(path, task_id):
-        time.sleep(5)  # allow file stream to finish
+@app.route('/api/video/archive', methods=['GET', 'POST'])
+def download_archive():
+    """Stream one ZIP of several tasks' files, or of a whole playlist as it downloads"""
+    data = request.get_json(silent=True) if request.method == 'POST' else request.args
 
-        try:
-            task = download_tasks.get(task_id)
+    if not wsgi_archive_slots.acquire(blocking=False):
+        return api_error_response(ApiError('Too many archives in progress, try again later', 503))
 
-            # Delete video/audio file
-            if os.path.exists(path):
-                os.remove(path)
-                print(f"✓ Deleted file: {path}")
+    try:
+        bundle = parse_archive_request(data or {})
+    except ApiError as e:
+        wsgi_archive_slots.release()
+        return api_error_response(e)
+    except Exception:
+        wsgi_archive_slots.release()
+        raise
 
-            # Delete thumbnail file (SAFE METHOD)
-            if task:
-                thumb_file = task.get('thumbnail_file')
+    response = Response(
+        iter_archive(bundle),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{bundle.name}.zip"',
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no'
+        }
+    )
 
-                if thumb_file:
-                    thumb_path = os.path.join(app.config['DOWNLOAD_FOLDER'], thumb_file)
+    def close():
+        # iter_archive's own cleanup never runs if the body was never iterated
+        bundle.close()
+        wsgi_archive_slots.release()
 
-                    if os.path.exists(thumb_path):
-                        os.remove(thumb_path)
-                        print(f"✓ Deleted thumbnail: {thumb_path}")
+    response.call_on_close(close)
+    return response
 
-            # Remove task
-            if task_id in download_tasks:
-                del download_tasks[task_id]
-                print(f"✓ Removed task: {task_id}")
 
-        except Exception as e:
-            print(f"Cleanup error: {str(e)}")
+@app.route('/api/video/stream', methods=['GET'])
+def stream_video():
+    """Stream a video or audio track to the client while it downloads"""
+    url = request.args.get('url')
+    is_audio = request.args.get('is_audio', 'false').lower() in ('1', 'true', 'yes')
+    audio_format = request.args.get('audio_format', 'mp3')
 
-    threading.Thread(
-        target=delayed_cleanup,
-        args=(file_path, task_id),
-        daemon=True
-    ).start()
+    try:
+        cmd, plan, filename, release_stream = prepare_stream(url, is_audio, audio_format)
+    except ApiError as e:
+        return api_error_response(e)
 
-    # -------------------------
-    # Send File
-    # -------------------------
-    return send_file(
-        file_path,
-        as_attachment=True,
-        download_name=os.path.basename(file_path),
-        mimetype=mimetype
+    response = Response(
+        stream_process_output(cmd),
+        mimetype=plan['mimetype'],
+        headers={
+            'Content-Disposition': f'attachment; filename={filename}',
+            'X-Accel-Buffering': 'no'
+        }
     )
+    # Runs even if the client disconnects before the body is iterated
+    response.call_on_close(release_stream)
+    return response
 
 
 @app.route('/api/thumbnail/<filename>', methods=['GET'])
 def serve_thumbnail(filename):
-    """Serve downloaded thumbnail"""
+    """Serve a thumbnail, optionally resized (?size=<px>) and re-encoded (?format=webp|jpeg)"""
     try:
-        filepath = os.path.join(app.config['DOWNLOAD_FOLDER'], filename)
-        
-        if not os.path.exists(filepath):
+        variant = thumbnail_variant_name(filename, request.args.get('size'), request.args.get('format'))
+    except ApiError as e:
+        return api_error_response(e)
+
+    try:
+        image = load_thumbnail(filename, variant)
+
+        if not image:
             return jsonify({'error': 'Thumbnail not found'}), 404
-        
-        return send_file(filepath, mimetype='image/jpeg')
+
+        headers = thumbnail_headers(image)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(image['etag'])
+        else:
+            not_modified = bool(request.if_modified_since) and image['mtime'] <= request.if_modified_since.timestamp()
+        if not_modified:
+            return Response(status=304, headers=headers)
+
+        BYTES_SERVED.inc(len(image['body']), endpoint='serve_thumbnail')
+        return Response(image['body'], mimetype=image['mimetype'], headers=headers)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+metrics.register(Gauge(
+    'video_api_tasks',
+    'Tasks in the task store by status',
+    ('status',),
+    collect=lambda: {(str(status),): n for status, n in task_store.count_by_status().items()}
+))
+metrics.register(Gauge(
+    'video_api_active_downloads',
+    'Downloads holding a scheduler slot',
+    collect=lambda: {(): download_scheduler.stats()['running']}
+))
+metrics.register(Gauge(
+    'video_api_queued_downloads',
+    'Downloads waiting for a scheduler slot',
+    collect=lambda: {(): download_scheduler.stats()['queued']}
+))
+metrics.register(Gauge(
+    'video_api_download_folder_bytes',
+    'Bytes of indexed files in the download folder',
+    collect=lambda: {(): file_index.stats()['bytes']}
+))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({
         'status': 'healthy',
         'cookie_exists': os.path.exists(app.config['COOKIES_FILE']),
-        'total_tasks': len(download_tasks),
+        'total_tasks': task_store.count(),
+        'task_store': app.config['TASK_STORE'],
+        'info_cache': info_cache.stats(),
+        'scheduler': download_scheduler.stats(),
+        'bandwidth': bandwidth_budget.stats(),
+        'speculation': speculation_stats(),
+        'rate_limits': {platform: bucket.stats() for platform, bucket in platform_buckets.items()},
+        'identities': identity_pool.stats(),
+        'journaled_downloads': len(download_journal.entries()),
+        'delivery': delivery.stats(),
+        'thumbnail_cache': thumbnail_cache.stats(),
+        'download_folder_usage': file_index.stats(),
         'download_folder': app.config['DOWNLOAD_FOLDER']
     }), 200
 
 
+start_janitor()
+
+
 if __name__ == "__main__":
     print("=" * 60)
     print("Video Download API - Enhanced Version")
@@ -0,0 +1,614 @@
+"""Asynchronous (ASGI) serving mode
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker --workers 1
+    uvicorn asgi:app --port 5000
+
+Run one worker per download folder: downloads, the artifact cache and
+the scheduler belong to the process that started them (see app.py).
+
+The endpoints that hold connections open -- status polls, progress
+streams, file transfers, ZIP archives, progressive streams and
+thumbnails -- run on the event loop, so a slow client costs a coroutine
+instead of a thread. yt-dlp downloads are supervised with asyncio
+subprocesses on the same loop.
+Everything else is the Flask app (app.py) behind a WSGI bridge; running
+`gunicorn app:app` directly remains the compatibility mode.
+"""
+
+import asyncio
+import json
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.http import http_date, parse_date, parse_etags, parse_if_range_header, parse_range_header
+
+import app as api
+
+FILE_CHUNK_SIZE = 256 * 1024
+KEEPALIVE_INTERVAL = 15
+
+wsgi_app = WSGIMiddleware(api.app, workers=int(os.environ.get('ASGI_WSGI_THREADS', 8)))
+
+
+# -----------------------------
+# Event loop integration
+# -----------------------------
+class ProgressBroadcast:
+    """Wakes every coroutine waiting for a progress change"""
+
+    def __init__(self):
+        self._event = asyncio.Event()
+
+    def notify(self):
+        self._event.set()
+        self._event = asyncio.Event()
+
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+progress_broadcast = None
+
+
+def kill(process):
+    if process.returncode is None:
+        api.kill_process_group(process.pid)
+
+
+async def spawn(cmd, prefix=None, **kwargs):
+    """api.spawn_process for the event loop: own process group, recorded until exit"""
+    api.count_spawn(cmd)
+    process = await asyncio.create_subprocess_exec(*cmd, start_new_session=True, **kwargs)
+    api.process_registry.register(process.pid, cmd, prefix)
+    return process
+
+
+async def supervise_ytdlp(cmd, tracker):
+    """Run a yt-dlp download on the event loop, feeding its output to tracker"""
+    process = await spawn(
+        cmd,
+        prefix=tracker.artifact['output_path'],
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=1024 * 1024
+    )
+    loop = asyncio.get_running_loop()
+    tracker.set_stop(lambda: loop.call_soon_threadsafe(kill, process))
+    try:
+        async for line in process.stdout:
+            tracker.feed_line(line.decode('utf-8', errors='replace'))
+        return await process.wait()
+    finally:
+        tracker.set_stop(None)
+        if process.returncode is None:
+            kill(process)
+            await process.wait()
+        api.process_exited(process.pid)
+
+
+def start(loop):
+    """Hook the Flask module up to this event loop (once per process)"""
+    global progress_broadcast
+    if progress_broadcast is not None:
+        return
+
+    progress_broadcast = ProgressBroadcast()
+    api.progress_listeners.append(lambda: loop.call_soon_threadsafe(progress_broadcast.notify))
+
+    # Download jobs still hold their scheduler slot on a worker thread, but
+    # the process and its output are handled here
+    api.download_supervisor = lambda cmd, tracker: asyncio.run_coroutine_threadsafe(
+        supervise_ytdlp(cmd, tracker), loop
+    ).result()
+
+
+async def blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+async def cleanup(fn, *args):
+    """blocking() for cleanup on the way out: runs to the end even if the request is cancelled again"""
+    await asyncio.shield(blocking(fn, *args))
+
+
+async def load_task(task_id):
+    # The in-memory store is a dict lookup; SQLite may touch the disk
+    if api.app.config['TASK_STORE'] == 'memory':
+        return api.task_store.get(task_id)
+    return await blocking(api.task_store.get, task_id)
+
+
+# -----------------------------
+# Responses
+# -----------------------------
+BASE_HEADERS = [(b'access-control-allow-origin', b'*')]
+
+
+async def send_start(send, status, headers):
+    encoded = [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()]
+    await send({'type': 'http.response.start', 'status': status, 'headers': BASE_HEADERS + encoded})
+
+
+async def send_json(send, payload, status=200, headers=None):
+    body = json.dumps(payload).encode()
+    await send_start(send, status, dict(headers or {}, **{'Content-Type': 'application/json', 'Content-Length': len(body)}))
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_api_error(send, e):
+    headers = {'Retry-After': e.retry_after} if isinstance(e, api.RateLimited) else None
+    await send_json(send, {'error': str(e)}, e.status, headers)
+
+
+class Disconnect:
+    """Watches the receive channel so long responses stop when the client leaves"""
+
+    def __init__(self, receive):
+        self.event = asyncio.Event()
+        self._task = asyncio.ensure_future(self._watch(receive))
+
+    async def _watch(self, receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                self.event.set()
+                return
+
+    def is_set(self):
+        return self.event.is_set()
+
+    def close(self):
+        self._task.cancel()
+
+
+async def send_file(scope, receive, send, file_path, mimetype, download_name=None, cache_control=None):
+    """Async counterpart of send_media_file: conditional GET and a single Range
+
+    Returns the number of body bytes sent. Multi-range requests never get
+    here; they are handed to the Flask app.
+    """
+    headers_in = scope['headers_dict']
+    stat = os.stat(file_path)
+    size = stat.st_size
+    mtime = int(stat.st_mtime)
+    etag = f"{mtime:x}-{size:x}"
+
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(mtime),
+        'Accept-Ranges': 'bytes'
+    }
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    if download_name:
+        headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+
+    # -------------------------
+    # Conditional GET
+    # -------------------------
+    if_none_match = parse_etags(headers_in.get('if-none-match'))
+    if_modified_since = parse_date(headers_in.get('if-modified-since'))
+    if headers_in.get('if-none-match'):
+        not_modified = if_none_match.contains_weak(etag)
+    else:
+        not_modified = bool(if_modified_since) and mtime <= if_modified_since.timestamp()
+
+    if not_modified:
+        await send_start(send, 304, headers)
+        await send({'type': 'http.response.body', 'body': b''})
+        return 0
+
+    # -------------------------
+    # Range
+    # -------------------------
+    byte_range = parse_range_header(headers_in.get('range'))
+    if_range = parse_if_range_header(headers_in.get('if-range'))
+    if byte_range and (if_range.etag or if_range.date):
+        if if_range.etag:
+            still_valid = if_range.etag == etag
+        else:
+            still_valid = mtime <= if_range.date.timestamp()
+        if not still_valid:
+            byte_range = None
+
+    status, start, stop = 200, 0, size
+    if byte_range and byte_range.units == 'bytes':
+        ranges = api._satisfiable_ranges(byte_range, size)
+        if not ranges:
+            headers['Content-Range'] = f"bytes */{size}"
+            await send_start(send, 416, headers)
+            await send({'type': 'http.response.body', 'body': b''})
+            return 0
+        if ranges[0] != (0, size):
+            status, (start, stop) = 206, ranges[0]
+            headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+
+    headers['Content-Type'] = mimetype
+    headers['Content-Length'] = stop - start
+
+    # -------------------------
+    # Body
+    # -------------------------
+    fd = os.open(file_path, os.O_RDONLY)
+    disconnect = Disconnect(receive)
+    sent = 0
+    try:
+        await send_start(send, status, headers)
+        offset = start
+        while offset < stop and not disconnect.is_set():
+            chunk = await blocking(os.pread, fd, min(FILE_CHUNK_SIZE, stop - offset), offset)
+            if not chunk:
+                break
+            offset += len(chunk)
+            # Awaiting send is the backpressure: a slow client parks this
+            # coroutine, not a thread
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            sent += len(chunk)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnect.close()
+        os.close(fd)
+
+    return sent
+
+
+# -----------------------------
+# Endpoints
+# -----------------------------
+async def video_status(scope, receive, send, task_id):
+    task = await load_task(task_id)
+
+    if task is None:
+        return await send_json(send, {'error': 'Task not found'}, 404)
+
+    await blocking(api.record_poll, task_id, task)
+    await send_json(send, api.status_payload(task))
+
+
+async def wait_for_progress(task_id, since, timeout):
+    """Async _wait_for_progress: returns the task once it changes after since"""
+    deadline = time.time() + timeout
+
+    while True:
+        task = await load_task(task_id)
+        if task is None or (task.get('updated_at') or 0) > since or task.get('status') in api.TERMINAL_STATUSES:
+            return task
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return task
+
+        # Local updates wake us immediately; the timeout picks up changes
+        # written by other worker processes
+        await progress_broadcast.wait(min(remaining, 1.0))
+
+
+async def video_progress(scope, receive, send, task_id):
+    task = await load_task(task_id)
+
+    if task is None:
+        return await send_json(send, {'error': 'Task not found'}, 404)
+
+    query = scope['query']
+
+    # -------------------------
+    # Long-poll fallback
+    # -------------------------
+    if 'wait' in query:
+        try:
+            since, wait = api.parse_long_poll(query)
+        except api.ApiError as e:
+            return await send_api_error(send, e)
+        task = await wait_for_progress(task_id, since, wait)
+        if task is None:
+            return await send_json(send, {'error': 'Task not found'}, 404)
+        await blocking(api.record_poll, task_id, task)
+        snapshot = api._progress_snapshot(task)
+        snapshot['updated_at'] = task.get('updated_at') or 0
+        return await send_json(send, snapshot)
+
+    # -------------------------
+    # Server-Sent Events
+    # -------------------------
+    await send_start(send, 200, {
+        'Content-Type': 'text/event-stream; charset=utf-8',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+    disconnect = Disconnect(receive)
+    since = -1
+    started = last_sent = time.time()
+    try:
+        while time.time() - started < api.app.config['PROGRESS_STREAM_TIMEOUT'] and not disconnect.is_set():
+            task = await wait_for_progress(task_id, since, KEEPALIVE_INTERVAL)
+            if task is None:
+                message = "event: error\ndata: {\"error\": \"Task not found\"}\n\n"
+                await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+                break
+            # An open stream counts as polling
+            await blocking(api.record_poll, task_id, task)
+
+            updated_at = task.get('updated_at') or 0
+            if updated_at > since:
+                since = max(updated_at, 0)
+                last_sent = time.time()
+                message = api.progress_event(task)
+            elif time.time() - last_sent >= KEEPALIVE_INTERVAL:
+                last_sent = time.time()
+                message = ": keepalive\n\n"
+            else:
+                message = None
+
+            if message:
+                await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+
+            if task.get('status') in api.TERMINAL_STATUSES:
+                break
+    finally:
+        disconnect.close()
+
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def video_file(scope, receive, send, task_id):
+    started = time.perf_counter()
+
+    try:
+        file_path, mimetype, download_name = await blocking(api.locate_task_file, task_id)
+    except api.ApiError as e:
+        return await send_api_error(send, e)
+
+    handoff = await blocking(api.delivery.handoff, task_id, file_path, mimetype, download_name)
+    if handoff:
+        status, headers = handoff
+        await send_start(send, status, dict(headers, **{'Content-Length': 0}))
+        await send({'type': 'http.response.body', 'body': b''})
+        api.DELIVERIES.inc(backend=api.delivery.name)
+        api.STAGE_SECONDS.observe(time.perf_counter() - started, stage='file_ttfb')
+        return await blocking(api.finish_file_transfer, file_path, task_id, False)
+
+    # Pinned against the janitor for as long as the transfer runs
+    api.file_index.acquire(file_path)
+    api.DELIVERIES.inc(backend='direct')
+    api.STAGE_SECONDS.observe(time.perf_counter() - started, stage='file_ttfb')
+    try:
+        sent = await send_file(scope, receive, send, file_path, mimetype, download_name=download_name)
+    except FileNotFoundError:
+        # Evicted between the existence check and open()
+        api.file_index.release(file_path)
+        return await send_json(send, {'error': 'File not found'}, 404)
+    except BaseException:
+        await cleanup(api.finish_file_transfer, file_path, task_id)
+        raise
+
+    api.BYTES_SERVED.inc(sent, endpoint='download_file')
+    await blocking(api.finish_file_transfer, file_path, task_id)
+
+
+async def thumbnail(scope, receive, send, filename):
+    query = scope['query']
+    try:
+        variant = api.thumbnail_variant_name(filename, query.get('size'), query.get('format'))
+    except api.ApiError as e:
+        return await send_api_error(send, e)
+
+    # Hot images come straight from memory, without a thread hop
+    image = api.cached_thumbnail(variant) or await blocking(api.load_thumbnail, filename, variant)
+    if not image:
+        return await send_json(send, {'error': 'Thumbnail not found'}, 404)
+
+    headers = api.thumbnail_headers(image)
+    headers_in = scope['headers_dict']
+    if_none_match = parse_etags(headers_in.get('if-none-match'))
+    if headers_in.get('if-none-match'):
+        not_modified = if_none_match.contains_weak(image['etag'])
+    else:
+        since = parse_date(headers_in.get('if-modified-since'))
+        not_modified = since is not None and image['mtime'] <= since.timestamp()
+    if not_modified:
+        await send_start(send, 304, headers)
+        return await send({'type': 'http.response.body', 'body': b''})
+
+    headers['Content-Type'] = image['mimetype']
+    headers['Content-Length'] = str(len(image['body']))
+    await send_start(send, 200, headers)
+    await send({'type': 'http.response.body', 'body': image['body']})
+    api.BYTES_SERVED.inc(len(image['body']), endpoint='serve_thumbnail')
+
+
+async def video_stream(scope, receive, send):
+    query = scope['query']
+    url = query.get('url')
+    is_audio = query.get('is_audio', 'false').lower() in ('1', 'true', 'yes')
+    audio_format = query.get('audio_format', 'mp3')
+
+    try:
+        cmd, plan, filename, release_stream = await blocking(api.prepare_stream, url, is_audio, audio_format)
+    except api.ApiError as e:
+        return await send_api_error(send, e)
+
+    disconnect = Disconnect(receive)
+    process = None
+    try:
+        try:
+            process = await spawn(cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        except OSError as e:
+            api.FAILURES.inc(cause='stream')
+            return await send_json(send, {'error': str(e)}, 500)
+
+        await send_start(send, 200, {
+            'Content-Type': plan['mimetype'],
+            'Content-Disposition': f'attachment; filename={filename}',
+            'X-Accel-Buffering': 'no'
+        })
+
+        chunk_size = api.app.config['STREAM_CHUNK_SIZE']
+        while not disconnect.is_set():
+            chunk = await process.stdout.read(chunk_size)
+            if not chunk:
+                break
+            api.BYTES_SERVED.inc(len(chunk), endpoint='stream')
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        await send({'type': 'http.response.body', 'body': b''})
+
+        if not disconnect.is_set():
+            await process.wait()
+            if process.returncode != 0:
+                print(f"Stream process exited with {process.returncode}: {cmd[0]}")
+                api.FAILURES.inc(cause='stream')
+    finally:
+        # Client went away or we finished: never leave it running
+        disconnect.close()
+        if process:
+            if process.returncode is None:
+                kill(process)
+                await process.wait()
+            api.process_exited(process.pid)
+        release_stream()
+
+
+async def send_archive_entry(send, disconnect, zip_stream, bundle, task_id, task):
+    """Send one completed task's file as a ZIP entry; returns the bytes sent"""
+    opened = await blocking(bundle.open_file, task_id, task)
+    if opened is None:
+        return 0
+    fd, size, mtime = opened
+
+    sent = 0
+
+    async def emit(chunk):
+        nonlocal sent
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        sent += len(chunk)
+
+    try:
+        await emit(zip_stream.begin(bundle.entry_name(task), size, mtime))
+        offset = 0
+        while offset < size and not disconnect.is_set():
+            data = await blocking(os.pread, fd, min(FILE_CHUNK_SIZE, size - offset), offset)
+            if not data:
+                raise IOError(f"{task.get('file_path')} shrank while archiving")
+            offset += len(data)
+            await emit(zip_stream.write(data))
+        if offset >= size:
+            await emit(zip_stream.end())
+    except BaseException:
+        await cleanup(bundle.close_file, task_id, task, fd)
+        raise
+
+    await blocking(bundle.close_file, task_id, task, fd)
+    return sent
+
+
+async def read_json(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body or b'{}')
+    except ValueError:
+        return None
+
+
+async def video_archive(scope, receive, send):
+    data = scope['query'] if scope['method'] == 'GET' else await read_json(receive)
+    if not isinstance(data, dict):
+        return await send_json(send, {'error': 'Request body must be a JSON object'}, 400)
+
+    try:
+        bundle = await blocking(api.parse_archive_request, data)
+    except api.ApiError as e:
+        return await send_api_error(send, e)
+
+    await send_start(send, 200, {
+        'Content-Type': 'application/zip',
+        'Content-Disposition': f'attachment; filename="{bundle.name}.zip"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no'
+    })
+
+    zip_stream = api.ZipStream()
+    disconnect = Disconnect(receive)
+    sent = 0
+    try:
+        while not disconnect.is_set():
+            ready = await blocking(bundle.poll)
+            for task_id, task in ready:
+                sent += await send_archive_entry(send, disconnect, zip_stream, bundle, task_id, task)
+            if bundle.done:
+                break
+            if not ready:
+                await progress_broadcast.wait(1.0)
+
+        if not disconnect.is_set():
+            report = bundle.error_report()
+            chunk = (zip_stream.add_text('errors.txt', report) if report else b'') + zip_stream.finish()
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            sent += len(chunk)
+            bundle.complete = True
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnect.close()
+        # Cancels what a playlist archive started if the client left early
+        await cleanup(bundle.close)
+        api.BYTES_SERVED.inc(sent, endpoint='archive')
+
+
+ROUTES = [
+    (re.compile(r'^/api/video/status/([^/]+)$'), video_status, ('GET',)),
+    (re.compile(r'^/api/video/progress/([^/]+)$'), video_progress, ('GET',)),
+    (re.compile(r'^/api/video/file/([^/]+)$'), video_file, ('GET',)),
+    (re.compile(r'^/api/thumbnail/([^/]+)$'), thumbnail, ('GET',)),
+    (re.compile(r'^/api/video/stream$'), video_stream, ('GET',)),
+    (re.compile(r'^/api/video/archive$'), video_archive, ('GET', 'POST')),
+]
+
+
+def route(scope):
+    # Multi-part ranges are rare; the Flask implementation handles them
+    for name, value in scope['headers']:
+        if name == b'range' and b',' in value:
+            return None, ()
+
+    for pattern, handler, methods in ROUTES:
+        match = pattern.match(scope['path'])
+        if match and scope['method'] in methods:
+            return handler, match.groups()
+    return None, ()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                start(asyncio.get_running_loop())
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    # Servers without lifespan support
+    start(asyncio.get_running_loop())
+
+    handler, params = route(scope)
+    if handler is None:
+        return await wsgi_app(scope, receive, send)
+
+    scope['headers_dict'] = {k.decode('latin-1'): v.decode('latin-1') for k, v in scope['headers']}
+    scope['query'] = {k: v[-1] for k, v in parse_qs(scope['query_string'].decode('latin-1')).items()}
+    await handler(scope, receive, send, *params)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""Stand-in for the yt-dlp CLI, for offline benchmarks
+
+Understands the subset of yt-dlp the API uses:
+
+    --dump-json / --dump-single-json [--flat-playlist] URL   canned info JSON
+    --format SPEC --output TEMPLATE (URL | --load-info-json FILE)
+        downloads the selected formats from the local media server, printing
+        --progress-template lines (or yt-dlp style [download] lines) and a
+        Merger post-processing step when two formats are combined
+    --output -                                              payload to stdout
+    --version
+
+Environment:
+    BENCH_MEDIA_URL       base URL of bench/media_server.py (required)
+    BENCH_VIDEO_BYTES     size of the 1080p video track (default 4 MiB)
+    BENCH_AUDIO_BYTES     size of the m4a audio track (default 1 MiB)
+    BENCH_EXTRACT_DELAY   seconds spent "extracting" info (default 0.2)
+    BENCH_PLAYLIST_SIZE   entries in a flat playlist (default 10)
+    BENCH_FAIL_RATE       probability a download fails (default 0)
+"""
+
+import json
+import os
+import random
+import re
+import sys
+import time
+import urllib.request
+
+VALUE_OPTIONS = {
+    '-f', '--format', '-o', '--output', '--load-info-json', '--progress-template',
+    '-r', '--limit-rate', '-N', '--concurrent-fragments', '--cookies',
+    '--merge-output-format', '--download-sections',
+}
+
+CHUNK_SIZE = 256 * 1024
+
+MEDIA_URL = os.environ.get('BENCH_MEDIA_URL', '').rstrip('/')
+VIDEO_BYTES = int(os.environ.get('BENCH_VIDEO_BYTES', 4 * 1024 * 1024))
+AUDIO_BYTES = int(os.environ.get('BENCH_AUDIO_BYTES', 1024 * 1024))
+EXTRACT_DELAY = float(os.environ.get('BENCH_EXTRACT_DELAY', 0.2))
+PLAYLIST_SIZE = int(os.environ.get('BENCH_PLAYLIST_SIZE', 10))
+FAIL_RATE = float(os.environ.get('BENCH_FAIL_RATE', 0))
+
+
+def parse_args(argv):
+    options = {}
+    flags = set()
+    positional = []
+
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in VALUE_OPTIONS:
+            options.setdefault(arg, []).append(argv[i + 1])
+            i += 2
+        elif arg.startswith('-') and arg != '-':
+            flags.add(arg)
+            i += 1
+        else:
+            positional.append(arg)
+            i += 1
+    return options, flags, positional
+
+
+def option(options, *names, default=None):
+    for name in names:
+        if name in options:
+            return options[name][-1]
+    return default
+
+
+def video_id_from_url(url):
+    match = re.search(r'(?:v=|youtu\.be/|shorts/|/p/|/reel/)([\w-]+)', url)
+    if match:
+        return match.group(1)
+    return re.sub(r'\W', '', url.rstrip('/').rsplit('/', 1)[-1])[:11] or 'bench'
+
+
+# -----------------------------
+# Canned info
+# -----------------------------
+def media_format(video_id, format_id, ext, size, expire, **fields):
+    return {
+        'format_id': format_id,
+        'ext': ext,
+        'url': f"{MEDIA_URL}/media/{video_id}/{format_id}.{ext}?size={size}&expire={expire}",
+        'filesize': size,
+        'protocol': 'https',
+        'http_headers': {'User-Agent': 'Mozilla/5.0 (bench)'},
+        **fields
+    }
+
+
+def make_info(url):
+    video_id = video_id_from_url(url)
+    expire = int(time.time()) + 6 * 3600
+
+    formats = [
+        media_format(video_id, '140', 'm4a', AUDIO_BYTES, expire,
+                     vcodec='none', acodec='mp4a.40.2', abr=129.5, tbr=129.5),
+        media_format(video_id, '251', 'webm', int(AUDIO_BYTES * 1.1), expire,
+                     vcodec='none', acodec='opus', abr=140.0, tbr=140.0),
+        media_format(video_id, '18', 'mp4', VIDEO_BYTES // 4, expire,
+                     vcodec='avc1.42001E', acodec='mp4a.40.2', height=360, width=640, tbr=500.0),
+        media_format(video_id, '136', 'mp4', VIDEO_BYTES // 2, expire,
+                     vcodec='avc1.4d401f', acodec='none', height=720, width=1280, tbr=1500.0),
+        media_format(video_id, '137', 'mp4', VIDEO_BYTES, expire,
+                     vcodec='avc1.640028', acodec='none', height=1080, width=1920, tbr=3000.0),
+    ]
+
+    return {
+        'id': video_id,
+        'title': f"Benchmark video {video_id}",
+        'uploader': 'bench',
+        'duration': 213,
+        'view_count': 1234567,
+        'webpage_url': url,
+        'extractor': 'youtube',
+        'extractor_key': 'Youtube',
+        'thumbnail': f"{MEDIA_URL}/thumb/{video_id}.jpg",
+        'thumbnails': [{'url': f"{MEDIA_URL}/thumb/{video_id}.jpg", 'width': 1280, 'height': 720}],
+        'formats': formats,
+    }
+
+
+def make_playlist(url):
+    return {
+        '_type': 'playlist',
+        'id': video_id_from_url(url),
+        'title': 'Benchmark playlist',
+        'entries': [
+            {
+                '_type': 'url',
+                'id': f"bench{i:06d}",
+                'url': f"https://www.youtube.com/watch?v=bench{i:06d}",
+                'title': f"Benchmark video {i}",
+            }
+            for i in range(PLAYLIST_SIZE)
+        ],
+    }
+
+
+# -----------------------------
+# Format selection
+# -----------------------------
+FILTER_RE = re.compile(r'\[(\w+)(<=|>=|!=|=|<|>)([^\]]+)\]')
+
+
+def _has_video(f):
+    return f.get('vcodec') not in (None, 'none')
+
+
+def _has_audio(f):
+    return f.get('acodec') not in (None, 'none')
+
+
+def _matches(f, filters):
+    for key, op, value in filters:
+        actual = f.get(key)
+        if op in ('=', '!='):
+            equal = str(actual) == value or (key in ('acodec', 'vcodec') and str(actual).startswith(value))
+            if equal != (op == '='):
+                return False
+            continue
+        if actual is None:
+            return False
+        number = float(value)
+        if not {'<=': actual <= number, '>=': actual >= number,
+                '<': actual < number, '>': actual > number}[op]:
+            return False
+    return True
+
+
+def pick_format(formats, spec):
+    name = spec.split('[', 1)[0]
+    filters = FILTER_RE.findall(spec)
+    candidates = [f for f in formats if _matches(f, filters)]
+
+    if name in ('bv*', 'bestvideo*'):
+        candidates = [f for f in candidates if _has_video(f)]
+    elif name in ('bv', 'bestvideo'):
+        candidates = [f for f in candidates if _has_video(f) and not _has_audio(f)]
+    elif name in ('ba', 'bestaudio'):
+        candidates = [f for f in candidates if _has_audio(f) and not _has_video(f)]
+    elif name in ('b', 'best'):
+        candidates = [f for f in candidates if _has_video(f) and _has_audio(f)]
+    else:
+        candidates = [f for f in candidates if f['format_id'] == name]
+
+    if not candidates:
+        return None
+    return max(candidates, key=lambda f: (f.get('height') or 0, f.get('tbr') or 0))
+
+
+def select_formats(info, spec):
+    for alternative in spec.split('/'):
+        picked = [pick_format(info['formats'], part) for part in alternative.split('+')]
+        if all(picked):
+            return picked
+    return None
+
+
+# -----------------------------
+# Progress output
+# -----------------------------
+TEMPLATE_FIELD_RE = re.compile(r'%\(([\w.]+)\)([jsd])')
+
+
+def render_template(template, context):
+    def lookup(match):
+        value = context
+        for part in match.group(1).split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        if match.group(2) == 'j':
+            return json.dumps(value)
+        if match.group(2) == 'd':
+            return str(int(value or 0))
+        return str(value)
+    return TEMPLATE_FIELD_RE.sub(lookup, template)
+
+
+class Reporter:
+    def __init__(self, options):
+        self.templates = {}
+        for template in options.get('--progress-template', []):
+            kind, _, body = template.partition(':')
+            self.templates[kind] = body
+
+    def download(self, progress, fmt):
+        template = self.templates.get('download')
+        if template:
+            print(render_template(template, {'progress': progress, 'info': fmt}), flush=True)
+            return
+        total = progress.get('total_bytes') or 0
+        percent = progress['downloaded_bytes'] / total * 100 if total else 0
+        print(f"[download] {percent:5.1f}% of {total / 1048576:.2f}MiB at "
+              f"{(progress.get('speed') or 0) / 1048576:.2f}MiB/s ETA {progress.get('eta') or 0}s", flush=True)
+
+    def postprocess(self, progress):
+        template = self.templates.get('postprocess')
+        if template:
+            print(render_template(template, {'progress': progress, 'info': {}}), flush=True)
+        elif progress['status'] == 'started':
+            print(f"[{progress['postprocessor']}] Merging formats", flush=True)
+
+
+# -----------------------------
+# Downloading
+# -----------------------------
+def fetch(fmt, out, rate_limit, on_progress=None):
+    """Copy a format's payload into out; returns bytes written"""
+    request = urllib.request.Request(fmt['url'], headers=fmt.get('http_headers') or {})
+    started = time.time()
+    done = 0
+
+    with urllib.request.urlopen(request, timeout=30) as resp:
+        total = int(resp.headers.get('Content-Length') or fmt.get('filesize') or 0)
+        while True:
+            chunk = resp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            done += len(chunk)
+
+            elapsed = time.time() - started
+            if rate_limit:
+                ahead = done / rate_limit - elapsed
+                if ahead > 0:
+                    time.sleep(ahead)
+                    elapsed += ahead
+
+            if on_progress:
+                speed = done / elapsed if elapsed > 0 else None
+                on_progress(done, total, speed)
+
+    return done
+
+
+def parse_rate(value):
+    """yt-dlp style rate ('50K', '4.2M', '1048576') in bytes/s"""
+    multipliers = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = value.strip()
+    if value and value[-1].lower() in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1].lower()])
+    return int(float(value or 0))
+
+
+def download(info, options, reporter):
+    spec = option(options, '-f', '--format', default='bv*+ba/b')
+    formats = select_formats(info, spec)
+    if not formats:
+        print(f"ERROR: [bench] {info['id']}: Requested format is not available", file=sys.stderr)
+        return 1
+
+    rate_limit = parse_rate(option(options, '-r', '--limit-rate', default='0'))
+    output = option(options, '-o', '--output', default='%(title)s [%(id)s].%(ext)s')
+
+    if output == '-':
+        fetch(formats[0], sys.stdout.buffer, rate_limit)
+        sys.stdout.buffer.flush()
+        return 0
+
+    if random.random() < FAIL_RATE:
+        print("ERROR: [bench] injected failure", file=sys.stderr)
+        return 1
+
+    merge_ext = option(options, '--merge-output-format')
+    final_ext = (merge_ext or formats[0]['ext']) if len(formats) > 1 else formats[0]['ext']
+    final_path = output.replace('%(ext)s', final_ext).replace('%(id)s', info['id'])
+    base = final_path[:-len(final_ext) - 1]
+
+    part_paths = []
+    for fmt in formats:
+        path = f"{base}.f{fmt['format_id']}.{fmt['ext']}" if len(formats) > 1 else final_path
+        part_paths.append(path)
+        tmp_path = path + ".part"
+
+        def on_progress(done, total, speed, fmt=fmt, tmp_path=tmp_path):
+            reporter.download({
+                'status': 'downloading',
+                'downloaded_bytes': done,
+                'total_bytes': total,
+                'speed': speed,
+                'eta': int((total - done) / speed) if speed and total else None,
+                'filename': path,
+                'tmpfilename': tmp_path,
+            }, fmt)
+
+        with open(tmp_path, 'wb') as out:
+            done = fetch(fmt, out, rate_limit, on_progress)
+        os.replace(tmp_path, path)
+
+        reporter.download({
+            'status': 'finished',
+            'downloaded_bytes': done,
+            'total_bytes': done,
+            'filename': path,
+        }, fmt)
+
+    if len(formats) > 1:
+        # "Merge" by concatenation; the cost that matters here is the disk I/O
+        reporter.postprocess({'status': 'started', 'postprocessor': 'Merger'})
+        with open(final_path + ".temp", 'wb') as out:
+            for path in part_paths:
+                with open(path, 'rb') as f:
+                    while True:
+                        chunk = f.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                os.remove(path)
+        os.replace(final_path + ".temp", final_path)
+        reporter.postprocess({'status': 'finished', 'postprocessor': 'Merger'})
+
+    return 0
+
+
+def main(argv):
+    options, flags, positional = parse_args(argv)
+
+    if '--version' in flags:
+        print("2099.01.01-bench")
+        return 0
+
+    if not MEDIA_URL:
+        print("ERROR: BENCH_MEDIA_URL is not set", file=sys.stderr)
+        return 2
+
+    info_json = option(options, '--load-info-json')
+    if info_json:
+        with open(info_json) as f:
+            info = json.load(f)
+    elif positional:
+        time.sleep(EXTRACT_DELAY)
+        url = positional[-1]
+        info = make_playlist(url) if '--flat-playlist' in flags else make_info(url)
+    else:
+        print("ERROR: You must provide at least one URL.", file=sys.stderr)
+        return 2
+
+    if '--dump-json' in flags or '--dump-single-json' in flags or '-J' in flags or '-j' in flags:
+        print(json.dumps(info))
+        return 0
+
+    return download(info, options, Reporter(options))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,121 @@
+"""Local HTTP server that serves synthetic media for benchmarks
+
+    /media/<video_id>/<format_id>.<ext>?size=<bytes>   deterministic payload, Range supported
+    /thumb/<video_id>.jpg                             small fake JPEG
+
+MEDIA_RATE (bytes/s per connection, 0 = unlimited) emulates a CDN link.
+Run standalone with `python bench/media_server.py --port 8901`.
+"""
+
+import argparse
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+CHUNK_SIZE = 64 * 1024
+PATTERN = bytes(range(256)) * (CHUNK_SIZE // 256)
+THUMBNAIL = b"\xff\xd8\xff\xe0" + b"\x00" * 8 * 1024 + b"\xff\xd9"
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    rate = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        parsed = urlparse(self.path)
+
+        if parsed.path.startswith("/thumb/"):
+            self._send_headers(200, "image/jpeg", len(THUMBNAIL))
+            if not head:
+                self.wfile.write(THUMBNAIL)
+            return
+
+        if not parsed.path.startswith("/media/"):
+            self.send_error(404)
+            return
+
+        query = parse_qs(parsed.query)
+        size = int(query.get('size', ['1048576'])[0])
+        start, stop = 0, size
+
+        match = RANGE_RE.match(self.headers.get('Range', ''))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                stop = min(int(match.group(2)) + 1, size) if match.group(2) else size
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self._send_headers(206, "application/octet-stream", stop - start,
+                               {"Content-Range": f"bytes {start}-{stop - 1}/{size}"})
+        else:
+            self._send_headers(200, "application/octet-stream", size)
+
+        if not head:
+            self._write_payload(start, stop)
+
+    def _send_headers(self, status, content_type, length, extra=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        for key, value in (extra or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+    def _write_payload(self, start, stop):
+        started = time.time()
+        sent = 0
+        offset = start
+        try:
+            while offset < stop:
+                n = min(CHUNK_SIZE - offset % CHUNK_SIZE, stop - offset)
+                self.wfile.write(PATTERN[offset % CHUNK_SIZE:offset % CHUNK_SIZE + n])
+                offset += n
+                sent += n
+                if self.rate:
+                    # Sleep off whatever we are ahead of the configured rate
+                    ahead = sent / self.rate - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def start_media_server(port=0, rate=0):
+    """Start the server on a background thread; returns (server, base_url)"""
+    handler = type("RateLimitedMediaHandler", (MediaHandler,), {'rate': rate})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="media-server").start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--rate", type=int, default=0, help="bytes/s per connection (0 = unlimited)")
+    args = parser.parse_args()
+
+    server, base_url = start_media_server(args.port, args.rate)
+    print(f"Serving synthetic media on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,432 @@
+"""Offline load test for the video API
+
+Starts bench/media_server.py, puts bench/fake_ytdlp.py on the server's PATH
+as `yt-dlp`, boots the API under gunicorn in a scratch directory and drives
+it with concurrent clients:
+
+    info      POST /api/video/info
+    download  POST /api/video/download, then GET /api/video/status until the
+              task completes, then GET /api/video/file (full body)
+
+Reports throughput and p50/p95/p99 latency per endpoint plus peak RSS and
+open file descriptors of the server process tree. Nothing touches the
+network beyond 127.0.0.1. Audio downloads need a real ffmpeg and are not
+exercised.
+
+    python bench/run.py --requests 200 --concurrency 16
+    python bench/run.py --json results.json
+    python bench/run.py --baseline results.json --tolerance 0.2   # exit 1 on regression
+
+--delivery s3 serves files through presigned redirects; point it at a
+local S3-compatible store, e.g.
+
+    docker run -p 9000:9000 minio/minio server /data
+    S3_ENDPOINT=http://127.0.0.1:9000 S3_BUCKET=bench S3_ACCESS_KEY=minioadmin \\
+        S3_SECRET_KEY=minioadmin python bench/run.py --delivery s3
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from media_server import start_media_server  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+# -----------------------------
+# Measurements
+# -----------------------------
+class Recorder:
+    """Latency samples and error counts per endpoint"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.bytes = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, ok=True, nbytes=0):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            if nbytes:
+                self.bytes[endpoint] = self.bytes.get(endpoint, 0) + nbytes
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(recorder, wall_seconds):
+    summary = {}
+    for endpoint, values in recorder.samples.items():
+        values = sorted(values)
+        summary[endpoint] = {
+            'count': len(values),
+            'errors': recorder.errors.get(endpoint, 0),
+            'throughput': round(len(values) / wall_seconds, 2) if wall_seconds else None,
+            'p50_ms': round(percentile(values, 50) * 1000, 1),
+            'p95_ms': round(percentile(values, 95) * 1000, 1),
+            'p99_ms': round(percentile(values, 99) * 1000, 1),
+            'max_ms': round(values[-1] * 1000, 1),
+        }
+        if recorder.bytes.get(endpoint):
+            summary[endpoint]['mb_per_s'] = round(recorder.bytes[endpoint] / wall_seconds / 1048576, 2)
+    return summary
+
+
+class ProcessSampler:
+    """Samples RSS and open FDs of a process and its descendants"""
+
+    def __init__(self, pid, interval=0.2):
+        self.pid = pid
+        self.interval = interval
+        self.peak = {'rss_mb': 0.0, 'fds': 0, 'processes': 0, 'server_rss_mb': 0.0}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.peak
+
+    def _descendants(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # comm may contain spaces; ppid is the second field after it
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+        pids, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            pids.append(pid)
+            stack.extend(children.get(pid, []))
+        return pids
+
+    def _sample(self):
+        rss_kb = server_kb = fds = processes = 0
+        for pid in self._descendants():
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    kb = next((int(line.split()[1]) for line in f if line.startswith('VmRSS:')), 0)
+                with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                    helper = b'fake_ytdlp' in f.read()
+                fds += len(os.listdir(f'/proc/{pid}/fd'))
+            except OSError:
+                continue
+            processes += 1
+            rss_kb += kb
+            if not helper:
+                server_kb += kb
+
+        self.peak['rss_mb'] = max(self.peak['rss_mb'], round(rss_kb / 1024, 1))
+        self.peak['server_rss_mb'] = max(self.peak['server_rss_mb'], round(server_kb / 1024, 1))
+        self.peak['fds'] = max(self.peak['fds'], fds)
+        self.peak['processes'] = max(self.peak['processes'], processes)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+
+# -----------------------------
+# HTTP client
+# -----------------------------
+def call(base_url, method, path, body=None, timeout=120):
+    """Returns (status, parsed JSON or None)"""
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method,
+                                 headers={'Content-Type': 'application/json'} if data else {})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return resp.status, json.loads(resp.read() or b'null')
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+
+def video_url(n):
+    return f"https://www.youtube.com/watch?v=bench{n:06d}"
+
+
+def info_request(base_url, recorder, n):
+    started = time.perf_counter()
+    status, _ = call(base_url, 'POST', '/api/video/info', {'url': video_url(n)})
+    recorder.add('info', time.perf_counter() - started, ok=status == 200)
+
+
+def download_flow(base_url, recorder, n, poll_interval, timeout):
+    flow_started = time.perf_counter()
+    url = video_url(n)
+
+    started = time.perf_counter()
+    status, body = call(base_url, 'POST', '/api/video/download', {'url': url})
+    recorder.add('download', time.perf_counter() - started, ok=status == 202)
+    if status != 202:
+        recorder.add('flow', time.perf_counter() - flow_started, ok=False)
+        return
+
+    task_id = body['task_id']
+    deadline = time.time() + timeout
+    while True:
+        started = time.perf_counter()
+        status, task = call(base_url, 'GET', f'/api/video/status/{task_id}')
+        recorder.add('status', time.perf_counter() - started, ok=status == 200)
+        if status != 200 or task['status'] in ('completed', 'failed') or time.time() > deadline:
+            break
+        time.sleep(poll_interval)
+
+    if status != 200 or task['status'] != 'completed':
+        recorder.add('flow', time.perf_counter() - flow_started, ok=False)
+        return
+
+    started = time.perf_counter()
+    nbytes = 0
+    ok = False
+    try:
+        with urllib.request.urlopen(f"{base_url}/api/video/file/{task_id}", timeout=timeout) as resp:
+            recorder.add('file_ttfb', time.perf_counter() - started)
+            while True:
+                chunk = resp.read(256 * 1024)
+                if not chunk:
+                    break
+                nbytes += len(chunk)
+            ok = resp.status == 200
+    except urllib.error.HTTPError:
+        pass
+    recorder.add('file', time.perf_counter() - started, ok=ok, nbytes=nbytes)
+    recorder.add('flow', time.perf_counter() - flow_started, ok=ok)
+
+
+def run_phase(name, fn, count, concurrency):
+    print(f"  {name}: {count} requests, concurrency {concurrency} ...", flush=True)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(fn, i) for i in range(count)]:
+            future.result()
+    return time.perf_counter() - started
+
+
+# -----------------------------
+# Server under test
+# -----------------------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_api_server(args, media_url, workdir):
+    bindir = os.path.join(workdir, 'bin')
+    os.makedirs(bindir)
+    shim = os.path.join(bindir, 'yt-dlp')
+    with open(shim, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCH_DIR, "fake_ytdlp.py")}" "$@"\n')
+    os.chmod(shim, 0o755)
+
+    port = free_port()
+    env = dict(
+        os.environ,
+        PATH=bindir + os.pathsep + os.environ.get('PATH', ''),
+        EXTRACTOR_MODE='subprocess',
+        TASK_STORE=args.task_store,
+        DELIVERY_BACKEND=args.delivery,
+        TASK_STORE_PATH=os.path.join(workdir, 'tasks.sqlite3'),
+        BENCH_MEDIA_URL=media_url,
+        BENCH_VIDEO_BYTES=str(int(args.video_mb * 1048576)),
+        BENCH_AUDIO_BYTES=str(int(args.video_mb * 1048576 / 4)),
+        BENCH_EXTRACT_DELAY=str(args.extract_delay),
+        BENCH_FAIL_RATE=str(args.fail_rate),
+        # The stub has no platform to protect; measure the server, not the budget
+        YOUTUBE_RATE_PER_MINUTE=os.environ.get('YOUTUBE_RATE_PER_MINUTE', '0'),
+        INSTAGRAM_RATE_PER_MINUTE=os.environ.get('INSTAGRAM_RATE_PER_MINUTE', '0'),
+    )
+
+    cmd = [
+        sys.executable, '-m', 'gunicorn',
+        '--pythonpath', REPO_DIR,
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', str(args.workers),
+        '--log-level', 'warning',
+    ]
+    if args.mode == 'asgi':
+        cmd += ['--worker-class', 'uvicorn.workers.UvicornWorker', 'asgi:app']
+    else:
+        cmd += ['--threads', str(args.threads), 'app:app']
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+                               start_new_session=True)
+
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API server exited; see {log.name}")
+        try:
+            if call(base_url, 'GET', '/api/health', timeout=2)[0] == 200:
+                return process, base_url
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("API server did not become ready")
+
+
+def stop_api_server(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+# -----------------------------
+# Reporting
+# -----------------------------
+def print_report(results):
+    print()
+    print(f"{'endpoint':<10} {'count':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for endpoint, s in results['endpoints'].items():
+        print(f"{endpoint:<10} {s['count']:>6} {s['errors']:>6} {s['throughput']:>8} "
+              f"{s['p50_ms']:>9} {s['p95_ms']:>9} {s['p99_ms']:>9} {s['max_ms']:>9}"
+              + (f"  {s['mb_per_s']} MB/s" if 'mb_per_s' in s else ""))
+    if results.get('resources'):
+        r = results['resources']
+        print(f"\npeak RSS {r['rss_mb']} MB (server {r['server_rss_mb']} MB), "
+              f"peak FDs {r['fds']}, peak processes {r['processes']}")
+
+
+def compare(results, baseline, tolerance):
+    """List of regressions beyond tolerance (fractional) against a baseline run"""
+    regressions = []
+    for endpoint, current in results['endpoints'].items():
+        previous = baseline['endpoints'].get(endpoint)
+        if not previous:
+            continue
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            if previous[metric] and current[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{endpoint} {metric}: {previous[metric]} -> {current[metric]}")
+        if previous['throughput'] and current['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f"{endpoint} throughput: {previous['throughput']} -> {current['throughput']}")
+        if current['errors'] > previous['errors']:
+            regressions.append(f"{endpoint} errors: {previous['errors']} -> {current['errors']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50, help='requests (flows) per phase')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--distinct', type=int, default=0,
+                        help='distinct videos (0 = one per request); lower values exercise caching')
+    parser.add_argument('--phases', default='info,download')
+    parser.add_argument('--poll-interval', type=float, default=0.25)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--video-mb', type=float, default=4, help='size of the downloaded video track')
+    parser.add_argument('--media-rate', type=int, default=0, help='media server bytes/s per connection')
+    parser.add_argument('--extract-delay', type=float, default=0.2, help='fake yt-dlp extraction time')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='fraction of downloads that fail')
+    parser.add_argument('--mode', default='wsgi', choices=('wsgi', 'asgi'), help='serve app:app or asgi:app')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--task-store', default='memory', choices=('memory', 'sqlite'))
+    parser.add_argument('--delivery', default='direct', choices=('direct', 's3'),
+                        help='file delivery backend; s3 reads S3_ENDPOINT/S3_BUCKET/... from the environment')
+    parser.add_argument('--target', help='benchmark an already running server instead of starting one')
+    parser.add_argument('--pid', type=int, help='with --target: process to sample for RSS/FDs')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    media_server, media_url = start_media_server(rate=args.media_rate)
+    workdir = tempfile.mkdtemp(prefix='video-api-bench-')
+    process = None
+
+    try:
+        if args.target:
+            base_url, pid = args.target.rstrip('/'), args.pid
+        else:
+            process, base_url = start_api_server(args, media_url, workdir)
+            pid = process.pid
+
+        print(f"Benchmarking {base_url} (media: {media_url}, scratch: {workdir})")
+        sampler = ProcessSampler(pid).start() if pid else None
+
+        distinct = args.distinct or args.requests
+        phases = [p.strip() for p in args.phases.split(',') if p.strip()]
+        results = {'config': vars(args), 'endpoints': {}, 'phases': {}}
+
+        for phase in phases:
+            recorder = Recorder()
+            if phase == 'info':
+                fn = lambda i: info_request(base_url, recorder, i % distinct)
+            elif phase == 'download':
+                fn = lambda i: download_flow(base_url, recorder, i % distinct, args.poll_interval, args.timeout)
+            else:
+                parser.error(f"unknown phase: {phase}")
+
+            wall = run_phase(phase, fn, args.requests, args.concurrency)
+            results['phases'][phase] = {'wall_seconds': round(wall, 2)}
+            results['endpoints'].update(summarize(recorder, wall))
+
+        if sampler:
+            results['resources'] = sampler.stop()
+
+    finally:
+        if process:
+            stop_api_server(process)
+        media_server.shutdown()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\nNo regressions against baseline")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
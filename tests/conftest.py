@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py creates its downloads/data folders relative to the working directory
+# on import, so the suite runs from a scratch directory
+os.chdir(tempfile.mkdtemp(prefix='video-api-tests-'))
+os.environ.setdefault('DELIVERY_BACKEND', 'direct')
+sys.path.insert(0, ROOT)
+
+
+class FakeYtdlp:
+    """Stands in for app._run_ytdlp: records each command and writes the file it would have"""
+
+    def __init__(self):
+        self.commands = []
+        self.results = []               # (returncode, throttled) per run; default success
+        self.ext = 'mp4'
+
+    def __call__(self, cmd, artifact):
+        self.commands.append(list(cmd))
+        returncode, throttled = self.results.pop(0) if self.results else (0, False)
+        if returncode == 0:
+            template = cmd[cmd.index('--output') + 1]
+            with open(template.replace('%(ext)s', self.ext), 'wb') as f:
+                f.write(b'media')
+        return returncode, throttled
+
+
+@pytest.fixture
+def ytdlp(monkeypatch):
+    import app
+    fake = FakeYtdlp()
+    monkeypatch.setattr(app, '_run_ytdlp', fake)
+    return fake
+
+
+@pytest.fixture
+def artifact():
+    """A fresh artifact this test owns, removed from the cache afterwards"""
+    import app
+    key = f"test_{uuid.uuid4().hex}"
+    task_id = uuid.uuid4().hex
+    app.task_store.create(task_id, {'status': 'pending', 'artifact_key': key})
+    artifact, _ = app.claim_artifact(key, task_id)
+    yield artifact
+    app.artifacts.pop(key, None)
@@ -0,0 +1,102 @@
+"""/api/video/archive: request validation, the ZIP stream and the WSGI archive cap"""
+import io
+import threading
+import time
+import uuid
+import zipfile
+
+import pytest
+
+import app
+
+PLAYLIST = 'https://www.youtube.com/playlist?list=PL0123456789'
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def completed_task(tmp_path, name, content):
+    path = tmp_path / f"{uuid.uuid4().hex}.mp4"
+    path.write_bytes(content)
+    task_id = uuid.uuid4().hex
+    app.task_store.create(task_id, {'status': 'completed', 'file_path': str(path), 'download_name': name})
+    return task_id
+
+
+@pytest.mark.parametrize('body, error', [
+    ({}, 'url or task_ids is required'),
+    ({'task_ids': 5}, 'task_ids must be a list'),
+    ({'url': 'https://www.youtube.com/watch?v=abcdefghijk'}, 'url must be a YouTube playlist or channel'),
+    ({'url': PLAYLIST, 'is_audio': 'maybe'}, 'is_audio must be true or false'),
+    ({'url': PLAYLIST, 'is_audio': True, 'audio_format': 'wav'}, 'audio_format must be one of'),
+])
+def test_bad_requests_are_400(client, body, error):
+    response = client.post('/api/video/archive', json=body)
+    assert response.status_code == 400
+    assert response.get_json()['error'].startswith(error)
+
+
+def test_too_many_tasks_is_400(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'ARCHIVE_MAX_ITEMS', 1)
+    response = client.get('/api/video/archive?task_ids=a,b')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'At most 1 tasks per archive'
+
+
+def test_unknown_task_is_404(client):
+    response = client.get(f'/api/video/archive?task_ids={uuid.uuid4().hex}')
+    assert response.status_code == 404
+
+
+def test_bad_requests_leave_the_slot_free(client):
+    free = app.wsgi_archive_slots._value
+    client.post('/api/video/archive', json={})
+    assert app.wsgi_archive_slots._value == free
+
+
+def test_archive_of_finished_tasks(client, tmp_path):
+    first = completed_task(tmp_path, 'first', b'a' * 1000)
+    second = completed_task(tmp_path, 'first', b'b' * 3000)
+    failed = uuid.uuid4().hex
+    app.task_store.create(failed, {'status': 'failed', 'error': 'gone', 'download_name': 'third'})
+
+    response = client.get(f'/api/video/archive?task_ids={first},{second},{failed}')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/zip'
+
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.testzip() is None
+    assert archive.namelist() == ['first.mp4', 'first (2).mp4', 'errors.txt']
+    assert archive.read('first.mp4') == b'a' * 1000
+    assert archive.read('first (2).mp4') == b'b' * 3000
+    assert 'third: gone' in archive.read('errors.txt').decode()
+    assert app.task_store.get(first).get('served_at')
+
+
+def test_zip_stream_is_a_valid_archive():
+    zip_stream = app.ZipStream()
+    chunks = [zip_stream.begin('a.bin', 6, time.time())]
+    chunks += [zip_stream.write(b'abc'), zip_stream.write(b'def'), zip_stream.end()]
+    chunks.append(zip_stream.add_text('notes.txt', 'hello'))
+    chunks.append(zip_stream.finish())
+
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+    assert archive.read('a.bin') == b'abcdef'
+    assert archive.read('notes.txt') == b'hello'
+    assert archive.getinfo('a.bin').compress_type == zipfile.ZIP_STORED
+
+
+def test_wsgi_archives_are_capped(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'wsgi_archive_slots', threading.BoundedSemaphore(1))
+    task_id = completed_task(tmp_path, 'clip', b'x' * 10)
+
+    held = client.get(f'/api/video/archive?task_ids={task_id}', buffered=False)
+    assert held.status_code == 200
+    rejected = client.get(f'/api/video/archive?task_ids={task_id}')
+    assert rejected.status_code == 503
+
+    # Closing the unread response frees the slot
+    held.close()
+    assert client.get(f'/api/video/archive?task_ids={task_id}').status_code == 200
@@ -0,0 +1,97 @@
+"""Identical downloads share one artifact instead of one file per task"""
+import os
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    jobs = []
+    monkeypatch.setattr(app, 'submit_download', lambda artifact, params, job_name, priority=None:
+                        jobs.append((artifact, params)))
+    before = set(app.artifacts)
+    yield jobs
+    for key in set(app.artifacts) - before:
+        app.artifacts.pop(key, None)
+
+
+@pytest.fixture
+def url():
+    return f"https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}"
+
+
+def start(url, is_audio=False, audio_format='mp3', clip=None):
+    return app.start_download_task(url, 'youtube', 'best', is_audio, audio_format, clip=clip)
+
+
+def run(job):
+    artifact, params = job
+    app.download_youtube_video(params['url'], params['format_id'], 'job', artifact, params['is_audio'],
+                               params['video_key'], params['audio_format'], params['clip'])
+
+
+def test_key_covers_everything_that_changes_the_file():
+    clip = {'start': 0.0, 'end': 10.0, 'accurate': False}
+    keys = {
+        app.get_artifact_key('youtube:a', False),
+        app.get_artifact_key('youtube:b', False),
+        app.get_artifact_key('youtube:a', True, 'mp3'),
+        app.get_artifact_key('youtube:a', True, 'opus'),
+        app.get_artifact_key('youtube:a', False, clip=clip),
+        app.get_artifact_key('youtube:a', False, clip=dict(clip, accurate=True)),
+    }
+    assert len(keys) == 6
+    assert app.get_artifact_key('youtube:a', False) == app.get_artifact_key('youtube:a', False)
+
+
+def test_concurrent_requests_share_one_download(ytdlp, submitted, url):
+    first_id, artifact = start(url)
+    second_id, shared = start(url)
+    assert shared is artifact
+    assert len(submitted) == 1
+
+    run(submitted[0])
+    assert len(ytdlp.commands) == 1
+    first, second = app.task_store.get(first_id), app.task_store.get(second_id)
+    assert first['status'] == second['status'] == 'completed'
+    assert first['file_path'] == second['file_path'] == artifact['file_path']
+
+
+def test_finished_file_is_reused(ytdlp, submitted, url):
+    start(url)
+    run(submitted[0])
+
+    task_id, artifact = start(url)
+    assert len(submitted) == 1
+    assert app.task_store.get(task_id)['status'] == 'completed'
+    assert task_id in artifact['task_ids']
+
+
+def test_audio_and_video_are_separate_artifacts(submitted, url):
+    _, video = start(url)
+    _, audio = start(url, is_audio=True)
+    assert video is not audio
+    assert len(submitted) == 2
+
+
+def test_removed_file_is_downloaded_again(ytdlp, submitted, url):
+    start(url)
+    run(submitted[0])
+    os.remove(submitted[0][0]['file_path'])
+
+    start(url)
+    assert len(submitted) == 2
+
+
+def test_failed_download_is_retried_from_scratch(ytdlp, submitted, url):
+    ytdlp.results = [(1, False)]
+    task_id, artifact = start(url)
+    run(submitted[0])
+    assert app.task_store.get(task_id)['status'] == 'failed'
+    assert artifact['key'] not in app.artifacts
+
+    start(url)
+    assert len(submitted) == 2
@@ -0,0 +1,132 @@
+"""The ASGI front end: event-loop endpoints, the Flask fallback, and subprocess supervision"""
+import asyncio
+import json
+import sys
+
+import pytest
+
+import app
+import asgi
+
+CONTENT = bytes(range(256)) * 2048
+
+
+@pytest.fixture(autouse=True)
+def loop_hooks(monkeypatch):
+    """Each test runs its own event loop; keep asgi.start() from leaking it into later tests"""
+    monkeypatch.setattr(asgi, 'progress_broadcast', None)
+    monkeypatch.setattr(app, 'download_supervisor', None)
+    monkeypatch.setattr(app, 'progress_listeners', [])
+
+
+def call(path, method='GET', query=b'', headers=None, body=b'', send_fails_after=None):
+    """Run one request through asgi.app; returns (status, headers, body)"""
+    messages = []
+    pending = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        if pending:
+            return pending.pop()
+        # The client never leaves on its own
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if send_fails_after is not None and len(messages) > send_fails_after:
+            raise ConnectionResetError('client went away')
+        messages.append(message)
+
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'raw_path': path.encode(), 'root_path': '',
+        'scheme': 'http', 'query_string': query, 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234),
+        'http_version': '1.1', 'asgi': {'version': '3.0'},
+        'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    }
+
+    async def run():
+        await asgi.app(scope, receive, send)
+
+    asyncio.run(run())
+    start = messages[0]
+    return (start['status'], {k.decode(): v.decode() for k, v in start['headers']},
+            b''.join(m.get('body', b'') for m in messages[1:]))
+
+
+@pytest.fixture
+def completed(artifact, tmp_path):
+    """A completed task with a file"""
+    path = tmp_path / 'media.mp4'
+    path.write_bytes(CONTENT)
+    app.file_index.add(str(path), 3600)
+    app.update_artifact(artifact, status='completed', progress=100, file_path=str(path))
+    return artifact['task_ids'][0], str(path)
+
+
+def test_status_runs_on_the_loop(artifact):
+    status, _, body = call(f"/api/video/status/{artifact['task_ids'][0]}")
+    assert status == 200 and json.loads(body)['status'] == 'pending'
+
+    status, _, _ = call('/api/video/status/nope')
+    assert status == 404
+
+
+def test_file_range_and_conditional_requests(completed):
+    task_id, _ = completed
+    status, headers, body = call(f'/api/video/file/{task_id}', headers={'Range': 'bytes=10-19'})
+    assert status == 206 and body == CONTENT[10:20]
+    assert headers['content-range'] == f'bytes 10-19/{len(CONTENT)}'
+
+    status, _, body = call(f'/api/video/file/{task_id}', headers={'If-None-Match': headers['etag']})
+    assert status == 304 and body == b''
+
+    status, _, body = call(f'/api/video/file/{task_id}')
+    assert status == 200 and body == CONTENT
+
+
+def test_aborted_transfer_still_unpins_the_file(completed, monkeypatch):
+    task_id, path = completed
+    finished = []
+    monkeypatch.setattr(app, 'finish_file_transfer', lambda *args: finished.append(args))
+
+    with pytest.raises(ConnectionResetError):
+        call(f'/api/video/file/{task_id}', send_fails_after=1)
+    assert finished == [(path, task_id)]
+
+
+def test_other_routes_fall_through_to_flask():
+    status, headers, body = call('/metrics')
+    assert status == 200 and headers['content-type'].startswith('text/plain')
+    assert b'video_api_stage_duration_seconds' in body
+
+    status, _, _ = call('/api/video/info/batch', method='POST', body=b'{}',
+                        headers={'Content-Type': 'application/json'})
+    assert status == 400
+
+
+def test_long_poll_wakes_on_progress(artifact):
+    task_id = artifact['task_ids'][0]
+    app.update_artifact(artifact, progress=5)
+    since = app.task_store.get(task_id)['updated_at']
+
+    async def run():
+        asgi.start(asyncio.get_running_loop())
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.2, lambda: loop.run_in_executor(None, lambda: app.update_artifact(artifact, progress=50)))
+        return await asgi.wait_for_progress(task_id, since, 10)
+
+    assert asyncio.run(run())['progress'] == 50
+
+
+def test_downloads_are_supervised_on_the_loop(artifact):
+    line = json.dumps({'progress': {'status': 'finished', 'downloaded_bytes': 10, 'total_bytes': 10,
+                                    'filename': 'x.mp4'}, 'vcodec': 'avc1', 'acodec': 'mp4a'})
+    cmd = [sys.executable, '-c', f"print('[progress] ' + {line!r}); raise SystemExit(3)"]
+    tracker = app.ProgressTracker(artifact)
+
+    async def run():
+        return await asgi.supervise_ytdlp(cmd, tracker)
+
+    assert asyncio.run(run()) == 3
+    assert artifact['downloaded_bytes'] == 10 and artifact['progress'] == 95
+    assert artifact.get('stop') is None
+    # The process group was recorded and forgotten again
+    assert not any(entry.get('prefix') == artifact['output_path'] for _, entry, _ in app.process_registry.entries())
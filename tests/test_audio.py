@@ -0,0 +1,95 @@
+"""Audio downloads: native tracks pass through, container changes remux, the rest transcode on the pool"""
+import json
+import os
+import sys
+import time
+
+import pytest
+
+import app
+
+URL = 'https://www.youtube.com/watch?v=abcdefghijk'
+
+
+@pytest.fixture
+def ffmpeg(tmp_path, monkeypatch):
+    """A stand-in ffmpeg that logs its arguments and writes its output file; fails stream copies on request"""
+    log = tmp_path / 'ffmpeg.log'
+    script = tmp_path / 'ffmpeg'
+    script.write_text(f"""#!{sys.executable}
+import json, os, sys
+args = sys.argv[1:]
+with open({str(log)!r}, 'a') as f:
+    f.write(json.dumps(args) + '\\n')
+if 'copy' in args and os.environ.get('FAKE_FFMPEG_FAIL_COPY'):
+    sys.exit(1)
+with open(args[-1], 'wb') as f:
+    f.write(b'audio')
+""")
+    script.chmod(0o755)
+    monkeypatch.setattr(app, 'FFMPEG_PATH', str(script))
+
+    def calls():
+        return [json.loads(line) for line in log.read_text().splitlines()] if log.exists() else []
+    return calls
+
+
+def download(artifact, audio_format):
+    app.download_youtube_video(URL, None, 'job', artifact, is_audio=True, video_key='youtube:abcdefghijk',
+                               audio_format=audio_format)
+    deadline = time.time() + 10
+    while artifact['status'] not in app.TERMINAL_STATUSES and time.time() < deadline:
+        time.sleep(0.02)
+    return artifact
+
+
+def test_only_the_native_track_is_downloaded(ytdlp, artifact, ffmpeg):
+    ytdlp.ext = 'm4a'
+    download(artifact, 'm4a')
+
+    [cmd] = ytdlp.commands
+    assert cmd[cmd.index('--format') + 1] == app.AUDIO_PROFILES['m4a']['format']
+    assert '--extract-audio' not in cmd and '--audio-format' not in cmd
+    assert artifact['status'] == 'completed' and artifact['file_ext'] == 'm4a'
+    assert ffmpeg() == []
+
+
+def test_container_change_is_a_stream_copy(ytdlp, artifact, ffmpeg):
+    ytdlp.ext = 'webm'
+    download(artifact, 'opus')
+
+    [args] = ffmpeg()
+    assert args[args.index('-c:a') + 1] == 'copy'
+    assert args[args.index('-f') + 1] == 'opus'
+    assert artifact['status'] == 'completed' and artifact['file_path'].endswith('.opus')
+    assert not os.path.exists(f"{artifact['output_path']}.webm")
+
+
+def test_other_formats_are_transcoded_on_the_pool(ytdlp, artifact, ffmpeg):
+    ytdlp.ext = 'webm'
+    download(artifact, 'mp3')
+
+    [args] = ffmpeg()
+    assert 'libmp3lame' in args and 'copy' not in args
+    assert artifact['status'] == 'completed' and artifact['file_path'].endswith('.mp3')
+    assert not os.path.exists(f"{artifact['output_path']}.webm")
+
+
+def test_failed_remux_falls_back_to_a_transcode(ytdlp, artifact, ffmpeg, monkeypatch):
+    monkeypatch.setenv('FAKE_FFMPEG_FAIL_COPY', '1')
+    ytdlp.ext = 'mp4'
+    download(artifact, 'm4a')
+
+    copy, transcode = ffmpeg()
+    assert 'copy' in copy and 'aac' in transcode
+    assert artifact['status'] == 'completed' and artifact['file_path'].endswith('.m4a')
+    # No half-written output left behind by the failed copy
+    assert not os.path.exists(f"{artifact['output_path']}.m4a.part")
+
+
+def test_failed_transcode_fails_the_download(ytdlp, artifact, monkeypatch):
+    monkeypatch.setattr(app, 'FFMPEG_PATH', 'false')
+    ytdlp.ext = 'webm'
+    download(artifact, 'mp3')
+    assert artifact['status'] == 'failed'
+    assert not os.path.exists(f"{artifact['output_path']}.webm")
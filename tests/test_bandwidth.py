@@ -0,0 +1,100 @@
+"""BandwidthBudget leases, bandwidth admission and the downloader's rate flags"""
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def test_unlimited_budget_leases_nothing():
+    budget = app.BandwidthBudget(0, 4)
+    assert budget.can_start()
+    assert budget.lease('a', 10) is None
+    assert budget.leased('a') is None
+
+
+def test_download_alone_is_not_held_to_one_slot():
+    budget = app.BandwidthBudget(8000, 4)
+    assert budget.lease('a') == 6000          # keeps 2000 back for the next arrival
+    assert budget.lease('b') == 2000
+    assert not budget.can_start()
+    budget.release('a')
+    assert budget.can_start()
+
+
+def test_burst_shares_evenly():
+    budget = app.BandwidthBudget(8000, 4)
+    rates = [budget.lease(job, waiting) for job, waiting in (('a', 3), ('b', 2), ('c', 1), ('d', 0))]
+    assert rates == [2000, 2000, 2000, 2000]
+
+
+@pytest.mark.parametrize('waiting', [0, 1, 5])
+def test_leases_never_exceed_the_budget(waiting):
+    budget = app.BandwidthBudget(10000, 3)
+    jobs = 0
+    while budget.can_start():
+        budget.lease(jobs, waiting)
+        jobs += 1
+    stats = budget.stats()
+    assert stats['allocated'] <= 10000
+    assert 1 <= stats['active_leases'] <= 3
+
+
+def test_release_is_idempotent():
+    budget = app.BandwidthBudget(8000, 4)
+    budget.lease('a')
+    budget.release('a')
+    budget.release('a')
+    assert budget.stats()['allocated'] == 0
+
+
+def test_scheduler_waits_for_free_bandwidth(monkeypatch):
+    budget = app.BandwidthBudget(4000, 2)
+    monkeypatch.setattr(app, 'bandwidth_budget', budget)
+    scheduler = app.DownloadScheduler(4, {}, 10, admit=app.admit_download)
+    release = threading.Event()
+    ran = []
+
+    def job(name):
+        ran.append((name, budget.leased(name)))
+        release.wait(5)
+        budget.release(name)
+
+    for name in ('a', 'b', 'c'):
+        scheduler.submit(name, 'generic', job, (name,))
+    deadline = time.time() + 5
+    while len(ran) < 2:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    time.sleep(0.1)
+
+    # Four slots, but the budget is all leased; c waits for one to finish
+    assert ran == [('a', 2000), ('b', 2000)]
+    assert scheduler.stats()['queued'] == 1
+    release.set()
+    while len(ran) < 3:
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_rate_limited_download_fetches_one_fragment_at_a_time(monkeypatch, ytdlp, artifact):
+    budget = app.BandwidthBudget(8000, 4)
+    monkeypatch.setattr(app, 'bandwidth_budget', budget)
+    budget.lease(artifact['key'])
+
+    app.download_youtube_video('https://example.com/v.mp4', None, 'job', artifact)
+
+    [cmd] = ytdlp.commands
+    assert cmd[cmd.index('--limit-rate') + 1] == '6000'
+    assert '--concurrent-fragments' not in cmd
+    assert artifact['status'] == 'completed'
+    assert budget.leased(artifact['key']) is None
+
+
+def test_unlimited_download_fetches_fragments_in_parallel(ytdlp, artifact):
+    app.download_youtube_video('https://example.com/v.mp4', None, 'job', artifact)
+
+    [cmd] = ytdlp.commands
+    assert cmd[cmd.index('--concurrent-fragments') + 1] == str(app.app.config['CONCURRENT_FRAGMENTS'])
+    assert '--limit-rate' not in cmd
@@ -0,0 +1,96 @@
+"""Batch info: playlist expansion and NDJSON results in completion order"""
+import json
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://www.youtube.com/playlist?list=PL123', True),
+    ('https://www.youtube.com/@somechannel', True),
+    ('https://www.youtube.com/channel/UC123/videos', True),
+    ('youtube.com/c/name', True),
+    ('https://www.youtube.com/watch?v=abcdefghijk&list=PL123', False),
+    ('https://www.youtube.com/watch?v=abcdefghijk', False),
+    ('https://youtu.be/abcdefghijk', False),
+])
+def test_is_playlist_url(url, expected):
+    assert app.is_playlist_url(url, 'youtube') is expected
+
+
+def test_instagram_is_never_a_playlist():
+    assert not app.is_playlist_url('https://www.instagram.com/playlist', 'instagram')
+
+
+@pytest.fixture
+def listing(monkeypatch):
+    asked = []
+
+    def extract_info(url, flat=False):
+        asked.append((url, flat))
+        return {'title': 'Uploads', 'entries': [
+            {'url': 'https://www.youtube.com/watch?v=aaaaaaaaaaa', 'title': 'A'},
+            {'id': 'bbbbbbbbbbb', 'title': 'B'},
+            {'title': 'no url'},
+            {'id': 'ccccccccccc'},
+        ]}
+    monkeypatch.setattr(app, 'extract_info', extract_info)
+    return asked
+
+
+@pytest.mark.parametrize('url, listed', [
+    ('https://www.youtube.com/@name', 'https://www.youtube.com/@name/videos'),
+    ('https://www.youtube.com/channel/UC1?hl=en', 'https://www.youtube.com/channel/UC1/videos?hl=en'),
+    ('https://www.youtube.com/@name/shorts', 'https://www.youtube.com/@name/shorts'),
+    ('https://www.youtube.com/playlist?list=PL1', 'https://www.youtube.com/playlist?list=PL1'),
+])
+def test_channels_list_their_uploads(listing, url, listed):
+    app.expand_playlist(url, 10)
+    assert listing == [(listed, True)]
+
+
+def test_expansion_is_limited(listing):
+    title, entries = app.expand_playlist('https://www.youtube.com/playlist?list=PL1', 2)
+    assert title == 'Uploads'
+    assert entries == [('https://www.youtube.com/watch?v=aaaaaaaaaaa', 'A'),
+                       ('https://www.youtube.com/watch?v=bbbbbbbbbbb', 'B')]
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.mark.parametrize('body', [{}, {'urls': []}, {'urls': 'https://youtu.be/x'}])
+def test_bad_batches_are_400(client, body):
+    assert client.post('/api/video/info/batch', json=body).status_code == 400
+
+
+def test_too_many_urls_is_400(client, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'BATCH_MAX_ITEMS', 2)
+    response = client.post('/api/video/info/batch', json={'urls': ['a', 'b', 'c']})
+    assert response.status_code == 400
+
+
+def test_results_stream_as_ndjson(client, listing, monkeypatch):
+    def info(url, platform, clip=None):
+        if url.endswith('bbbbbbbbbbb'):
+            raise Exception('Video unavailable')
+        return {'url': url}
+    monkeypatch.setattr(app, 'get_video_info_universal', info)
+
+    response = client.post('/api/video/info/batch', json={'urls': [
+        'https://www.youtube.com/playlist?list=PL1',
+        'https://example.com/video',
+    ]})
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert lines[0] == {'url': 'https://www.youtube.com/playlist?list=PL1', 'status': 'playlist',
+                        'title': 'Uploads', 'entries': 3}
+    results = {line['index']: line for line in lines[1:]}
+    assert sorted(results) == [0, 1, 2, 3]
+    assert results[0]['status'] == 'ok' and results[0]['info'] == {'url': 'https://www.youtube.com/watch?v=aaaaaaaaaaa'}
+    assert results[1]['status'] == 'error' and results[1]['error'] == 'Video unavailable'
+    assert results[3]['status'] == 'error' and results[3]['url'] == 'https://example.com/video'
@@ -0,0 +1,81 @@
+"""The benchmark stand-ins understand the commands the API actually runs"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import app
+
+BENCH_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench')
+sys.path.insert(0, BENCH_DIR)
+
+import fake_ytdlp  # noqa: E402
+from media_server import start_media_server  # noqa: E402
+
+URL = 'https://www.youtube.com/watch?v=abcdefghijk'
+
+
+def test_option_values_are_not_urls():
+    argv = ['--newline', *app.PROGRESS_TEMPLATE_ARGS[1:], '--download-sections', '*0-10',
+            '--force-keyframes-at-cuts', '--limit-rate', '50K', '--format', app.VIDEO_FORMAT,
+            '--output', 'out.%(ext)s', URL]
+    options, flags, positional = fake_ytdlp.parse_args(argv)
+
+    assert positional == [URL]
+    assert options['--download-sections'] == ['*0-10']
+    assert len(options['--progress-template']) == 2
+    assert {'--newline', '--force-keyframes-at-cuts'} <= flags
+
+
+def test_api_format_selectors_pick_formats():
+    info = fake_ytdlp.make_info(URL)
+    assert [f['format_id'] for f in fake_ytdlp.select_formats(info, app.VIDEO_FORMAT)] == ['137', '140']
+    for audio_format, format_id in (('mp3', '251'), ('m4a', '140'), ('opus', '251')):
+        [picked] = fake_ytdlp.select_formats(info, app.AUDIO_PROFILES[audio_format]['format'])
+        assert picked['format_id'] == format_id
+
+
+@pytest.mark.parametrize('value, rate', [('50K', 51200), ('4.5M', 4718592), ('1048576', 1048576), ('0', 0)])
+def test_rates(value, rate):
+    assert fake_ytdlp.parse_rate(value) == rate
+
+
+@pytest.fixture(scope='module')
+def media_url():
+    server, url = start_media_server()
+    yield url
+    server.shutdown()
+
+
+@pytest.fixture
+def bench_ytdlp(tmp_path, monkeypatch, media_url):
+    """Put the stub on PATH as yt-dlp, as bench/run.py does"""
+    wrapper = tmp_path / 'yt-dlp'
+    wrapper.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.join(BENCH_DIR, "fake_ytdlp.py")}" "$@"\n')
+    wrapper.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv('BENCH_MEDIA_URL', media_url)
+    monkeypatch.setenv('BENCH_EXTRACT_DELAY', '0')
+    monkeypatch.setenv('BENCH_VIDEO_BYTES', '200000')
+    monkeypatch.setenv('BENCH_AUDIO_BYTES', '50000')
+
+
+def test_info_json(bench_ytdlp):
+    output = subprocess.run(['yt-dlp', '--dump-json', URL], capture_output=True, check=True).stdout
+    info = json.loads(output)
+    assert info['id'] == 'abcdefghijk' and len(info['formats']) == 5
+
+
+def test_api_download_runs_against_the_stub(bench_ytdlp, artifact, monkeypatch):
+    phases = []
+    update = app.update_artifact
+    monkeypatch.setattr(app, 'update_artifact', lambda a, **fields: (phases.append(fields.get('phase')), update(a, **fields)))
+    app.download_youtube_video(URL, None, 'job', artifact, video_key='youtube:abcdefghijk')
+
+    assert artifact['status'] == 'completed', artifact.get('error')
+    # 1080p video track plus the m4a track, "merged"
+    assert os.path.getsize(artifact['file_path']) == 250000
+    assert artifact['downloaded_bytes'] == 250000
+    assert 'merging' in phases
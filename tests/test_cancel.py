@@ -0,0 +1,122 @@
+"""Cancellation and process lifecycle: nothing a download started outlives it"""
+import json
+import os
+import subprocess
+import threading
+import time
+import uuid
+
+import pytest
+
+import app
+
+
+def alive(pid):
+    """Running (zombies count as gone)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def wait_until(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.02)
+    return predicate()
+
+
+def registered(pid):
+    return any(pgid == pid for pgid, _, _ in app.process_registry.entries())
+
+
+def test_reaping_kills_what_the_leader_left_behind():
+    process = app.spawn_process(['sh', '-c', 'sleep 60 & echo $!'], stdout=subprocess.PIPE)
+    child = int(process.stdout.readline())
+    assert registered(process.pid)
+
+    app.reap_process(process)
+    process.stdout.close()
+    assert wait_until(lambda: not alive(child))
+    assert not registered(process.pid)
+
+
+def test_kill_stops_a_running_leader():
+    process = app.spawn_process(['sleep', '60'])
+    app.reap_process(process, kill=True)
+    assert process.returncode == -9
+
+
+def test_orphans_of_dead_workers_are_killed():
+    process = subprocess.Popen(['sleep', '60'], start_new_session=True)
+    try:
+        app.process_registry.register(process.pid, ['sleep'])
+        dead_owner = {'pid': 2 ** 22 + 1, 'start_time': 1}
+        path = app.process_registry._file(process.pid)
+        with open(path) as f:
+            entry = json.load(f)
+        with open(path, 'w') as f:
+            json.dump(dict(entry, owner=dead_owner), f)
+
+        app.kill_orphaned_groups()
+        assert process.wait(timeout=5) == -9
+        assert not registered(process.pid)
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+@pytest.fixture
+def slow_ytdlp(tmp_path, monkeypatch):
+    """yt-dlp that starts a child (like the ffmpeg it runs) and hangs"""
+    script = tmp_path / 'yt-dlp'
+    script.write_text('#!/bin/sh\nsleep 60 &\necho "child $!"\nwait\n')
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_cancelling_a_running_download(slow_ytdlp, artifact):
+    task_id = artifact['task_ids'][0]
+    url = f"https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}"
+    worker = threading.Thread(target=app.download_youtube_video, args=(url, None, 'job', artifact))
+    worker.start()
+    assert wait_until(lambda: artifact.get('stop'))
+
+    response = app.app.test_client().delete(f'/api/video/task/{task_id}')
+    assert response.status_code == 200
+    worker.join(10)
+
+    assert not worker.is_alive()
+    assert artifact['status'] == 'failed' and artifact['error'] == 'Cancelled'
+    assert app.task_store.get(task_id)['status'] == 'cancelled'
+    assert not any(entry.get('prefix') == artifact['output_path'] for _, entry, _ in app.process_registry.entries())
+
+
+def test_a_shared_download_keeps_going_for_the_other_task(artifact):
+    first = artifact['task_ids'][0]
+    second = uuid.uuid4().hex
+    app.task_store.create(second, {'status': 'pending', 'artifact_key': artifact['key']})
+    app.claim_artifact(artifact['key'], second)
+
+    app.cancel_task(first)
+    assert not artifact.get('cancelled')
+    assert app.task_store.get(second)['status'] == 'pending'
+
+    app.cancel_task(second)
+    assert artifact['cancelled']
+
+
+def test_unknown_task_is_404():
+    assert app.app.test_client().delete('/api/video/task/nope').status_code == 404
+
+
+def test_tasks_nobody_polls_are_cancelled(artifact, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'TASK_POLL_TIMEOUT', 60)
+    task_id = artifact['task_ids'][0]
+    app.task_store.update(task_id, last_polled=time.time() - 61)
+
+    app.cancel_abandoned_tasks()
+    assert app.task_store.get(task_id)['status'] == 'cancelled'
+    assert artifact['cancelled']
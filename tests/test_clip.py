@@ -0,0 +1,71 @@
+"""Time-range clips: request parsing and the yt-dlp command they produce"""
+import pytest
+
+import app
+
+URL = 'https://www.youtube.com/watch?v=abcdefghijk'
+
+
+@pytest.mark.parametrize('value, seconds', [
+    (90, 90.0),
+    ('90', 90.0),
+    ('1:30', 90.0),
+    ('01:02:03.5', 3723.5),
+    ('90:00', 5400.0),
+    ('0:59.999', 59.999),
+])
+def test_timestamps(value, seconds):
+    assert app.parse_timestamp(value) == seconds
+
+
+@pytest.mark.parametrize('value', [
+    '1:75', '0:99:99', '1:60:00', '0:00:60', 'abc', '1::2', '-5', True, float('nan'), float('inf')
+])
+def test_malformed_timestamps(value):
+    assert app.parse_timestamp(value) is None
+
+
+def test_no_range_is_the_whole_video():
+    assert app.parse_clip({}) is None
+    assert app.parse_clip({'start': '', 'end': ''}) is None
+
+
+def test_range_defaults_to_a_keyframe_cut_from_zero():
+    assert app.parse_clip({'end': '1:00'}) == {'start': 0.0, 'end': 60.0, 'accurate': False}
+    assert app.parse_clip({'start': 5, 'end': 10, 'accurate_cut': 'yes'})['accurate'] is True
+
+
+@pytest.mark.parametrize('data', [
+    {'start': 5},
+    {'start': '1:75', 'end': '3:00'},
+    {'start': 0, 'end': '0:99:99'},
+    {'start': -1, 'end': 5},
+    {'start': 10, 'end': 10},
+    {'start': 0, 'end': 5, 'accurate_cut': 'maybe'},
+])
+def test_bad_ranges_are_400(data):
+    with pytest.raises(app.ApiError) as raised:
+        app.parse_clip(data)
+    assert raised.value.status == 400
+
+
+def test_out_of_range_timestamp_is_400_on_the_route():
+    response = app.app.test_client().post('/api/video/info', json={'url': URL, 'start': '1:75', 'end': '3:00'})
+    assert response.status_code == 400
+
+
+def test_clip_is_clamped_to_the_duration():
+    clip = app.parse_clip({'start': 10, 'end': 500})
+    assert app.bound_clip(clip, 120)['end'] == 120.0
+    with pytest.raises(app.ApiError):
+        app.bound_clip(clip, 5)
+
+
+@pytest.mark.parametrize('accurate', [False, True])
+def test_download_sections(ytdlp, artifact, accurate):
+    clip = {'start': 61.5, 'end': 90.0, 'accurate': accurate}
+    app.download_youtube_video(URL, None, 'job', artifact, video_key='youtube:abcdefghijk', clip=clip)
+
+    [cmd] = ytdlp.commands
+    assert cmd[cmd.index('--download-sections') + 1] == '*61.5-90'
+    assert ('--force-keyframes-at-cuts' in cmd) is accurate
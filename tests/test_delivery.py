@@ -0,0 +1,68 @@
+"""File delivery handed to the front proxy instead of streamed through the app"""
+import os
+import uuid
+from urllib.parse import quote
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def completed(artifact):
+    """A completed task whose file sits in the download folder"""
+    path = os.path.join(app.app.config['DOWNLOAD_FOLDER'], f"media_{uuid.uuid4().hex} [1].mp4")
+    with open(path, 'wb') as f:
+        f.write(b'media' * 100)
+    app.file_index.add(path, 3600)
+    app.update_artifact(artifact, status='completed', progress=100, file_path=path)
+    app.task_store.update(artifact['task_ids'][0], download_name='video_1')
+    yield artifact['task_ids'][0], path
+    app.file_index.discard(path)
+    os.remove(path)
+
+
+def test_accel_redirect_points_nginx_at_the_file(completed, monkeypatch):
+    task_id, path = completed
+    monkeypatch.setattr(app, 'delivery', app.ProxyDelivery('accel'))
+
+    response = app.app.test_client().get(f'/api/video/file/{task_id}')
+    assert response.status_code == 200
+    assert response.data == b''
+    # Quoted: the file name has a space and brackets
+    assert response.headers['X-Accel-Redirect'] == app.app.config['ACCEL_REDIRECT_PREFIX'] + quote(os.path.basename(path))
+    assert '%20' in response.headers['X-Accel-Redirect']
+    assert response.headers['Content-Disposition'] == 'attachment; filename="video_1.mp4"'
+    assert response.mimetype == 'video/mp4'
+
+
+def test_sendfile_gets_the_absolute_path(completed, monkeypatch):
+    task_id, path = completed
+    monkeypatch.setattr(app, 'delivery', app.ProxyDelivery('sendfile'))
+
+    response = app.app.test_client().get(f'/api/video/file/{task_id}')
+    assert response.headers['X-Sendfile'] == os.path.abspath(path)
+
+
+def test_handed_off_files_are_not_pinned(completed, monkeypatch):
+    task_id, path = completed
+    monkeypatch.setattr(app, 'delivery', app.ProxyDelivery('accel'))
+    before = app.DELIVERIES.value(backend='accel')
+
+    app.app.test_client().get(f'/api/video/file/{task_id}')
+    assert app.file_index._entries[path]['readers'] == 0
+    assert app.task_store.get(task_id)['served_at']
+    assert app.DELIVERIES.value(backend='accel') == before + 1
+
+
+def test_direct_delivery_streams_the_bytes(completed):
+    task_id, path = completed
+    response = app.app.test_client().get(f'/api/video/file/{task_id}')
+    assert response.data == b'media' * 100
+    assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_unknown_backend_is_rejected(monkeypatch):
+    monkeypatch.setitem(app.app.config, 'DELIVERY_BACKEND', 'ftp')
+    with pytest.raises(ValueError):
+        app.create_delivery_backend()
@@ -0,0 +1,125 @@
+"""In-process extraction pool: timeouts, CLI overflow, 503 when saturated and hung-pool replacement"""
+import threading
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def extractor(monkeypatch):
+    """A one-thread pool with a short timeout; extractions block until `release` is set"""
+    monkeypatch.setitem(app.app.config, 'EXTRACTOR_MODE', 'inprocess')
+    monkeypatch.setitem(app.app.config, 'EXTRACTOR_POOL_SIZE', 1)
+    monkeypatch.setitem(app.app.config, 'EXTRACT_TIMEOUT', 0.3)
+    monkeypatch.setitem(app.app.config, 'EXTRACTOR_MAX_RETIRED_POOLS', 1)
+    monkeypatch.setattr(app, '_extract_executor', app._new_extract_executor())
+    monkeypatch.setattr(app, '_retired_extract_executors', set())
+    monkeypatch.setattr(app, '_extract_fallback_slots', threading.BoundedSemaphore(1))
+
+    class Extractor:
+        def __init__(self):
+            self.release = threading.Event()
+            self.inprocess = []
+            self.subprocess = []
+
+        def run_inprocess(self, url, flat=False, cookiefile=None):
+            self.inprocess.append(url)
+            if url.startswith('slow'):
+                self.release.wait(10)
+            return {'id': url, 'engine': 'inprocess'}
+
+        def run_subprocess(self, url, timeout, flat=False, cookiefile=None):
+            self.subprocess.append(url)
+            if url.startswith('slow'):
+                self.release.wait(10)
+            return {'id': url, 'engine': 'subprocess'}
+
+    fake = Extractor()
+    monkeypatch.setattr(app, '_extract_inprocess', fake.run_inprocess)
+    monkeypatch.setattr(app, '_extract_subprocess', fake.run_subprocess)
+    yield fake
+    fake.release.set()
+
+
+def in_background(fn, *args):
+    result = {}
+
+    def run():
+        try:
+            result['value'] = fn(*args)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_extracts_in_the_pool(extractor):
+    assert app._extract_with('a', False, None) == {'id': 'a', 'engine': 'inprocess'}
+    assert extractor.subprocess == []
+
+
+def test_busy_pool_overflows_to_a_bounded_cli(extractor):
+    in_background(app._extract_with, 'slow-1', False, None)
+    wait_for(lambda: extractor.inprocess == ['slow-1'])
+
+    # The pool's only thread is taken: the CLI takes this one at once
+    assert app._extract_with('b', False, None)['engine'] == 'subprocess'
+
+    # With the fallback slot taken too, the next one waits for the pool...
+    in_background(app._extract_with, 'slow-2', False, None)
+    wait_for(lambda: extractor.subprocess == ['b', 'slow-2'])
+    started = time.monotonic()
+    with pytest.raises(app.ApiError) as e:
+        app._extract_with('c', False, None)
+    # ...and gets 503 after one timeout, not two
+    assert e.value.status == 503
+    assert time.monotonic() - started < 0.6
+    assert 'c' not in extractor.inprocess
+
+
+def test_hung_extraction_replaces_the_pool(extractor):
+    pool = app._extract_executor
+    with pytest.raises(Exception, match='timed out'):
+        app._extract_with('slow-1', False, None)
+    wait_for(lambda: app._extract_executor is not pool)
+    assert app._retired_extract_executors == {pool}
+
+    assert app._extract_with('a', False, None)['engine'] == 'inprocess'
+
+    # Once the hung call returns, the retired pool is forgotten
+    extractor.release.set()
+    wait_for(lambda: not app._retired_extract_executors)
+
+
+def test_retired_pools_are_capped(extractor, monkeypatch):
+    monkeypatch.setattr(app, '_extract_fallback_slots', threading.BoundedSemaphore(0))
+    first = app._extract_executor
+    with pytest.raises(Exception, match='timed out'):
+        app._extract_with('slow-1', False, None)
+    wait_for(lambda: app._extract_executor is not first)
+
+    second = app._extract_executor
+    with pytest.raises(Exception, match='timed out'):
+        app._extract_with('slow-2', False, None)
+    time.sleep(0.5)
+    # The cap is one retired pool: the second stays, short-handed
+    assert app._extract_executor is second
+    with pytest.raises(app.ApiError):
+        app._extract_with('a', False, None)
+
+
+def test_subprocess_mode_skips_the_pool(extractor, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'EXTRACTOR_MODE', 'subprocess')
+    assert app._extract_with('a', False, None)['engine'] == 'subprocess'
+    assert extractor.inprocess == []
@@ -0,0 +1,87 @@
+"""The download folder index: TTL expiry, the byte budget, and what is never deleted"""
+import os
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def folder(tmp_path):
+    def make(name, size=5):
+        path = tmp_path / name
+        path.write_bytes(b'x' * size)
+        return str(path)
+    return make
+
+
+def collected(index):
+    return [os.path.basename(path) for path, _ in index.collect()]
+
+
+def test_files_expire_unless_read(folder):
+    index = app.FileIndex(10 ** 6)
+    old, read = folder('old.mp4'), folder('read.mp4')
+    index.add(old, 0)
+    index.add(read, 0)
+    index.acquire(read)
+
+    assert collected(index) == ['old.mp4']
+    assert index.stats()['files'] == 1
+
+    index.release(read)
+    assert collected(index) == ['read.mp4']
+
+
+def test_least_recently_used_files_go_over_budget(folder):
+    index = app.FileIndex(10)
+    a, b, c = folder('a.mp4'), folder('b.mp4'), folder('c.mp4')
+    index.add(a, 3600)
+    index.add(b, 3600)
+    index.touch(a)
+    index.add(c, 3600)
+
+    assert collected(index) == ['b.mp4']
+    assert index.stats()['bytes'] == 10 and index.stats()['evictions'] == 1
+
+
+def test_files_being_written_are_kept(folder):
+    index = app.FileIndex(1)
+    path = folder('media_abc.mp4')
+    index.add(path, 0)
+    index.begin_write(path[:-4])
+    assert collected(index) == []
+    assert index.discard(path) is None
+
+    index.end_write(path[:-4])
+    assert index.discard(path)['size'] == 5
+
+
+def test_janitor_deletes_and_calls_back(folder, monkeypatch):
+    index = app.FileIndex(10 ** 6)
+    monkeypatch.setattr(app, 'file_index', index)
+    evicted = []
+    path = folder('gone.mp4')
+    index.add(path, 0, on_evict=lambda: evicted.append(path))
+
+    app.run_janitor_pass()
+    assert not os.path.exists(path)
+    assert evicted == [path]
+
+
+def test_startup_index_skips_files_that_are_not_ours(tmp_path, folder, monkeypatch):
+    index = app.FileIndex(10 ** 6)
+    monkeypatch.setattr(app, 'file_index', index)
+    monkeypatch.setitem(app.app.config, 'DOWNLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setattr(app.download_journal, 'unfinished_prefixes', lambda: ['media_resume'])
+    monkeypatch.setattr(app.download_journal, 'live_prefixes', lambda: ['media_live'])
+    monkeypatch.setattr(app.process_registry, 'entries', lambda: [
+        (1, {'prefix': str(tmp_path / 'media_running')}, True),
+        (2, {'prefix': str(tmp_path / 'media_dead')}, False),
+    ])
+    for name in ('media_old.mp4', 'media_dead.mp4', 'media_resume.f137.mp4', 'media_live.mp4',
+                 'media_running.mp3', 'media_new.mp4.part'):
+        folder(name)
+
+    app.index_existing_files()
+    assert sorted(os.path.basename(p) for p in index._entries) == ['media_dead.mp4', 'media_old.mp4']
@@ -0,0 +1,97 @@
+"""InfoCache: TTL/LRU eviction and single-flight loading"""
+import threading
+import time
+
+import app
+
+
+def test_concurrent_misses_load_once():
+    cache = app.InfoCache(ttl=60, max_entries=10)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {'title': 'x'}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('k', loader))) for _ in range(8)]
+    threads[0].start()
+    assert started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    # Followers are parked on the leader's flight before it finishes
+    deadline = time.time() + 5
+    while cache.coalesced < 7:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert len(calls) == 1
+    assert len(results) == 8 and all(r is results[0] for r in results)
+    assert cache.misses == 1 and cache.coalesced == 7
+    assert cache.get_or_load('k', loader) is results[0]
+    assert cache.hits == 1
+
+
+def test_a_failed_load_reaches_every_waiter_and_is_not_cached():
+    cache = app.InfoCache(ttl=60, max_entries=10)
+    release = threading.Event()
+
+    def failing():
+        release.wait(5)
+        raise ValueError('boom')
+
+    errors = []
+
+    def call():
+        try:
+            cache.get_or_load('k', failing)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for t in threads:
+        t.start()
+    deadline = time.time() + 5
+    while cache.misses + cache.coalesced < 4:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert len(errors) == 4
+    assert cache.get('k') is None
+    assert cache.get_or_load('k', lambda: 'fresh') == 'fresh'
+
+
+def test_entries_expire():
+    cache = app.InfoCache(ttl=0.05, max_entries=10)
+    cache.put('k', 'v')
+    assert cache.get('k') == 'v'
+    time.sleep(0.1)
+    assert cache.get('k') is None
+
+
+def test_least_recently_used_is_evicted():
+    cache = app.InfoCache(ttl=60, max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.evictions == 1
+
+
+def test_invalidate():
+    cache = app.InfoCache(ttl=60, max_entries=2)
+    cache.put('k', 1)
+    cache.invalidate('k')
+    assert cache.get('k') is None
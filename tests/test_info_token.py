@@ -0,0 +1,106 @@
+"""info_token: /api/video/info hands out a saved copy of the info that downloads start from"""
+import json
+import os
+import time
+
+import pytest
+
+import app
+
+URL = 'https://www.youtube.com/watch?v=abcdefghijk'
+VIDEO_KEY = 'youtube:abcdefghijk'
+
+
+def info(expire_in=3600):
+    return {
+        'id': 'abcdefghijk',
+        'title': 'Clip',
+        'duration': 120,
+        'formats': [{'format_id': '18', 'url': f"https://r1.googlevideo.com/videoplayback?expire={int(time.time() + expire_in)}"}]
+    }
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    jobs = []
+    monkeypatch.setattr(app, 'submit_download', lambda artifact, params, job_name, priority=None:
+                        jobs.append(params))
+    before = set(app.artifacts)
+    yield jobs
+    for key in set(app.artifacts) - before:
+        app.artifacts.pop(key, None)
+
+
+def test_token_is_issued_once_per_info_dict():
+    data = info()
+    token = app.issue_info_token(VIDEO_KEY, data)
+    assert app.INFO_TOKEN_RE.match(token)
+    assert app.issue_info_token(VIDEO_KEY, data) == token
+    assert app.issue_info_token(VIDEO_KEY, info()) != token
+
+    with open(app.info_token_path(token)) as f:
+        saved = json.load(f)
+    assert saved['_video_key'] == VIDEO_KEY and saved['title'] == 'Clip'
+
+
+def test_load_rejects_unknown_stale_and_malformed_tokens():
+    assert app.load_info_token('../../etc/passwd') is None
+    assert app.load_info_token('0' * 32) is None
+
+    expiring = app.issue_info_token(VIDEO_KEY, info(expire_in=60))
+    assert app.load_info_token(expiring) is None
+
+    old = app.issue_info_token(VIDEO_KEY, info())
+    assert app.load_info_token(old)['_video_key'] == VIDEO_KEY
+    past = time.time() - app.app.config['INFO_TOKEN_TTL'] - 1
+    os.utime(app.info_token_path(old), (past, past))
+    assert app.load_info_token(old) is None
+
+    app.prune_info_tokens()
+    assert not os.path.exists(app.info_token_path(old))
+
+
+def test_summary_carries_a_token():
+    summary = app.summarize_info(info(), URL, 'youtube')
+    assert app.load_info_token(summary['info_token'])['id'] == 'abcdefghijk'
+
+
+def test_download_starts_from_the_token(submitted):
+    token = app.issue_info_token(VIDEO_KEY, info())
+    response = app.app.test_client().post('/api/video/download', json={'url': URL, 'info_token': token})
+    assert response.status_code == 202
+    assert submitted[0]['info_token'] == token
+
+
+def test_token_for_another_video_is_400(submitted):
+    token = app.issue_info_token('youtube:zzzzzzzzzzz', info())
+    response = app.app.test_client().post('/api/video/download', json={'url': URL, 'info_token': token})
+    assert response.status_code == 400
+    assert submitted == []
+
+
+@pytest.mark.parametrize('token', [VIDEO_KEY, '0' * 32])
+def test_old_or_expired_tokens_fall_back_to_extraction(submitted, token):
+    response = app.app.test_client().post('/api/video/download', json={'url': URL, 'info_token': token})
+    assert response.status_code == 202
+    assert submitted[0]['info_token'] is None
+
+
+def test_downloader_loads_the_saved_info(ytdlp, artifact):
+    token = app.issue_info_token(VIDEO_KEY, info())
+    app.download_youtube_video(URL, None, 'job', artifact, video_key=VIDEO_KEY, info_token=token)
+
+    [cmd] = ytdlp.commands
+    assert cmd[-2:] == ['--load-info-json', app.info_token_path(token)]
+    assert artifact['status'] == 'completed'
+    # The saved copy outlives the download for other tasks
+    assert os.path.exists(app.info_token_path(token))
+
+
+def test_rejected_info_falls_back_to_the_url(ytdlp, artifact):
+    token = app.issue_info_token(VIDEO_KEY, info())
+    ytdlp.results = [(1, False)]
+    app.download_youtube_video(URL, None, 'job', artifact, video_key=VIDEO_KEY, info_token=token)
+
+    assert [cmd[-1] for cmd in ytdlp.commands] == [app.info_token_path(token), URL]
+    assert artifact['status'] == 'completed'
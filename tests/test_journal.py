@@ -0,0 +1,154 @@
+"""DownloadJournal entries, orphan claiming and the resume path after a restart"""
+import os
+import uuid
+
+import pytest
+
+import app
+
+# Owner of entries left behind by a worker that is gone
+DEAD_OWNER = {'pid': os.getpid(), 'start_time': 'not-a-start-time'}
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    journal = app.DownloadJournal(str(tmp_path / 'journal'))
+    monkeypatch.setattr(app, 'download_journal', journal)
+    return journal
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    jobs = []
+    monkeypatch.setattr(app, 'submit_download', lambda artifact, params, job_name, priority=None:
+                        jobs.append((artifact['key'], params)))
+    return jobs
+
+
+@pytest.fixture
+def key():
+    key = f"test_{uuid.uuid4().hex}"
+    yield key
+    app.artifacts.pop(key, None)
+
+
+def new_task(**fields):
+    task_id = uuid.uuid4().hex
+    app.task_store.create(task_id, dict({'status': 'pending'}, **fields))
+    return task_id
+
+
+def orphan_entry(journal, key, tmp_path, **fields):
+    """Journal entry as a worker that died mid-download would have left it"""
+    task_id = uuid.uuid4().hex
+    entry = dict({
+        'key': key,
+        'output_path': str(tmp_path / app.artifact_base_name(key)),
+        'status': 'downloading',
+        'file_path': None,
+        'params': {'url': 'https://www.youtube.com/watch?v=x', 'platform': 'youtube'},
+        'resume_attempts': 0,
+        'tasks': {task_id: {'status': 'downloading', 'progress': 40, 'artifact_key': key}},
+        'owner': DEAD_OWNER
+    }, **fields)
+    journal._write(journal._file(key), entry)
+    return entry, task_id
+
+
+def test_record_and_forget(journal, key):
+    task_id = new_task()
+    artifact, _ = app.claim_artifact(key, task_id)
+    artifact['params'] = {'url': 'u', 'platform': 'youtube'}
+    journal.record(artifact)
+
+    [entry] = journal.entries()
+    assert entry['key'] == key
+    assert entry['params'] == artifact['params']
+    assert entry['tasks'][task_id]['status'] == 'pending'
+    assert entry['owner']['pid'] == os.getpid()
+
+    # Nothing left to resume once no task wants it
+    artifact['task_ids'].clear()
+    journal.record(artifact)
+    assert journal.entries() == []
+
+
+def test_claim_orphans_takes_dead_workers_entries_once(journal, key, tmp_path):
+    orphan_entry(journal, key, tmp_path)
+    live_key = f"test_{uuid.uuid4().hex}"
+    orphan_entry(journal, live_key, tmp_path,
+                 owner={'pid': os.getpid(), 'start_time': app._process_start_time(os.getpid())})
+
+    claimed = journal.claim_orphans()
+    assert [e['key'] for e in claimed] == [key]
+    assert claimed[0]['owner']['start_time'] == app._process_start_time(os.getpid())
+    assert journal.claim_orphans() == []
+
+
+def test_interrupted_download_is_resumed(journal, submitted, key, tmp_path):
+    entry, task_id = orphan_entry(journal, key, tmp_path)
+    [claimed] = journal.claim_orphans()
+    app.recover_download(claimed)
+
+    # The task came back from the journal's copy
+    task = app.task_store.get(task_id)
+    assert task['status'] == 'pending' and task['phase'] == 'resuming'
+    artifact = app.artifacts[key]
+    assert artifact['resume_attempts'] == 1
+    assert submitted == [(key, entry['params'])]
+    [recorded] = journal.entries()
+    assert recorded['resume_attempts'] == 1
+
+
+def test_resume_gives_up_after_too_many_restarts(journal, submitted, key, tmp_path):
+    attempts = app.app.config['MAX_RESUME_ATTEMPTS']
+    entry, task_id = orphan_entry(journal, key, tmp_path, resume_attempts=attempts)
+    partial = entry['output_path'] + '.mp4.part'
+    open(partial, 'wb').close()
+
+    app.recover_download(journal.claim_orphans()[0])
+
+    assert submitted == []
+    assert app.task_store.get(task_id)['status'] == 'failed'
+    assert not os.path.exists(partial)
+    assert key not in app.artifacts
+    assert journal.entries() == []
+
+
+def test_finished_download_is_restored(journal, submitted, key, tmp_path):
+    file_path = str(tmp_path / (app.artifact_base_name(key) + '.mp4'))
+    with open(file_path, 'wb') as f:
+        f.write(b'video')
+    _, task_id = orphan_entry(journal, key, tmp_path, status='completed', file_path=file_path)
+
+    app.recover_download(journal.claim_orphans()[0])
+
+    task = app.task_store.get(task_id)
+    assert task['status'] == 'completed' and task['file_path'] == file_path
+    assert submitted == []
+
+
+def test_cancelled_tasks_are_not_resumed(journal, submitted, key, tmp_path):
+    entry, task_id = orphan_entry(journal, key, tmp_path)
+    app.task_store.create(task_id, {'status': 'downloading', 'cancel_requested': True})
+    partial = entry['output_path'] + '.mp4.part'
+    open(partial, 'wb').close()
+
+    app.recover_download(journal.claim_orphans()[0])
+
+    assert submitted == []
+    assert key not in app.artifacts
+    assert not os.path.exists(partial)
+    assert journal.entries() == []
+
+
+def test_new_request_for_the_same_download_wins(journal, submitted, key, tmp_path):
+    _, task_id = orphan_entry(journal, key, tmp_path)
+    artifact, _ = app.claim_artifact(key, new_task())
+    app.update_artifact(artifact, status='downloading', progress=70)
+
+    app.recover_download(journal.claim_orphans()[0])
+
+    assert submitted == []
+    assert task_id in artifact['task_ids']
+    assert app.task_store.get(task_id)['status'] == 'downloading'
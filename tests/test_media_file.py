@@ -0,0 +1,129 @@
+"""Range, multipart and conditional requests through send_media_file"""
+import os
+
+import pytest
+
+import app
+
+CONTENT = bytes(range(256)) * 40          # 10240 bytes
+
+
+@pytest.fixture
+def media(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(CONTENT)
+    return str(path)
+
+
+def serve(path, headers=None, method='GET'):
+    closed = []
+    with app.app.test_request_context('/file', method=method, headers=headers or {}):
+        response = app.send_media_file(path, 'video/mp4', on_close=lambda: closed.append(True))
+    return response, closed
+
+
+def body(response):
+    data = b"".join(response.response)
+    response.close()
+    return data
+
+
+def test_full_body(media):
+    response, closed = serve(media)
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert body(response) == CONTENT
+    assert closed == [True]
+
+
+def test_bounded_range(media):
+    response, closed = serve(media, {'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(CONTENT)}'
+    assert response.headers['Content-Length'] == '100'
+    assert body(response) == CONTENT[100:200]
+    assert closed == [True]
+
+
+def test_open_ended_and_suffix_ranges(media):
+    response, _ = serve(media, {'Range': 'bytes=10000-'})
+    assert response.status_code == 206
+    assert body(response) == CONTENT[10000:]
+
+    response, _ = serve(media, {'Range': 'bytes=-50'})
+    assert response.headers['Content-Range'] == f'bytes {len(CONTENT) - 50}-{len(CONTENT) - 1}/{len(CONTENT)}'
+    assert body(response) == CONTENT[-50:]
+
+
+def test_range_past_the_end_is_clamped(media):
+    response, _ = serve(media, {'Range': f'bytes=10200-{len(CONTENT) + 500}'})
+    assert response.status_code == 206
+    assert body(response) == CONTENT[10200:]
+
+
+def test_whole_file_range_is_a_plain_200(media):
+    response, _ = serve(media, {'Range': f'bytes=0-{len(CONTENT) - 1}'})
+    assert response.status_code == 200
+    assert body(response) == CONTENT
+
+
+def test_unsatisfiable_range(media):
+    response, closed = serve(media, {'Range': f'bytes={len(CONTENT)}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(CONTENT)}'
+    response.close()
+    assert closed == [True]
+
+
+def test_multipart_ranges(media):
+    response, closed = serve(media, {'Range': 'bytes=0-9,20-29'})
+    assert response.status_code == 206
+    mimetype, _, boundary = response.headers['Content-Type'].partition('; boundary=')
+    assert mimetype == 'multipart/byteranges'
+
+    data = body(response)
+    assert data == (
+        f"--{boundary}\r\nContent-Type: video/mp4\r\nContent-Range: bytes 0-9/{len(CONTENT)}\r\n\r\n".encode()
+        + CONTENT[0:10] + b"\r\n"
+        + f"--{boundary}\r\nContent-Type: video/mp4\r\nContent-Range: bytes 20-29/{len(CONTENT)}\r\n\r\n".encode()
+        + CONTENT[20:30] + b"\r\n"
+        + f"--{boundary}--\r\n".encode()
+    )
+    assert closed == [True]
+
+
+def test_if_range_with_a_stale_etag_sends_everything(media):
+    response, _ = serve(media, {'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert response.status_code == 200
+    assert body(response) == CONTENT
+
+
+def test_if_range_with_the_current_etag_honours_the_range(media):
+    response, _ = serve(media)
+    etag = response.headers['ETag']
+    response.close()
+
+    response, _ = serve(media, {'Range': 'bytes=0-9', 'If-Range': etag})
+    assert response.status_code == 206
+    assert body(response) == CONTENT[:10]
+
+
+def test_if_none_match(media):
+    response, closed = serve(media)
+    etag = response.headers['ETag']
+    response.close()
+
+    response, closed = serve(media, {'If-None-Match': etag})
+    assert response.status_code == 304
+    response.close()
+    assert closed == [True]
+
+
+@pytest.mark.parametrize('headers', [{}, {'Range': 'bytes=100-199'}, {'Range': 'bytes=0-9,20-29'}])
+def test_body_closed_before_iteration_releases_the_file(media, headers):
+    # HEAD requests and clients that leave early close the body unread
+    before = len(os.listdir('/proc/self/fd'))
+    response, closed = serve(media, headers, method='HEAD')
+    response.close()
+    assert closed == [True]
+    assert len(os.listdir('/proc/self/fd')) == before
@@ -0,0 +1,74 @@
+"""Prometheus text rendering of the per-worker metrics"""
+import os
+
+import app
+
+
+def render(*metrics):
+    registry = app.MetricsRegistry()
+    for metric in metrics:
+        registry.register(metric)
+    return registry.render().splitlines()
+
+
+def test_counter_samples_carry_their_labels_and_the_worker():
+    counter = app.Counter('test_total', 'Things', ('cause',))
+    counter.inc(cause='a')
+    counter.inc(2, cause='b')
+    counter.inc(cause='a')
+
+    worker = os.getpid()
+    assert render(counter) == [
+        '# HELP test_total Things',
+        '# TYPE test_total counter',
+        f'test_total{{cause="a",worker="{worker}"}} 2',
+        f'test_total{{cause="b",worker="{worker}"}} 2',
+    ]
+    assert counter.value(cause='a') == 2
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = app.Histogram('test_seconds', 'Durations', ('stage',), buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, stage='x')
+
+    worker = os.getpid()
+    assert render(histogram)[2:] == [
+        f'test_seconds_bucket{{stage="x",le="0.1",worker="{worker}"}} 1',
+        f'test_seconds_bucket{{stage="x",le="1.0",worker="{worker}"}} 3',
+        f'test_seconds_bucket{{stage="x",le="+Inf",worker="{worker}"}} 4',
+        f'test_seconds_sum{{stage="x",worker="{worker}"}} 6.05',
+        f'test_seconds_count{{stage="x",worker="{worker}"}} 4',
+    ]
+
+
+def test_timer_observes_once():
+    histogram = app.Histogram('test_seconds', 'Durations', ('stage',))
+    with histogram.time(stage='y'):
+        pass
+    assert render(histogram)[-1] == f'test_seconds_count{{stage="y",worker="{os.getpid()}"}} 1'
+
+
+def test_label_values_are_escaped():
+    counter = app.Counter('test_total', 'Things', ('cause',))
+    counter.inc(cause='say "hi"\\\n')
+    assert render(counter)[-1] == f'test_total{{cause="say \\"hi\\"\\\\\\n",worker="{os.getpid()}"}} 1'
+
+
+def test_a_failing_gauge_does_not_break_the_scrape():
+    def broken():
+        raise RuntimeError('store unavailable')
+    lines = render(app.Gauge('test_broken', 'Broken', collect=broken),
+                   app.Gauge('test_ok', 'Fine', collect=lambda: {(): 3}))
+    assert lines == ['# HELP test_ok Fine', '# TYPE test_ok gauge', f'test_ok{{worker="{os.getpid()}"}} 3']
+
+
+def test_endpoint():
+    app.BYTES_SERVED.inc(0, endpoint='test')
+    response = app.app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    body = response.get_data(as_text=True)
+    assert '# TYPE video_api_stage_duration_seconds histogram' in body
+    assert f'video_api_served_bytes_total{{endpoint="test",worker="{os.getpid()}"}} 0' in body
+    assert '# TYPE video_api_tasks gauge' in body
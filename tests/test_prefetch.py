@@ -0,0 +1,62 @@
+"""Speculative prefetch: preempting unadopted downloads and requeueing adopted ones"""
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def prefetch(monkeypatch):
+    submitted = []
+    monkeypatch.setattr(app, 'submit_download', lambda artifact, params, job_name, priority=None:
+                        submitted.append(artifact['key']))
+    key = f"test_{uuid.uuid4().hex}"
+    artifact, is_owner = app.claim_artifact(key, None, speculative=True)
+    assert is_owner
+    artifact['platform'] = 'youtube'
+    artifact['params'] = {'platform': 'youtube'}
+    stopped = []
+    artifact['stop'] = lambda: stopped.append(key)
+    app.update_artifact(artifact, status='downloading')
+    yield artifact, stopped, submitted
+    app.artifacts.pop(key, None)
+
+
+def adopt(artifact):
+    task_id = uuid.uuid4().hex
+    app.task_store.create(task_id, {'status': 'pending', 'artifact_key': artifact['key']})
+    app.claim_artifact(artifact['key'], task_id)
+    return task_id
+
+
+def test_preempt_stops_an_unadopted_prefetch(prefetch):
+    artifact, stopped, submitted = prefetch
+    app.preempt_speculative('youtube')
+
+    assert stopped == [artifact['key']]
+    assert artifact['cancelled'] and artifact['preempted']
+    # Nobody wanted it: the job's cancel path drops it
+    assert not app.requeue_preempted(artifact)
+    assert submitted == []
+
+
+def test_prefetch_adopted_while_stopping_is_queued_again(prefetch):
+    artifact, stopped, submitted = prefetch
+    app.preempt_speculative('youtube')
+    adopt(artifact)
+
+    assert app.requeue_preempted(artifact)
+    assert submitted == [artifact['key']]
+    assert not artifact['cancelled']
+    assert artifact['status'] == 'pending'
+
+
+def test_prefetch_adopted_before_preempting_is_left_alone(prefetch):
+    artifact, stopped, submitted = prefetch
+    adopt(artifact)
+
+    assert not app.cancel_artifact(artifact, preempt=True)
+    app.preempt_speculative('youtube')
+    assert stopped == []
+    assert not artifact.get('cancelled')
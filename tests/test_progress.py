@@ -0,0 +1,102 @@
+"""Structured progress: yt-dlp's JSON lines in, SSE or long-poll out"""
+import json
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture
+def task_id(artifact):
+    return artifact['task_ids'][0]
+
+
+def progress_line(filename, downloaded, total, vcodec='avc1', acodec='none', status='downloading'):
+    progress = {'filename': filename, 'downloaded_bytes': downloaded, 'total_bytes': total,
+                'speed': 1000.0, 'eta': 3, 'status': status}
+    return f"[progress] {json.dumps({'progress': progress, 'vcodec': vcodec, 'acodec': acodec})}\n"
+
+
+def test_tracks_are_reported_as_one_transfer(artifact, task_id, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'PROGRESS_MIN_INTERVAL', 0)
+    tracker = app.ProgressTracker(artifact)
+
+    tracker.feed_line(progress_line('v.mp4', 500, 1000))
+    task = app.task_store.get(task_id)
+    # Half of the first of two tracks
+    assert task['progress'] == 23.8
+    assert (task['downloaded_bytes'], task['total_bytes'], task['speed'], task['eta']) == (500, 1000, 1000.0, 3)
+
+    tracker.feed_line(progress_line('v.mp4', 1000, 1000, status='finished'))
+    tracker.feed_line(progress_line('a.m4a', 100, 100, vcodec='none', acodec='mp4a', status='finished'))
+    task = app.task_store.get(task_id)
+    assert task['progress'] == 95 and task['total_bytes'] == 1100
+
+    tracker.feed_line('[postprocess] {"postprocessor": "Merger", "status": "started"}\n')
+    assert app.task_store.get(task_id)['phase'] == 'merging'
+
+
+def test_garbage_lines_are_ignored(artifact):
+    tracker = app.ProgressTracker(artifact)
+    tracker.feed_line('[progress] {not json\n')
+    tracker.feed_line('ERROR: HTTP Error 429: Too Many Requests\n')
+    assert tracker.throttled
+
+
+@pytest.mark.parametrize('query', [
+    {'wait': 'soon'}, {'wait': '5', 'since': 'yesterday'}, {'wait': 'nan'}, {'wait': '-1'}, {'wait': '1', 'since': 'inf'}
+])
+def test_bad_long_poll_args_are_400(client, task_id, query):
+    response = client.get(f'/api/video/progress/{task_id}', query_string=query)
+    assert response.status_code == 400
+
+
+def test_unknown_task_is_404(client):
+    assert client.get('/api/video/progress/nope').status_code == 404
+
+
+def test_long_poll_wakes_on_the_next_update(client, artifact, task_id):
+    app.update_artifact(artifact, progress=10)
+    since = app.task_store.get(task_id)['updated_at']
+
+    timer = threading.Timer(0.2, lambda: app.update_artifact(artifact, progress=42))
+    timer.start()
+    response = client.get(f'/api/video/progress/{task_id}', query_string={'wait': 10, 'since': since})
+    timer.join()
+
+    assert response.status_code == 200
+    assert response.json['progress'] == 42 and response.json['updated_at'] > since
+
+
+def test_event_stream_ends_with_the_terminal_state(client, artifact, task_id):
+    app.update_artifact(artifact, status='failed', error='boom')
+    response = client.get(f'/api/video/progress/{task_id}')
+    assert response.mimetype == 'text/event-stream'
+
+    events = [e for e in response.get_data(as_text=True).split('\n\n') if e]
+    assert len(events) == 1
+    data = json.loads(events[0].split('data: ', 1)[1])
+    assert data['status'] == 'failed' and data['error'] == 'boom'
+
+
+def test_event_streams_are_capped(client, task_id, monkeypatch):
+    monkeypatch.setattr(app, 'progress_stream_slots', threading.BoundedSemaphore(1))
+    app.progress_stream_slots.acquire()
+
+    body = client.get(f'/api/video/progress/{task_id}').get_data(as_text=True)
+    assert body.startswith(f"retry: {app.app.config['PROGRESS_RETRY_MS']}\n")
+    assert 'event: progress' in body
+
+
+def test_closing_a_stream_frees_its_slot(client, artifact, task_id, monkeypatch):
+    monkeypatch.setattr(app, 'progress_stream_slots', threading.BoundedSemaphore(1))
+    app.update_artifact(artifact, status='completed')
+
+    client.get(f'/api/video/progress/{task_id}').close()
+    assert app.progress_stream_slots.acquire(blocking=False)
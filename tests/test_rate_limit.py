@@ -0,0 +1,150 @@
+"""Per-platform token buckets and the cookie identity pool"""
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+import app
+from test_scheduler import Jobs, wait_for
+
+
+def test_bucket_grants_its_burst_then_reports_the_wait():
+    bucket = app.TokenBucket(rate=1 / 60, burst=2)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    assert 59 < bucket.try_acquire() <= 60
+    assert bucket.stats()['granted'] == 2
+
+
+def test_acquire_gives_up_at_once_when_the_wait_is_too_long():
+    bucket = app.TokenBucket(rate=1 / 60, burst=1)
+    bucket.acquire()
+    started = time.monotonic()
+    assert bucket.acquire(timeout=5) is False
+    assert time.monotonic() - started < 1
+    assert bucket.rejected == 1
+
+
+def test_pause_withholds_tokens():
+    bucket = app.TokenBucket(rate=100, burst=5)
+    bucket.pause(30)
+    assert 29 < bucket.delay() <= 30
+    assert bucket.try_acquire() > 29
+
+
+def test_zero_rate_is_unlimited():
+    bucket = app.TokenBucket(rate=0, burst=0)
+    assert all(bucket.try_acquire() == 0 for _ in range(100))
+    assert bucket.acquire(timeout=0)
+
+
+def test_rate_limited_platform_waits_in_the_queue():
+    bucket = app.TokenBucket(rate=1 / 60, burst=1)
+    scheduler = app.DownloadScheduler(
+        1, {}, 10, admit=lambda job, waiting: bucket.try_acquire() if job['platform'] == 'youtube' else 0
+    )
+    jobs = Jobs()
+    scheduler.submit('y1', 'youtube', jobs.run, ('y1',))
+    scheduler.submit('y2', 'youtube', jobs.run, ('y2',))
+    scheduler.submit('i1', 'instagram', jobs.run, ('i1',))
+
+    wait_for(lambda: jobs.ran == ['y1', 'i1'])
+    wait_for(lambda: scheduler.stats()['running'] == 0)
+    assert scheduler.stats()['queued'] == 1
+
+
+class Upload:
+    def __init__(self, text):
+        self.text = text
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.text)
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    pool = app.IdentityPool(str(tmp_path / 'pool'), str(tmp_path / 'cookies.txt'), backoff=60, backoff_max=150)
+    monkeypatch.setattr(app, 'identity_pool', pool)
+    monkeypatch.setitem(app.platform_buckets, 'youtube', app.TokenBucket(rate=100, burst=5))
+    return pool
+
+
+def test_identities_rotate_and_back_off(pool):
+    pool.save('youtube', 'a', Upload('# a'))
+    pool.save('youtube', 'b', Upload('# b'))
+
+    first = pool.acquire('youtube')
+    second = pool.acquire('youtube')
+    assert {first['name'], second['name']} == {'a', 'b'}
+
+    assert pool.release(first, throttled=True) == 60
+    pool.release(second, succeeded=True)
+    assert pool.acquire('youtube') is second
+
+    # Consecutive throttles double the backoff, up to the cap
+    assert pool.release(second, throttled=True) == 60
+    assert pool.acquire('youtube')['name'] == 'anonymous'
+    second['backoff_until'] = 0
+    pool.acquire('youtube')
+    assert pool.release(second, throttled=True) == 120
+    second['backoff_until'] = 0
+    pool.acquire('youtube')
+    assert pool.release(second, throttled=True) == 150
+
+
+def test_throttled_anonymous_requests_pause_the_platform(pool):
+    anonymous = pool.acquire('youtube')
+    assert anonymous['path'] is None
+    pool.release(anonymous, throttled=True)
+    assert app.platform_buckets['youtube'].delay() > 59
+
+
+def test_cookie_option_is_replaced():
+    cmd = ['yt-dlp', '--cookies', 'old.txt', '--format', 'best', 'URL']
+    identity = {'path': 'new.txt'}
+    assert app.with_identity(cmd, identity) == ['yt-dlp', '--cookies', 'new.txt', '--format', 'best', 'URL']
+    assert app.with_identity(cmd, {'path': None}) == ['yt-dlp', '--format', 'best', 'URL']
+
+
+def test_throttled_download_retries_as_the_next_identity(pool, ytdlp, artifact):
+    pool.save('youtube', 'a', Upload('# a'))
+    pool.save('youtube', 'b', Upload('# b'))
+    ytdlp.results = [(1, True), (0, False)]
+    url = f"https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}"
+    app.download_youtube_video(url, None, 'job', artifact)
+
+    first, second = [cmd[cmd.index('--cookies') + 1] for cmd in ytdlp.commands]
+    assert first != second
+    assert artifact['status'] == 'completed'
+    assert all(i['leases'] == 0 for i in pool.stats())
+
+
+def test_anonymous_throttling_fails_the_download(pool, ytdlp, artifact):
+    ytdlp.results = [(1, True)]
+    url = f"https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}"
+    app.download_youtube_video(url, None, 'job', artifact)
+
+    assert len(ytdlp.commands) == 1
+    assert artifact['status'] == 'failed' and artifact['retry_after'] == 60
+
+
+def test_warm_extractors_pick_up_refreshed_cookies(tmp_path):
+    cookies = tmp_path / 'cookies.txt'
+    cookies.write_text('# Netscape HTTP Cookie File\n')
+    found = []
+
+    def run():
+        first = app._get_worker_ydl(cookiefile=str(cookies))
+        same = app._get_worker_ydl(cookiefile=str(cookies))
+        os.utime(cookies, (time.time() + 10, time.time() + 10))
+        refreshed = app._get_worker_ydl(cookiefile=str(cookies))
+        found.extend([first is same, refreshed is not first, refreshed.params['cookiefile'] == str(cookies)])
+
+    # Instances are per pool thread
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert found == [True, True, True]
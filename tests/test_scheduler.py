@@ -0,0 +1,92 @@
+"""DownloadScheduler ordering, limits and queue positions"""
+import threading
+import time
+
+import pytest
+
+import app
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+class Jobs:
+    """Records the order jobs ran in; 'block' jobs hold their slot until released"""
+
+    def __init__(self):
+        self.ran = []
+        self.release = threading.Event()
+
+    def run(self, name, block=False):
+        self.ran.append(name)
+        if block:
+            self.release.wait(5)
+
+
+def test_higher_priority_starts_first():
+    scheduler = app.DownloadScheduler(1, {}, 10)
+    jobs = Jobs()
+    scheduler.submit('busy', 'youtube', jobs.run, ('busy', True))
+    wait_for(lambda: jobs.ran == ['busy'])
+
+    scheduler.submit('low', 'youtube', jobs.run, ('low',), priority=app.PRIORITY_LOW)
+    scheduler.submit('normal', 'youtube', jobs.run, ('normal',))
+    scheduler.submit('high', 'youtube', jobs.run, ('high',), priority=app.PRIORITY_HIGH)
+    scheduler.submit('normal2', 'youtube', jobs.run, ('normal2',))
+    assert scheduler.position('high')[0] == 1
+    assert scheduler.position('low')[0] == 4
+    jobs.release.set()
+
+    wait_for(lambda: len(jobs.ran) == 5)
+    assert jobs.ran == ['busy', 'high', 'normal', 'normal2', 'low']
+
+
+def test_promote_and_cancel():
+    scheduler = app.DownloadScheduler(1, {}, 10)
+    jobs = Jobs()
+    scheduler.submit('busy', 'youtube', jobs.run, ('busy', True))
+    wait_for(lambda: jobs.ran == ['busy'])
+
+    scheduler.submit('a', 'youtube', jobs.run, ('a',))
+    scheduler.submit('b', 'youtube', jobs.run, ('b',), priority=app.PRIORITY_LOW)
+    scheduler.submit('c', 'youtube', jobs.run, ('c',))
+    scheduler.promote('b', app.PRIORITY_HIGH)
+    scheduler.promote('a', app.PRIORITY_LOW)          # never demotes
+    assert scheduler.cancel('c')
+    assert not scheduler.cancel('c')
+    jobs.release.set()
+
+    wait_for(lambda: len(jobs.ran) == 3)
+    time.sleep(0.05)
+    assert jobs.ran == ['busy', 'b', 'a']
+
+
+def test_queue_limit():
+    scheduler = app.DownloadScheduler(1, {}, 1)
+    jobs = Jobs()
+    scheduler.submit('busy', 'youtube', jobs.run, ('busy', True))
+    wait_for(lambda: jobs.ran == ['busy'])
+    scheduler.submit('a', 'youtube', jobs.run, ('a',))
+    with pytest.raises(app.SchedulerFull):
+        scheduler.submit('b', 'youtube', jobs.run, ('b',))
+    assert scheduler.stats()['rejected'] == 1
+    jobs.release.set()
+
+
+def test_platform_limit_lets_other_platforms_past():
+    scheduler = app.DownloadScheduler(2, {'youtube': 1}, 10)
+    jobs = Jobs()
+    scheduler.submit('y1', 'youtube', jobs.run, ('y1', True))
+    wait_for(lambda: jobs.ran == ['y1'])
+    scheduler.submit('y2', 'youtube', jobs.run, ('y2',))
+    scheduler.submit('i1', 'instagram', jobs.run, ('i1',))
+
+    wait_for(lambda: 'i1' in jobs.ran)
+    assert 'y2' not in jobs.ran
+    assert not scheduler.has_room('youtube')
+    jobs.release.set()
+    wait_for(lambda: 'y2' in jobs.ran)
@@ -0,0 +1,92 @@
+"""Progressive streaming: pick a plan, pipe the process output, never hand ffmpeg stale URLs"""
+import sys
+import time
+import uuid
+
+import pytest
+
+import app
+
+PROGRESSIVE = {'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a', 'height': 360, 'url': 'https://m/18'}
+VIDEO_ONLY = {'format_id': '137', 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'none', 'height': 1080, 'url': 'https://m/137'}
+M4A = {'format_id': '140', 'ext': 'm4a', 'vcodec': 'none', 'acodec': 'mp4a', 'abr': 128, 'url': 'https://m/140'}
+OPUS = {'format_id': '251', 'ext': 'webm', 'vcodec': 'none', 'acodec': 'opus', 'abr': 160, 'url': 'https://m/251'}
+
+
+def info(*formats, expire_in=3600):
+    expire = int(time.time() + expire_in)
+    return {'id': 'x', 'formats': [dict(f, url=f"{f['url']}?expire={expire}") for f in formats]}
+
+
+@pytest.fixture
+def url():
+    return f"https://www.youtube.com/watch?v={uuid.uuid4().hex[:11]}"
+
+
+def test_plans():
+    plan = app.plan_stream(info(PROGRESSIVE, VIDEO_ONLY, M4A), False)
+    assert plan['kind'] == 'ffmpeg' and [f['format_id'] for f in plan['formats']] == ['137', '140']
+
+    plan = app.plan_stream(info(PROGRESSIVE, VIDEO_ONLY), False)
+    assert plan['kind'] == 'ytdlp' and plan['formats'][0]['format_id'] == '18'
+
+    plan = app.plan_stream(info(M4A, OPUS), True, 'mp3')
+    assert (plan['kind'], plan['ext']) == ('ffmpeg', 'mp3')
+
+    plan = app.plan_stream(info(M4A, OPUS), True, 'opus')
+    assert (plan['kind'], plan['formats'][0]['format_id'], plan['ext']) == ('ytdlp', '251', 'webm')
+
+    assert app.plan_stream(info(VIDEO_ONLY), False) is None
+    assert app.plan_stream(info(PROGRESSIVE), True) is None
+
+
+def test_merged_video_is_fragmented_mp4_on_stdout():
+    plan = app.plan_stream(info(VIDEO_ONLY, M4A), False)
+    cmd = app.build_stream_command(plan, 'https://www.youtube.com/watch?v=x')
+    assert cmd[0] == app.FFMPEG_PATH and cmd[-1] == 'pipe:1'
+    assert 'frag_keyframe+empty_moov+default_base_moof' in cmd
+
+
+def test_expiring_urls_are_re_extracted_before_ffmpeg_reads_them(monkeypatch, url):
+    extractions = [info(VIDEO_ONLY, M4A, expire_in=10), info(VIDEO_ONLY, M4A)]
+    monkeypatch.setattr(app, 'get_cached_info', lambda url, platform: extractions.pop(0))
+
+    cmd, plan, filename, release = app.prepare_stream(url, False, 'mp3')
+    release()
+    assert extractions == []
+    assert plan['kind'] == 'ffmpeg' and filename.endswith('.mp4')
+    assert app.info_urls_fresh({'formats': [{'url': cmd[cmd.index('-i') + 1]}]})
+
+
+def test_stream_pipes_the_process_output(monkeypatch, url):
+    monkeypatch.setattr(app, 'get_cached_info', lambda url, platform: info(PROGRESSIVE))
+    body = b'\x00\x00\x00\x18ftypmp42' * 1000
+    monkeypatch.setattr(app, 'build_stream_command', lambda *args: [
+        sys.executable, '-c', f"import sys; sys.stdout.buffer.write({body!r})"
+    ])
+
+    response = app.app.test_client().get('/api/video/stream', query_string={'url': url})
+    assert response.status_code == 200
+    assert response.mimetype == 'video/mp4'
+    assert response.data == body
+    response.close()
+
+    # The slot went back to the pool
+    for _ in range(app.app.config['MAX_CONCURRENT_STREAMS']):
+        assert app.stream_slots.acquire(blocking=False)
+    for _ in range(app.app.config['MAX_CONCURRENT_STREAMS']):
+        app.stream_slots.release()
+
+
+def test_no_streamable_format_is_422(monkeypatch, url):
+    monkeypatch.setattr(app, 'get_cached_info', lambda url, platform: info(VIDEO_ONLY))
+    response = app.app.test_client().get('/api/video/stream', query_string={'url': url})
+    assert response.status_code == 422
+
+
+def test_streams_are_capped(monkeypatch, url):
+    monkeypatch.setattr(app, 'get_cached_info', lambda url, platform: info(PROGRESSIVE))
+    monkeypatch.setattr(app, 'stream_slots', app.threading.BoundedSemaphore(1))
+    app.stream_slots.acquire()
+    response = app.app.test_client().get('/api/video/stream', query_string={'url': url})
+    assert response.status_code == 503
@@ -0,0 +1,47 @@
+"""Both task store backends must return the same documents for the same writes"""
+import pytest
+
+import app
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return app.SqliteTaskStore(str(tmp_path / 'tasks.sqlite3'))
+    return app.InMemoryTaskStore()
+
+
+def test_updates_merge_fields(store):
+    store.create('t', {'status': 'pending', 'progress': 0})
+    assert store.update('t', status='downloading', progress=40, speed=1024.5)
+    assert store.update('t', progress=60)
+    assert store.get('t') == {'status': 'downloading', 'progress': 60, 'speed': 1024.5}
+    assert not store.update('missing', status='x')
+
+
+def test_none_is_kept_as_null(store):
+    store.create('t', {'status': 'downloading', 'error': 'old', 'file_path': '/x'})
+    store.update('t', error=None, file_path=None, eta=None)
+    assert store.get('t') == {'status': 'downloading', 'error': None, 'file_path': None, 'eta': None}
+
+
+def test_nested_values_and_dotted_keys(store):
+    store.create('t', {})
+    store.update('t', clip={'start': 1.5, 'end': 3}, tags=[1, 2], **{'a.b': 1})
+    assert store.get('t') == {'clip': {'start': 1.5, 'end': 3}, 'tags': [1, 2], 'a.b': 1}
+
+
+def test_counts_and_purge(store):
+    store.create('a', {'status': 'completed'})
+    store.create('b', {'status': 'completed'})
+    store.create('c', {'status': 'failed'})
+    store.update('a', served_at=100.0)
+    store.update('b', served_at=300.0)
+    assert store.count() == 3
+    assert store.count_by_status() == {'completed': 2, 'failed': 1}
+
+    purged = store.purge_served(200.0)
+    assert list(purged) == ['a']
+    assert store.get('a') is None and store.get('b') is not None
+    store.delete('b')
+    assert store.count() == 1
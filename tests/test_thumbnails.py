@@ -0,0 +1,149 @@
+"""Thumbnails come from the extracted info and are fetched once, by whichever worker is asked"""
+import os
+import time
+import uuid
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def source(tmp_path):
+    """A remote thumbnail stand-in: a JPEG reachable through a file:// URL"""
+    path = tmp_path / 'maxresdefault.jpg'
+    path.write_bytes(b'\xff\xd8\xff\xe0 not really a jpeg')
+    return path.as_uri()
+
+
+def video_key():
+    return f"youtube:{uuid.uuid4().hex[:11]}"
+
+
+def test_best_jpeg_is_picked_from_the_info_dict():
+    info = {'thumbnails': [
+        {'url': 'https://i.ytimg.com/vi/x/default.jpg'},
+        {'url': 'https://i.ytimg.com/vi/x/hqdefault.jpg'},
+        {'url': 'https://i.ytimg.com/vi_webp/x/maxresdefault.webp'},
+    ]}
+    assert app.pick_thumbnail_url(info) == 'https://i.ytimg.com/vi/x/hqdefault.jpg'
+    assert app.pick_thumbnail_url({'thumbnail': 'https://x/y.png'}) == 'https://x/y.png'
+    assert app.pick_thumbnail_url({}) is None
+
+
+def test_info_summary_links_the_thumbnail_without_running_anything(monkeypatch, source):
+    def no_subprocess(*args, **kwargs):
+        raise AssertionError("thumbnails must not start a process")
+    monkeypatch.setattr(app.subprocess, 'run', no_subprocess)
+    monkeypatch.setattr(app.subprocess, 'Popen', no_subprocess)
+
+    info = {'id': 'abcdefghijk', 'title': 'Clip', 'formats': [], 'thumbnails': [{'url': source}]}
+    summary = app.summarize_info(info, 'https://www.youtube.com/watch?v=abcdefghijk', 'youtube')
+    assert summary['thumbnail'] == '/api/thumbnail/thumb_youtube_abcdefghijk.jpg'
+    assert summary['thumbnail_small'].startswith(summary['thumbnail'] + '?')
+
+
+def test_any_worker_can_serve_a_registered_thumbnail(source):
+    filename = app.register_thumbnail(video_key(), source)
+    # Another worker: nothing in memory, nothing fetched yet
+    app.thumbnail_sources.pop(filename, None)
+    app._thumbnail_executor.submit(lambda: None).result()
+    path = os.path.join(app.app.config['DOWNLOAD_FOLDER'], filename)
+    if os.path.exists(path):
+        os.remove(path)
+
+    assert app.get_thumbnail_source(filename) == source
+    response = app.app.test_client().get(f'/api/thumbnail/{filename}')
+    assert response.status_code == 200
+    assert response.data.startswith(b'\xff\xd8')
+
+
+def test_unknown_thumbnails_are_404():
+    response = app.app.test_client().get('/api/thumbnail/thumb_youtube_nosuchvideo.jpg')
+    assert response.status_code == 404
+
+
+def test_unused_sources_are_pruned(source):
+    key = video_key()
+    filename = app.register_thumbnail(key, source)
+    path = app._thumbnail_source_path(filename)
+    app.prune_thumbnail_sources()
+    assert os.path.exists(path)
+
+    past = time.time() - app.app.config['THUMBNAIL_TTL'] - 1
+    os.utime(path, (past, past))
+    # Registering again counts as a use
+    app.register_thumbnail(key, source)
+    app.prune_thumbnail_sources()
+    assert os.path.exists(path)
+
+    os.utime(path, (past, past))
+    app.prune_thumbnail_sources()
+    assert not os.path.exists(path)
+
+
+@pytest.mark.parametrize('size, fmt, variant', [
+    (None, None, 'thumb_x.jpg'),
+    ('320', 'webp', 'thumb_x.w320.webp'),
+    ('300', None, 'thumb_x.w320.jpg'),
+    ('1', 'jpeg', 'thumb_x.w160.jpg'),
+    ('5000', 'WEBP', 'thumb_x.w1280.webp'),
+    (None, 'webp', 'thumb_x.w1280.webp'),
+])
+def test_variant_names_snap_to_the_configured_widths(size, fmt, variant):
+    assert app.thumbnail_variant_name('thumb_x.jpg', size, fmt) == variant
+
+
+@pytest.mark.parametrize('query', ['size=big', 'size=0', 'size=-5', 'format=gif'])
+def test_bad_variant_args_are_400(query):
+    assert app.app.test_client().get(f'/api/thumbnail/thumb_x.jpg?{query}').status_code == 400
+
+
+def test_cache_is_bounded_by_bytes():
+    cache = app.ThumbnailCache(160)
+    image = {'body': b'x' * 10}
+    for name in 'abcdefghijklmnopq':
+        cache.put(name, image)
+    assert cache.stats()['bytes'] <= 160
+    assert cache.get('a') is None and cache.get('q') is image
+
+    # Anything over 1/16 of the budget is never cached
+    cache.put('huge', {'body': b'x' * 11})
+    assert cache.get('huge') is None
+
+
+@pytest.fixture
+def ffmpeg(tmp_path, monkeypatch):
+    """A stand-in ffmpeg that writes its arguments as the image"""
+    runs = tmp_path / 'runs'
+    script = tmp_path / 'ffmpeg'
+    script.write_text(f'#!/bin/sh\nfor a; do last=$a; done\necho run >> {runs}\necho "$@" > "$last"\n')
+    script.chmod(0o755)
+    monkeypatch.setattr(app, 'FFMPEG_PATH', str(script))
+    return lambda: len(runs.read_text().splitlines()) if runs.exists() else 0
+
+
+def test_variants_are_rendered_once_and_served_from_memory(source, ffmpeg):
+    filename = app.register_thumbnail(video_key(), source)
+    client = app.app.test_client()
+
+    response = client.get(f'/api/thumbnail/{filename}?size=320&format=webp')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/webp'
+    assert b"scale='min(320,iw)':-2" in response.data and b'libwebp' in response.data
+    assert 'immutable' in response.headers['Cache-Control']
+
+    again = client.get(f'/api/thumbnail/{filename}?size=300&format=webp')
+    assert again.data == response.data
+    assert ffmpeg() == 1
+
+    etag = response.headers['ETag']
+    assert client.get(f'/api/thumbnail/{filename}?size=320&format=webp',
+                      headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_failed_render_is_404(source, monkeypatch):
+    monkeypatch.setattr(app, 'FFMPEG_PATH', 'false')
+    filename = app.register_thumbnail(video_key(), source)
+    response = app.app.test_client().get(f'/api/thumbnail/{filename}?size=160')
+    assert response.status_code == 404